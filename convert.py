@@ -13,13 +13,18 @@ import os
 from converter import convert_dir
 
 if __name__ == '__main__':
+    args = sys.argv[1:]
+    # go on after errors and report all of them
+    recover = '--recover' in args
+    if recover:
+        args.remove('--recover')
     try:
-        rootdir = sys.argv[1]
-        destdir = os.path.abspath(sys.argv[2])
+        rootdir = args[0]
+        destdir = os.path.abspath(args[1])
     except IndexError:
-        print "usage: convert.py docrootdir destdir"
+        print "usage: convert.py [--recover] docrootdir destdir [subdirs...]"
         sys.exit()
 
     assert os.path.isdir(os.path.join(rootdir, 'texinputs'))
     os.chdir(rootdir)
-    convert_dir(destdir, *sys.argv[3:])
+    convert_dir(destdir, *args[2:], recover=recover)
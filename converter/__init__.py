@@ -12,46 +12,124 @@ import os
 import glob
 import shutil
 import codecs
+import mmap
 from os import path
 
 from .tokenizer import Tokenizer
 from .latexparser import DocParser
-from .restwriter import RestWriter
+from .restwriter import RestWriter, OutputBuffer
+from .cache import ParseCache
 from .filenamemap import (fn_mapping, copyfiles_mapping, newfiles_mapping,
                           rename_mapping, dirs_to_make, toctree_mapping,
                           amendments_mapping)
 from .console import red, green
 
+def map_file(infile):
+    """
+    Return a read-only memory map of the file, '' if it is empty; the
+    caller closes the map.
+    """
+    inf = open(infile, 'rb')
+    try:
+        return mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # empty files cannot be mapped
+        return ''
+    finally:
+        inf.close()
+
+
 def convert_file(infile, outfile, doraise=True, splitchap=False,
-                 toctree=None, deflang=None, labelprefix=''):
-    inf = codecs.open(infile, 'r', 'latin1')
-    p = DocParser(Tokenizer(inf.read()).tokenize(), infile)
-    if not splitchap:
-        outf = codecs.open(outfile, 'w', 'utf-8')
+                 toctree=None, deflang=None, labelprefix='', usemmap=False,
+                 cache=None, stream=False, diagnostics=None, bufsize=1<<20):
+    """
+    Convert a LaTeX file to ReST.  With `usemmap`, the file is tokenized
+    directly from a memory map of its bytes and token text is only decoded
+    (from Latin-1) when the parser consumes it.  A `cache`, a `ParseCache`,
+    keeps the parsed document for the next conversion of the same file.
+    With `stream` (and no `cache`), the document is parsed and written
+    section by section and never held in memory as a whole; if title
+    block metadata follows the first section, it is converted again
+    without streaming, with a warning.  A list
+    `diagnostics` turns on recovery mode: errors in the document are
+    appended to it as `Diagnostic`\s instead of stopping the conversion.
+    The ReST is encoded and written out whenever more than `bufsize`
+    characters of it are waiting, and at the end (only then if it is None).
+    """
+    if usemmap:
+        content = map_file(infile)
+        kwds = {'encoding': 'latin1'}
     else:
-        outf = None
-    
-    r = RestWriter(outf, splitchap, toctree, deflang, labelprefix)
+        content = codecs.open(infile, 'r', 'latin1').read()
+        kwds = {}
     try:
-        r.write_document(p.parse())
-        if splitchap:
-            for i, chapter in enumerate(r.chapters[1:]):
-                coutf = codecs.open('%s/%d_%s' % (
-                    path.dirname(outfile), i+1, path.basename(outfile)),
-                                    'w', 'utf-8')
-                coutf.write(chapter.getvalue())
-                coutf.close()
-        else:
-            outf.close()
-        p.finish()  # print warnings about unrecognized commands
-        return 1, r.warnings
-    except Exception, err:
-        if doraise:
-            raise
-        return 0, str(err)
+        if cache is None:
+            p = DocParser(Tokenizer(content, **kwds).tokenize(), infile,
+                          diagnostics=diagnostics)
+        outf = None
+        try:
+            if not splitchap:
+                outf = OutputBuffer(open(outfile, 'wb'), 'utf-8', bufsize)
+            r = RestWriter(outf, splitchap, toctree, deflang, labelprefix,
+                           diagnostics)
+            try:
+                if cache is not None:
+                    p = cache.parser(content, infile, diagnostics=diagnostics,
+                                     **kwds)
+                    r.write_document(p.rootnode)
+                elif stream:
+                    ndiagnostics = len(diagnostics or ())
+                    parts = p.iterparse()
+                    if not r.write_stream(p.rootnode, parts):
+                        # the title block lacks metadata that follows the
+                        # first section: convert the document again as a whole
+                        if diagnostics is not None:
+                            del diagnostics[ndiagnostics:]
+                        if outf is not None:
+                            outf.close()
+                            outf = OutputBuffer(open(outfile, 'wb'), 'utf-8',
+                                                bufsize)
+                        r = RestWriter(outf, splitchap, toctree, deflang,
+                                       labelprefix, diagnostics)
+                        p = DocParser(Tokenizer(content, **kwds).tokenize(),
+                                      infile, diagnostics=diagnostics)
+                        r.write_document(p.parse())
+                        r.warnings.insert(0, 'document metadata after the '
+                                          'first section, converted without '
+                                          'streaming')
+                else:
+                    r.write_document(p.parse())
+            finally:
+                # writes out what the writer wrote, also after an error
+                if outf is not None:
+                    outf.close()
+            if splitchap:
+                for i, chapter in enumerate(r.chapters[1:]):
+                    coutf = codecs.open('%s/%d_%s' % (
+                        path.dirname(outfile), i+1, path.basename(outfile)),
+                                        'w', 'utf-8')
+                    coutf.write(chapter.getvalue())
+                    coutf.close()
+            p.finish()  # print warnings about unrecognized commands
+            return 1, r.warnings
+        except Exception, err:
+            if doraise:
+                raise
+            return 0, str(err)
+    finally:
+        # the document is parsed and written, the tokens are decoded
+        if isinstance(content, mmap.mmap):
+            content.close()
 
 
-def convert_dir(outdirname, *args):
+def convert_dir(outdirname, *args, **options):
+    """
+    Convert the Python documentation to the directory `outdirname`; `args`
+    are the subdirectories to convert (default: all).  With the option
+    `recover`, every file is converted in recovery mode and the problems
+    of all files are reported.
+    """
+    recover = options.get('recover', False)
     # make directories
     for dirname in dirs_to_make:
         try:
@@ -100,11 +178,17 @@ def convert_dir(outdirname, *args):
             toctree = toctree_mapping.get(path.join(subdir, filename))
             infilename = path.join(subdir, filename + '.tex')
             print green(infilename),
+            diagnostics = [] if recover else None
             success, state = convert_file(infilename, outfilename, False,
-                                          splitchap, toctree, deflang, labelprefix)
+                                          splitchap, toctree, deflang, labelprefix,
+                                          diagnostics=diagnostics)
             if not success:
                 print red("ERROR:")
                 print red("    " + state)
+            elif diagnostics:
+                print red("ERRORS:")
+                for diagnostic in diagnostics:
+                    print red("    " + str(diagnostic))
             else:
                 if state:
                     print "warnings:"
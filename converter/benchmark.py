@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""
+    Converter benchmarks
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Timings for the parts of the converter that matter on big inputs.
+    Run as ``python -m converter.benchmark tokenize FILE [PROCESSES...]``
+    or ``python -m converter.benchmark corpus [SIZE [ENGINES...]]``
+    or ``python -m converter.benchmark nesting [DEPTH...]``
+    or ``python -m converter.benchmark output [SIZE [THRESHOLD...]]``
+    or ``python -m converter.benchmark wrap [SIZE [SHAPES...]]``
+    or ``python -m converter.benchmark escape [SIZE [SHAPES...]]``
+    or ``python -m converter.benchmark render [SIZE [SHAPES...]]``.
+"""
+
+import gc
+import os
+import sys
+import time
+import codecs
+import random
+import textwrap
+from StringIO import StringIO
+
+from .tokenizer import Tokenizer
+from .latexparser import DocParser
+from .restwriter import RestWriter, OutputBuffer, WIDTH
+from .util import wrap_text, wordsep_re, fixup_text, \
+     repair_bad_inline_markup, bad_markup_re, quoted_code_re, paren_re, \
+     wordchars_s, wordchars_e
+
+
+def best_of(func, repeat=3):
+    """ Return the best wall clock time of `repeat` calls of `func`. """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_tokenize(text, processes=(1, 2, 4, 8), repeat=3):
+    """
+    Time serial tokenization of `text` against parallel tokenization with
+    each number of `processes`; returns a list of ``(processes, seconds)``
+    where the serial run has ``0`` processes.
+    """
+    results = [(0, best_of(lambda: Tokenizer(text).tokenize(), repeat))]
+    for n in processes:
+        results.append((n, best_of(
+            lambda: Tokenizer(text).tokenize_parallel(n), repeat)))
+    return results
+
+
+# -- synthetic corpus ----------------------------------------------------------
+
+words = ('the module function returns a new list of values and raises an '
+         'error if the argument is not valid this object may be used to '
+         'read write open close data file string number item key').split()
+
+markup_commands = ('emph', 'code', 'var', 'samp', 'function', 'class',
+                   'module', 'keyword', 'file', 'constant', 'method')
+
+
+def _sentence(rnd, nwords):
+    return ' '.join(rnd.choice(words) for i in range(nwords)).capitalize() + '.'
+
+
+def _prose(rnd):
+    lines = []
+    for i in range(rnd.randint(3, 8)):
+        lines.append(_sentence(rnd, rnd.randint(6, 14)))
+    return '\n'.join(lines) + '\n'
+
+
+def _markup(rnd):
+    parts = []
+    for i in range(rnd.randint(20, 40)):
+        choice = rnd.random()
+        word = rnd.choice(words)
+        if choice < 0.5:
+            parts.append('\\%s{%s}' % (rnd.choice(markup_commands), word))
+        elif choice < 0.6:
+            parts.append('\\verb|%s|' % word)
+        elif choice < 0.7:
+            parts.append('$%s_%d$' % (word[0], rnd.randint(0, 9)))
+        elif choice < 0.8:
+            parts.append('\\%s{}' % rnd.choice(('LaTeX', 'ldots', 'e')))
+        else:
+            parts.append(word)
+        parts.append(rnd.choice((' ', ' ', ' ', '~', '\n')))
+    return ''.join(parts).rstrip() + '\n'
+
+
+def _verbatim(rnd):
+    lines = ['\\begin{verbatim}']
+    for i in range(rnd.randint(20, 60)):
+        indent = ' ' * (4 * rnd.randint(0, 3))
+        lines.append('%s%s = %s(%s)  # {%s} \\%s' % (
+            indent, rnd.choice(words), rnd.choice(words), rnd.choice(words),
+            rnd.choice(words), rnd.choice(words)))
+    lines.append('\\end{verbatim}')
+    return '\n'.join(lines) + '\n'
+
+
+def _comments(rnd):
+    lines = []
+    for i in range(rnd.randint(5, 15)):
+        if rnd.random() < 0.7:
+            lines.append('%s%% %s' % (' ' * rnd.randint(0, 4),
+                                      _sentence(rnd, rnd.randint(3, 10))))
+        else:
+            lines.append(_sentence(rnd, rnd.randint(3, 8)) + ' % trailing')
+    return '\n'.join(lines) + '\n'
+
+
+def _nesting(rnd):
+    depth = rnd.randint(10, 40)
+    opening = ''.join('\\%s{%s ' % (rnd.choice(markup_commands),
+                                     rnd.choice(words))
+                      for i in range(depth))
+    return opening + rnd.choice(words) + '}' * depth + '\n'
+
+
+def _tabular(rnd):
+    ncols = rnd.randint(2, 5)
+    lines = ['\\begin{tabular}{%s}' % ('l' * ncols), '\\hline']
+    for i in range(rnd.randint(10, 30)):
+        cells = []
+        for j in range(ncols):
+            if rnd.random() < 0.3:
+                cells.append('\\code{%s}' % rnd.choice(words))
+            else:
+                cells.append(' '.join(rnd.choice(words)
+                                      for k in range(rnd.randint(1, 3))))
+        lines.append(' & '.join(cells) + ' \\\\')
+    lines.extend(['\\hline', '\\end{tabular}'])
+    return '\n'.join(lines) + '\n'
+
+
+corpus_shapes = {
+    'prose':    _prose,
+    'markup':   _markup,
+    'verbatim': _verbatim,
+    'comments': _comments,
+    'nesting':  _nesting,
+    'tabular':  _tabular,
+}
+
+
+def generate_corpus(size, mix='prose', seed=0):
+    """
+    Return a synthetic LaTeX document of at least `size` bytes.  `mix` is
+    the name of one of the `corpus_shapes` or a dict mapping shape names to
+    weights; the paragraphs are drawn from the shapes in proportion to the
+    weights.  The same arguments always give the same document.
+    """
+    if isinstance(mix, basestring):
+        mix = {mix: 1}
+    shapes = []
+    weights = []
+    for name in sorted(mix):
+        if name not in corpus_shapes:
+            raise ValueError('unknown corpus shape %r' % name)
+        shapes.append(corpus_shapes[name])
+        weights.append(mix[name])
+    total = float(sum(weights))
+    rnd = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        choice = rnd.random() * total
+        for shape, weight in zip(shapes, weights):
+            choice -= weight
+            if choice < 0:
+                break
+        part = shape(rnd) + '\n'
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+def count_tokens(text, engine='master'):
+    """ Tokenize `text` and build every token; returns the token count. """
+    count = 0
+    for token in Tokenizer(text, engine=engine).tokenize():
+        count += 1
+    return count
+
+
+def allocations(func):
+    """
+    Return the number of objects that `func` created and that its result
+    refers to, itself included.  The objects that were there before are
+    those the garbage collector tracks and the ones they refer to.
+    """
+    gc.collect()
+    before = gc.get_objects()
+    known = set(map(id, before))
+    known.update(map(id, gc.get_referents(*before)))
+    result = func()
+    count = 0
+    stack = [result]
+    while stack:
+        obj = stack.pop()
+        if id(obj) not in known:
+            known.add(id(obj))
+            count += 1
+            stack.extend(gc.get_referents(obj))
+    return count
+
+
+def bench_corpus(size=1<<20, shapes=None, engines=Tokenizer.engines,
+                 seed=0, repeat=3):
+    """
+    Tokenize a generated corpus of `size` bytes for each of the `shapes`
+    (default: all of them, and all mixed) with each of the `engines`.
+    Returns a list of ``(shape, engine, bytes, tokens, seconds, objects)``
+    where `objects` is what `allocations()` returns for the tokens.
+    """
+    if shapes is None:
+        shapes = sorted(corpus_shapes) + ['mixed']
+    results = []
+    for shape in shapes:
+        if shape == 'mixed':
+            mix = dict.fromkeys(corpus_shapes, 1)
+        else:
+            mix = shape
+        text = generate_corpus(size, mix, seed)
+        for engine in engines:
+            ntokens = count_tokens(text, engine)
+            seconds = best_of(lambda: count_tokens(text, engine), repeat)
+            objects = allocations(
+                lambda: list(Tokenizer(text, engine=engine).tokenize()))
+            results.append((shape, engine, len(text), ntokens, seconds,
+                            objects))
+    return results
+
+
+nesting_kinds = {
+    'commands':     ('\\emph{', 'x', '}'),
+    'groups':       ('{', 'x', '}'),
+    'environments': ('\\begin{quote}', 'x', '\\end{quote}'),
+    'arguments':    ('\\seemodule[p]{m}{\\begin{center}', 'x',
+                     '\\end{center}}'),
+}
+
+
+def nested_document(kind, depth):
+    """ Return a document nesting one of the `nesting_kinds` `depth` deep. """
+    opening, middle, closing = nesting_kinds[kind]
+    return 'Nested.\n\n' + opening * depth + middle + closing * depth + '\n'
+
+
+def bench_nesting(depths=(100, 1000, 10000, 100000), repeat=3):
+    """
+    Parse documents nested to each of the `depths` in each of the ways in
+    `nesting_kinds`.  Returns a list of ``(kind, depth, tokens, seconds)``.
+    """
+    results = []
+    for kind in sorted(nesting_kinds):
+        for depth in depths:
+            text = nested_document(kind, depth)
+            ntokens = len(Tokenizer(text).tokenize()._tokens)
+            seconds = best_of(lambda: DocParser(Tokenizer(text).tokenize(),
+                                                kind).parse(), repeat)
+            results.append((kind, depth, ntokens, seconds))
+    return results
+
+
+class CountingFile(object):
+    """ A byte stream to `os.devnull` that counts the writes to it. """
+    def __init__(self):
+        self.fp = open(os.devnull, 'wb')
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.fp.write(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+def bench_output(size=4<<20, thresholds=(None, 1<<20, 1<<16), seed=0,
+                 repeat=3):
+    """
+    Write the ReST of a generated mixed corpus of `size` bytes, as the
+    writer writes it, to a ``codecs`` UTF-8 writer (what `convert_file()`
+    used) and to an `OutputBuffer` with each of the `thresholds`.  Returns
+    a list of ``(output, writes, seconds)``: the number of encoded strings
+    written to the byte stream and the best time to write the document.
+    """
+    text = generate_corpus(size, dict.fromkeys(corpus_shapes, 1), seed)
+    tree = DocParser(Tokenizer(text).tokenize(), 'corpus').parse()
+    # record the writes once; the writer's own work is the same for all
+    recorder = OutputBuffer(None, threshold=None)
+    RestWriter(recorder).write_document(tree)
+    lines = recorder.parts
+    outputs = [('codecs', lambda fp: codecs.getwriter('utf-8')(fp))]
+    for threshold in thresholds:
+        outputs.append(('buffer %s' % threshold,
+                        lambda fp, n=threshold: OutputBuffer(fp, 'utf-8', n)))
+    results = []
+    for name, output in outputs:
+        def write():
+            fp = CountingFile()
+            outf = output(fp)
+            for line in lines:
+                outf.write(line)
+            outf.close()
+            return fp.writes
+        results.append((name, write(), best_of(write, repeat)))
+    return results
+
+
+def bench_wrap(size=1<<20, shapes=('prose', 'markup'), seed=0, repeat=3):
+    """
+    Wrap the paragraphs of a generated corpus of `size` bytes for each of
+    the `shapes` with `wrap_text()` and with the ``textwrap`` wrapper it
+    replaces.  Returns a list of ``(shape, paragraphs, textwrap seconds,
+    wrap_text seconds)``.
+    """
+    wrapper = textwrap.TextWrapper(WIDTH, break_long_words=False)
+    wrapper.wordsep_re = wordsep_re
+    results = []
+    for shape in shapes:
+        paragraphs = [par.decode('latin1') for par in
+                      generate_corpus(size, shape, seed).split('\n\n')]
+        def old():
+            for par in paragraphs:
+                wrapper.wrap(par)
+        def new():
+            for par in paragraphs:
+                wrap_text(par, WIDTH)
+        results.append((shape, len(paragraphs), best_of(old, repeat),
+                        best_of(new, repeat)))
+    return results
+
+
+class RecordingWriter(RestWriter):
+    """ A writer that keeps the text it escapes and repairs. """
+    def __init__(self, *args):
+        RestWriter.__init__(self, *args)
+        self.paragraphs = []
+        self.texts = []
+
+    def get_par(self, wrap, width=None):
+        if self.curpar:
+            self.paragraphs.append(''.join(self.curpar).lstrip())
+        return RestWriter.get_par(self, wrap, width)
+
+    def visit_TextNode(self, node):
+        if not self.noescape:
+            self.texts.append(node.text)
+        RestWriter.visit_TextNode(self, node)
+
+
+def full_repair_bad_inline_markup(text):
+    """ `repair_bad_inline_markup()` as it was: every pass on every text. """
+    xtext = quoted_code_re.sub(r'\1', text)
+    xtext = xtext.replace('``\\``', '\x03')
+    xtext = xtext.replace('``````', '\x02')
+    xtext = paren_re.sub(r':\1:`\2`', xtext)
+    ntext = []
+    lasti = 0
+    l = len(xtext)
+    for m in bad_markup_re.finditer(xtext):
+        ntext.append(xtext[lasti:m.start()])
+        s, e = m.start(), m.end()
+        if s != 0 and xtext[s-1:s] in wordchars_s:
+            ntext.append('\\ ')
+        ntext.append((m.group(1) or '') + m.group(2) + m.group(3) + m.group(4))
+        if e != l and xtext[e:e+1] in wordchars_e:
+            ntext.append('\\ ')
+        lasti = m.end()
+    ntext.append(xtext[lasti:])
+    return ''.join(ntext).replace('\x02', '``````').replace('\x03', '``\\``')
+
+def full_fixup_text(text):
+    """ `fixup_text()` as it was: five replace calls on every text. """
+    return text.replace('``', '"').replace("''", '"').replace('`', "'").\
+           replace('|', '\\|').replace('*', '\\*')
+
+
+def bench_escape(size=1<<20, shapes=('prose', 'markup'), seed=0, repeat=3):
+    """
+    Time `repair_bad_inline_markup()` on the paragraphs and `fixup_text()`
+    on the text nodes the writer has for a generated corpus of `size`
+    bytes for each of the `shapes`, and the full passes they replace,
+    which must give the same results.  Returns a list of ``(shape,
+    paragraphs, full seconds, seconds, text nodes, full seconds,
+    seconds)``.
+    """
+    results = []
+    for shape in shapes:
+        text = generate_corpus(size, shape, seed).decode('latin1')
+        writer = RecordingWriter(StringIO())
+        writer.write_document(DocParser(Tokenizer(text).tokenize(),
+                                        shape).parse())
+        paragraphs, texts = writer.paragraphs, writer.texts
+        if map(repair_bad_inline_markup, paragraphs) != \
+               map(full_repair_bad_inline_markup, paragraphs) or \
+               map(fixup_text, texts) != map(full_fixup_text, texts):
+            raise AssertionError('%s: the passes disagree' % shape)
+        def timed(func, items):
+            def run():
+                for item in items:
+                    func(item)
+            return best_of(run, repeat)
+        results.append((shape, len(paragraphs),
+                        timed(full_repair_bad_inline_markup, paragraphs),
+                        timed(repair_bad_inline_markup, paragraphs),
+                        len(texts), timed(full_fixup_text, texts),
+                        timed(fixup_text, texts)))
+    return results
+
+
+def bench_render(size=1<<20, shapes=('markup', 'mixed'), seed=0, repeat=3):
+    """
+    Time writing a generated corpus of `size` bytes for each of the
+    `shapes` with and without the writer's memo of rendered inline
+    subtrees.  Returns a list of ``(shape, hits, misses, seconds without,
+    seconds with)``.
+    """
+    results = []
+    for shape in shapes:
+        mix = shape == 'mixed' and dict.fromkeys(corpus_shapes, 1) or shape
+        text = generate_corpus(size, mix, seed).decode('latin1')
+        tree = DocParser(Tokenizer(text).tokenize(), shape).parse()
+        writers = []
+        def write(memo):
+            writer = RestWriter(StringIO())
+            if not memo:
+                writer.rendered = None
+            writer.write_document(tree)
+            writers.append(writer)
+        without = best_of(lambda: write(False), repeat)
+        withmemo = best_of(lambda: write(True), repeat)
+        results.append((shape, writers[-1].render_hits,
+                        writers[-1].render_misses, without, withmemo))
+    return results
+
+
+def main(argv):
+    if len(argv) >= 3 and argv[1] == 'tokenize':
+        text = open(argv[2], 'rb').read()
+        processes = [int(arg) for arg in argv[3:]] or [1, 2, 4, 8]
+        results = bench_tokenize(text, processes)
+        serial = results[0][1]
+        print '%s: %d bytes' % (argv[2], len(text))
+        for n, seconds in results:
+            print '%-10s %8.3fs  %5.2fx' % (n and '%d procs' % n or 'serial',
+                                            seconds, serial / seconds)
+        return 0
+    if len(argv) >= 2 and argv[1] == 'corpus':
+        size = len(argv) > 2 and int(argv[2]) or 1<<20
+        engines = argv[3:] or Tokenizer.engines
+        print '%-10s %-8s %10s %12s %8s %12s' % (
+            'shape', 'engine', 'tokens', 'tokens/s', 'MB/s', 'allocs/token')
+        for shape, engine, nbytes, ntokens, seconds, objects in \
+                bench_corpus(size, engines=engines):
+            print '%-10s %-8s %10d %12.0f %8.2f %12.2f' % (
+                shape, engine, ntokens, ntokens / seconds,
+                nbytes / seconds / (1<<20), float(objects) / ntokens)
+        return 0
+    if len(argv) >= 2 and argv[1] == 'nesting':
+        depths = [int(arg) for arg in argv[2:]] or [100, 1000, 10000, 100000]
+        print '%-13s %8s %10s %10s %12s' % (
+            'kind', 'depth', 'tokens', 'seconds', 'tokens/s')
+        for kind, depth, ntokens, seconds in bench_nesting(depths):
+            print '%-13s %8d %10d %10.3f %12.0f' % (
+                kind, depth, ntokens, seconds, ntokens / seconds)
+        return 0
+    if len(argv) >= 2 and argv[1] == 'output':
+        size = len(argv) > 2 and int(argv[2]) or 4<<20
+        thresholds = [arg != 'none' and int(arg) or None
+                      for arg in argv[3:]] or [None, 1<<20, 1<<16]
+        print '%-16s %10s %10s' % ('output', 'writes', 'seconds')
+        for name, writes, seconds in bench_output(size, thresholds):
+            print '%-16s %10d %10.3f' % (name, writes, seconds)
+        return 0
+    if len(argv) >= 2 and argv[1] == 'wrap':
+        size = len(argv) > 2 and int(argv[2]) or 1<<20
+        shapes = argv[3:] or ['prose', 'markup']
+        print '%-10s %10s %10s %10s %8s' % (
+            'shape', 'paragraphs', 'textwrap', 'wrap_text', 'speedup')
+        for shape, npars, old, new in bench_wrap(size, shapes):
+            print '%-10s %10d %9.3fs %9.3fs %7.1fx' % (shape, npars, old, new,
+                                                      old / new)
+        return 0
+    if len(argv) >= 2 and argv[1] == 'escape':
+        size = len(argv) > 2 and int(argv[2]) or 1<<20
+        shapes = argv[3:] or ['prose', 'markup']
+        print '%-10s %-7s %8s %10s %10s %8s' % (
+            'shape', 'pass', 'count', 'full us', 'us', 'speedup')
+        for shape, npars, oldrepair, repair, ntexts, oldfixup, fixup in \
+                bench_escape(size, shapes):
+            for name, n, old, new in (('repair', npars, oldrepair, repair),
+                                      ('fixup', ntexts, oldfixup, fixup)):
+                print '%-10s %-7s %8d %10.2f %10.2f %7.1fx' % (
+                    shape, name, n, old / n * 1e6, new / n * 1e6, old / new)
+        return 0
+    if len(argv) >= 2 and argv[1] == 'render':
+        size = len(argv) > 2 and int(argv[2]) or 1<<20
+        shapes = argv[3:] or ['markup', 'mixed']
+        print '%-10s %10s %10s %10s %10s %8s' % (
+            'shape', 'hits', 'misses', 'no memo', 'memo', 'speedup')
+        for shape, hits, misses, old, new in bench_render(size, shapes):
+            print '%-10s %10d %10d %9.3fs %9.3fs %7.2fx' % (
+                shape, hits, misses, old, new, old / new)
+        return 0
+    print "usage: python -m converter.benchmark tokenize FILE [PROCESSES...]"
+    print "       python -m converter.benchmark corpus [SIZE [ENGINES...]]"
+    print "       python -m converter.benchmark nesting [DEPTH...]"
+    print "       python -m converter.benchmark output [SIZE [THRESHOLD...]]"
+    print "       python -m converter.benchmark wrap [SIZE [SHAPES...]]"
+    print "       python -m converter.benchmark escape [SIZE [SHAPES...]]"
+    print "       python -m converter.benchmark render [SIZE [SHAPES...]]"
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
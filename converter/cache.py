@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+    Parsed document cache
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Keeps the parsed document tree of each input on disk, so that a file
+    whose LaTeX has not changed is not tokenized and parsed again when only
+    the writer or its settings change.  An entry is found by a hash of the
+    input, the extlinks configuration and the source of the modules that
+    build the tree; the least recently used entries are removed when the
+    cache grows above its size limit.
+
+    Run as ``python -m converter.cache DIR [stats | prune [MAXSIZE] | clear]``
+    to act on the entries of the parse and section caches in DIR; other
+    files in DIR are left alone.
+"""
+
+import os
+import sys
+import zlib
+import errno
+import hashlib
+import tempfile
+import cPickle as pickle
+from os import path
+
+from . import tokenizer, latexparser, docnodes, util
+from .tokenizer import Tokenizer
+from .latexparser import DocParser
+from .docnodes import RootNode
+
+# the modules whose code decides what tree is built for an input
+fingerprint_modules = (tokenizer, latexparser, docnodes, util)
+
+_fingerprints = {}
+
+def fingerprint(modules=fingerprint_modules):
+    """ Return a hash of the source of `modules`. """
+    try:
+        return _fingerprints[modules]
+    except KeyError:
+        pass
+    digest = hashlib.sha1()
+    for module in modules:
+        filename = module.__file__
+        if filename.endswith(('.pyc', '.pyo')) and \
+               path.exists(filename[:-1]):
+            filename = filename[:-1]
+        digest.update(open(filename, 'rb').read())
+    _fingerprints[modules] = digest.hexdigest()
+    return _fingerprints[modules]
+
+
+class DiskCache(object):
+    """
+    A directory of compressed pickles, one file per key, at most `maxsize`
+    bytes big.  Entries are the files ending in `suffix`, so caches of
+    different kinds can share a directory.  `suffixes` are those of the
+    files `entries()`, `prune()` and `clear()` take in, by default just
+    `suffix`; none of them may be empty.
+    """
+    suffix = '.cache'
+
+    def __init__(self, dirname, maxsize=256<<20, suffixes=None):
+        self.dirname = dirname
+        self.maxsize = maxsize
+        self.suffixes = tuple(suffixes or (self.suffix,))
+        if not all(self.suffixes):
+            raise ValueError('cache entries need a file name suffix')
+        # an upper bound of the size of the entries, once it is known
+        self.size = None
+        if not path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def filename(self, key):
+        return path.join(self.dirname, key + self.suffix)
+
+    def get(self, key):
+        """ Return the value stored under `key`, None if there is none. """
+        fn = self.filename(key)
+        try:
+            data = open(fn, 'rb').read()
+        except IOError, err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            value = pickle.loads(zlib.decompress(data))
+        except Exception:
+            # written by another version of the pickled classes, or damaged
+            self.remove(fn)
+            return None
+        # the modification time orders the entries for pruning
+        os.utime(fn, None)
+        return value
+
+    def put(self, key, value):
+        """ Store `value` under `key`; prunes the cache if it is full. """
+        data = zlib.compress(pickle.dumps(value, 2))
+        # write to a temporary file first: a reader never sees half an entry
+        fd, tmpname = tempfile.mkstemp(self.suffix + '.tmp', '', self.dirname)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmpname, self.filename(key))
+        if self.size is not None:
+            self.size += len(data)
+        if self.size is None or self.size > self.maxsize:
+            self.prune()
+
+    def entries(self):
+        """ Return a list of ``(mtime, size, filename)`` of the entries. """
+        entries = []
+        for fn in os.listdir(self.dirname):
+            if not fn.endswith(self.suffixes) or fn.endswith('.tmp'):
+                continue
+            fn = path.join(self.dirname, fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+        return entries
+
+    def remove(self, fn):
+        try:
+            os.unlink(fn)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def prune(self, maxsize=None):
+        """
+        Remove the least recently used entries until the cache holds at most
+        `maxsize` (default: the cache's `maxsize`) bytes; returns the number
+        of entries removed.
+        """
+        if maxsize is None:
+            maxsize = self.maxsize
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, fn in entries)
+        removed = 0
+        for mtime, size, fn in entries:
+            if total <= maxsize:
+                break
+            self.remove(fn)
+            total -= size
+            removed += 1
+        self.size = total
+        return removed
+
+    def clear(self):
+        """ Remove all entries; returns their number. """
+        return self.prune(0)
+
+
+class ParseCache(DiskCache):
+    """ A `DiskCache` of parsed documents. """
+    suffix = '.ast'
+
+    def key(self, content, extlinks={}, parserclass=DocParser, *extra):
+        """
+        Return the key of the tree `parserclass` builds for `content`, a
+        string or a memory map, with `extlinks`.  `extra` are other values
+        the tree depends on, like the encoding of the content.
+        """
+        digest = hashlib.sha1(fingerprint())
+        digest.update(repr((parserclass.__module__, parserclass.__name__,
+                            sorted(extlinks.items()), type(content).__name__,
+                            extra)))
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        digest.update(content)
+        return digest.hexdigest()
+
+    def load(self, key, filename):
+        """
+        Return the root node stored under `key`, named `filename`, the set
+        of unrecognized commands, the parser warnings and the diagnostics of
+        recovery mode; None if there is no such entry.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        params, labels, children, unrecognized, warnings, diagnostics = entry
+        rootnode = RootNode(filename, children)
+        rootnode.params = params
+        rootnode.labels = labels
+        return rootnode, unrecognized, warnings, diagnostics
+
+    def store(self, key, rootnode, unrecognized, warnings=(),
+              diagnostics=()):
+        """ Store a parsed document under `key`. """
+        self.put(key, (rootnode.params, rootnode.labels, rootnode.children,
+                       set(unrecognized), list(warnings), list(diagnostics)))
+
+    def parser(self, content, filename, extlinks={}, parserclass=DocParser,
+               diagnostics=None, **kwds):
+        """
+        Return a `parserclass` instance for `content` whose document is
+        parsed, as `rootnode`, or loaded from the cache.  `diagnostics` is
+        passed to the parser, and gets those of a loaded document too;
+        `kwds` are passed to the `Tokenizer`.
+        """
+        extra = sorted(kwds.items())
+        if diagnostics is not None:
+            # a document parsed in recovery mode does not do without it
+            extra.append('recover')
+        key = self.key(content, extlinks, parserclass, *extra)
+        entry = self.load(key, filename)
+        if entry is not None:
+            p = parserclass(None, filename, extlinks=extlinks,
+                            diagnostics=diagnostics)
+            p.rootnode, p.unrecognized, p.warnings, loaded = entry
+            if diagnostics is not None:
+                diagnostics.extend(loaded)
+            return p
+        found = []
+        p = parserclass(Tokenizer(content, **kwds).tokenize(), filename,
+                        extlinks=extlinks,
+                        diagnostics=found if diagnostics is not None else None)
+        p.parse()
+        self.store(key, p.rootnode, p.unrecognized, p.warnings, found)
+        if diagnostics is not None:
+            diagnostics.extend(found)
+            p.diagnostics = diagnostics
+        return p
+
+
+def main(argv):
+    commands = ('stats', 'prune', 'clear')
+    if not 2 <= len(argv) <= 4 or argv[2:3] and argv[2] not in commands or \
+           len(argv) == 4 and argv[2] != 'prune':
+        print "usage: python -m converter.cache DIR [stats | prune [MAXSIZE] | clear]"
+        return 2
+    # only the entries of the known caches: DIR may hold other files
+    from .incremental import SectionCache
+    cache = DiskCache(argv[1], suffixes=(ParseCache.suffix,
+                                         SectionCache.suffix))
+    command = argv[2:3] and argv[2] or 'stats'
+    if command == 'stats':
+        entries = cache.entries()
+        print '%s: %d entries, %d bytes' % (
+            argv[1], len(entries), sum(entry[1] for entry in entries))
+    elif command == 'prune':
+        maxsize = None
+        if len(argv) > 3:
+            maxsize = int(argv[3])
+        print '%d entries removed' % cache.prune(maxsize)
+    else:
+        print '%d entries removed' % cache.clear()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
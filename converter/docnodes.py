@@ -7,9 +7,14 @@
     :license: BSD.
 """
 
+from bisect import bisect_left
+
 
 class DocNode(object):
     """ A node in the document tree. """
+    # nodes are many and small: no instance dicts
+    __slots__ = ()
+
     def __repr__(self):
         return '%s()' % self.__class__.__name__
 
@@ -20,8 +25,30 @@ class DocNode(object):
         return []
 
 
+class SharedNode(DocNode):
+    """
+    A node without state: every instantiation of a subclass returns the
+    same instance, which is also what unpickling and copying give back.
+    """
+    __slots__ = ()
+
+    def __new__(cls, *args):
+        instance = cls.__dict__.get('_instance')
+        if instance is None:
+            instance = cls._instance = DocNode.__new__(cls)
+        return instance
+
+    def __init__(self, *args):
+        pass
+
+    def __reduce__(self):
+        return (self.__class__, ())
+
+
 class CommentNode(DocNode):
     """ A comment. """
+    __slots__ = ('comment',)
+
     def __init__(self, comment):
         assert isinstance(comment, basestring)
         self.comment = comment
@@ -32,6 +59,8 @@ class CommentNode(DocNode):
 
 class RootNode(DocNode):
     """ A whole document. """
+    __slots__ = ('filename', 'children', 'params', 'labels')
+
     def __init__(self, filename, children):
         self.filename = filename
         self.children = children
@@ -46,20 +75,21 @@ class RootNode(DocNode):
 
     def transform(self):
         """ Do restructurings not possible during parsing. """
-        def do_descenvs(node):
-            r""" Make \xxxlines an attribute of the parent xxxdesc node. """
-            for subnode in node.walk():
-                do_descenvs(subnode)
+        # make \xxxlines an attribute of the parent xxxdesc node; the tree
+        # is walked with a stack, as it may be nested deeper than the
+        # recursion limit
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.walk())
             if isinstance(node, DescEnvironmentNode):
-                for subnode in node.content.walk():
-                    if isinstance(subnode, DescLineCommandNode):
-                        node.additional.append((subnode.cmdname, subnode.args))
-
-        do_descenvs(self)
+                node.collect_lines()
 
 
 class NodeList(DocNode, list):
     """ A list of subnodes. """
+    __slots__ = ()
+
     def __init__(self, children=None):
         list.__init__(self, children or [])
 
@@ -75,7 +105,7 @@ class NodeList(DocNode, list):
             return
         elif self and isinstance(node, TextNode) and \
                  type(self[-1]) is TextNode:
-            self[-1].text += node.text
+            self[-1].add_text(node.text)
         elif type(node) is NodeList:
             list.extend(self, node)
         elif type(node) is VerbatimNode and self and \
@@ -95,17 +125,45 @@ class NodeList(DocNode, list):
             return EmptyNode()
 
 
-class ParaSepNode(DocNode):
+class ParaSepNode(SharedNode):
     """ A node for paragraph separator. """
+    __slots__ = ()
+
     def __repr__(self):
         return 'Para'
 
 
 class TextNode(DocNode):
-    """ A node containing text. """
+    """
+    A node containing text.  Text added to a node is kept as a list of
+    parts that is joined the first time the text is read.
+    """
+    __slots__ = ('_text', '_parts')
+
     def __init__(self, text):
         assert isinstance(text, basestring)
-        self.text = text
+        self._text = text
+        self._parts = None
+
+    def _get_text(self):
+        if self._parts:
+            self._parts.insert(0, self._text)
+            self._text = ''.join(self._parts)
+            self._parts = None
+        return self._text
+
+    def _set_text(self, text):
+        self._text = text
+        self._parts = None
+
+    text = property(_get_text, _set_text)
+
+    def add_text(self, text):
+        """ Append `text` to the text of the node. """
+        if self._parts is None:
+            self._parts = [text]
+        else:
+            self._parts.append(text)
 
     def __repr__(self):
         if type(self) is TextNode:
@@ -115,33 +173,39 @@ class TextNode(DocNode):
 
 class TOCNode(TextNode):
     """ An contents node. """
+    __slots__ = ('title',)
+
     def __init__(self, title):
         self.title = title
 
 
-class EmptyNode(TextNode):
+class EmptyNode(SharedNode, TextNode):
     """ An empty node. """
-    def __init__(self, *args):
-        self.text = ''
+    __slots__ = ()
+    text = ''
 
 
-class AmpersandNode(DocNode):
+class AmpersandNode(SharedNode):
     """ An ampersand node. """
+    __slots__ = ()
+
     def __repr__(self):
         return 'Ampersand'
 
 class GraphicsNode(DocNode):
     """ A graphics node. """
+    __slots__ = ()
+
     def __repr__(self):
         return 'Graphics'
 
 
-class NbspNode(TextNode):
+class NbspNode(SharedNode, TextNode):
     """ A non-breaking space. """
-    def __init__(self, *args):
-        # this breaks ReST markup (!)
-        #self.text = u'\N{NO-BREAK SPACE}'
-        self.text = ' '
+    __slots__ = ()
+    # this breaks ReST markup (!)
+    #text = u'\N{NO-BREAK SPACE}'
+    text = ' '
 
     def __repr__(self):
         return 'NBSP'
@@ -183,18 +247,24 @@ simplecmd_mapping = {
 
 class SimpleCmdNode(TextNode):
     """ A command resulting in simple text. """
+    __slots__ = ()
+
     def __init__(self, cmdname, args):
         self.text = simplecmd_mapping[cmdname]
 
 
-class BreakNode(DocNode):
+class BreakNode(SharedNode):
     """ A line break. """
+    __slots__ = ()
+
     def __repr__(self):
         return 'BR'
 
 
 class CommandNode(DocNode):
     """ A general command. """
+    __slots__ = ('cmdname', 'args')
+
     def __init__(self, cmdname, args):
         self.cmdname = cmdname
         self.args = args
@@ -207,19 +277,25 @@ class CommandNode(DocNode):
 
 class ExtLinkNode(CommandNode):
     """ An external link command """
+    __slots__ = ()
 
 class DescLineCommandNode(CommandNode):
     """ A \\xxxline command. """
+    __slots__ = ()
 
 
 class InlineNode(CommandNode):
     """ A node with inline markup. """
+    __slots__ = ()
+
     def walk(self):
         return []
 
 
 class IndexNode(InlineNode):
     """ An index-generating command. """
+    __slots__ = ('indexargs',)
+
     def __init__(self, cmdname, args):
         self.cmdname = cmdname
         # tricky -- this is to make this silent in paragraphs
@@ -230,10 +306,13 @@ class IndexNode(InlineNode):
 
 class SectioningNode(CommandNode):
     """ A heading node. """
+    __slots__ = ()
 
 
 class EnvironmentNode(DocNode):
     """ An environment. """
+    __slots__ = ('envname', 'args', 'content')
+
     def __init__(self, envname, args, content):
         self.envname = envname
         self.args = args
@@ -249,6 +328,8 @@ class EnvironmentNode(DocNode):
 
 class FloatNode(EnvironmentNode):
     """ A Float environment node base for table/figure   """
+    __slots__ = ('opts',)
+
     def __init__(self, envname, args, content, opts={} ):
         self.envname = envname
         self.args = args
@@ -263,14 +344,17 @@ class FloatNode(EnvironmentNode):
 
 class FigureNode(FloatNode):
     """ A Figure Node """
+    __slots__ = ()
 
 class TableNode(FloatNode):
     """ A Table Node """
-      
+    __slots__ = ()
 
 
 class DescEnvironmentNode(EnvironmentNode):
     """ An xxxdesc environment. """
+    __slots__ = ('additional',)
+
     def __init__(self, envname, args, content):
         self.envname = envname
         self.args = args
@@ -281,8 +365,16 @@ class DescEnvironmentNode(EnvironmentNode):
         return 'DescEnvironmentNode(%r, %r, %r)' % (self.envname,
                                                     self.args, self.content)
 
+    def collect_lines(self):
+        r""" Add the \xxxline commands in the content to `additional`. """
+        for subnode in self.content.walk():
+            if isinstance(subnode, DescLineCommandNode):
+                self.additional.append((subnode.cmdname, subnode.args))
+
 
 class TabularNode(EnvironmentNode):
+    __slots__ = ('numcols', 'headings', 'lines', 'colspec')
+
     def __init__(self, numcols, headings, lines , colspec=None ):
         self.numcols = numcols
         self.headings = headings
@@ -299,6 +391,8 @@ class TabularNode(EnvironmentNode):
 
 class VerbatimNode(DocNode):
     """ A verbatim code block. """
+    __slots__ = ('content',)
+
     def __init__(self, content):
         self.content = content
 
@@ -307,6 +401,8 @@ class VerbatimNode(DocNode):
 
 class RstVerbatimNode(DocNode):
     """ rst inclusion  """
+    __slots__ = ('content',)
+
     def __init__(self, content):
         self.content = content
 
@@ -316,6 +412,8 @@ class RstVerbatimNode(DocNode):
 
 class MathNode(DocNode):
     """ A verbatim math block : equation/eqnarray/etc... """
+    __slots__ = ('content', 'label', 'raw')
+
     def __init__(self, content, label=None, raw=None):
         self.content = content
         self.label = label
@@ -327,6 +425,8 @@ class MathNode(DocNode):
 
 class ListingNode(VerbatimNode):
     """ A code listing environment. """
+    __slots__ = ('args',)
+
     def __init__(self, content, args):
         self.content = content
         self.args = args 
@@ -336,6 +436,8 @@ class ListingNode(VerbatimNode):
 
 class ListNode(DocNode):
     """ A list. """
+    __slots__ = ('items',)
+
     def __init__(self, items):
         self.items = items
 
@@ -348,19 +450,95 @@ class ListNode(DocNode):
 
 class ItemizeNode(ListNode):
     """ An enumeration with bullets. """
+    __slots__ = ()
 
 
 class EnumerateNode(ListNode):
     """ An enumeration with numbers. """
+    __slots__ = ()
 
 
 class DescriptionNode(ListNode):
     """ A description list. """
+    __slots__ = ()
 
 
 class DefinitionsNode(ListNode):
     """ A definition list. """
+    __slots__ = ()
 
 
 class ProductionListNode(ListNode):
     """ A grammar production list. """
+    __slots__ = ('arg',)
+
+
+class NodeIndex(object):
+    """
+    An index of the nodes below a node, in the order ``walk()`` finds
+    them: a flat pre-order list of the nodes with the position of each
+    node's parent and of the end of its subtree, and the positions of the
+    nodes of each class and of the command nodes of each name.  It is
+    built without recursion.  A shared node is looked up by its first
+    position.
+    """
+
+    def __init__(self, root):
+        self.nodes = nodes = []
+        self.parents = parents = []
+        self.types = types = {}
+        self.commands = commands = {}
+        self.numbers = numbers = {}
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            i = len(nodes)
+            nodes.append(node)
+            parents.append(parent)
+            numbers.setdefault(id(node), i)
+            types.setdefault(type(node), []).append(i)
+            if isinstance(node, CommandNode):
+                commands.setdefault(node.cmdname, []).append(i)
+            children = node.walk()
+            if children:
+                stack.extend([(child, i) for child in reversed(children)])
+        # a subtree ends where the last subtree below it ends
+        self.ends = ends = range(1, len(nodes) + 1)
+        for i in xrange(len(nodes) - 1, 0, -1):
+            if ends[i] > ends[parents[i]]:
+                ends[parents[i]] = ends[i]
+
+    def __contains__(self, node):
+        return id(node) in self.numbers
+
+    def subtree(self, node):
+        """ Return the nodes below `node`, in pre-order. """
+        i = self.numbers[id(node)]
+        return self.nodes[i+1:self.ends[i]]
+
+    def parent(self, node):
+        """ Return the parent of `node`, or None for the root. """
+        i = self.parents[self.numbers[id(node)]]
+        if i < 0:
+            return None
+        return self.nodes[i]
+
+    def find(self, node, type=None, cmdname=None):
+        """
+        Return the first node below `node` in pre-order that is an instance
+        of `type`, or a command node named `cmdname`; None if there is none.
+        """
+        i = self.numbers[id(node)]
+        if cmdname is not None:
+            candidates = [self.commands.get(cmdname, [])]
+        else:
+            candidates = [positions for cls, positions in self.types.iteritems()
+                          if issubclass(cls, type)]
+        first = end = self.ends[i]
+        for positions in candidates:
+            k = bisect_left(positions, i + 1)
+            if k < len(positions) and positions[k] < first:
+                first = positions[k]
+        if first < end:
+            return self.nodes[first]
+        return None
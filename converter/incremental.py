@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+    Incremental conversion
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Converts a document section by section and keeps the ReST of every
+    top-level section in a cache.  The source is split where
+    `DocParser.iterparse()` would split it; a section is found again by a
+    hash of its source and of the writer state it starts with, so that
+    after an edit only the changed sections (and those whose starting state
+    the change altered) are parsed and written again.  The output is the
+    output of a full conversion; `verify` checks that it is.
+"""
+
+import codecs
+import hashlib
+import cPickle as pickle
+from StringIO import StringIO
+
+from . import restwriter, tabular, filenamemap
+from .cache import DiskCache, fingerprint, fingerprint_modules
+from .tokenizer import Tokenizer, BGROUP, EGROUP, MATHMODE, COMMAND
+from .latexparser import DocParser
+from .restwriter import RestWriter
+
+# the modules whose code decides what ReST is written for a section
+writer_modules = fingerprint_modules + (restwriter, tabular, filenamemap)
+
+
+class VerificationError(Exception):
+    pass
+
+
+def section_spans(tokens, sectioning_commands=DocParser.sectioning_commands):
+    """
+    Return the top-level sections of the document in the `TokenBuffer`
+    `tokens` as a list of ``(start, stop, indocument)``: the source offsets
+    of each part `DocParser.iterparse()` yields, and whether the part starts
+    inside the document environment.
+    """
+    kinds = tokens.kinds
+    starts = tokens.starts
+    data = tokens.data
+    sectioning = set(sectioning_commands)
+    spans = []
+    begin = 0
+    spanindoc = indocument = False
+    # the state of the parser's top frame, and the depth of environments
+    # (all of which end at the next \end, as generic ones do)
+    bracelevel = envlevel = 0
+    mathmode = False
+    ntokens = len(kinds)
+    i = 0
+    while i < ntokens:
+        kind = kinds[i]
+        if envlevel:
+            if kind == COMMAND:
+                name = data[starts[i]+1:starts[i+1]].rstrip(' \t')
+                if name == 'begin':
+                    envlevel += 1
+                elif name == 'end':
+                    envlevel -= 1
+        elif kind == COMMAND:
+            name = data[starts[i]+1:starts[i+1]].rstrip(' \t')
+            if bracelevel:
+                pass
+            elif name in sectioning:
+                if starts[i] > begin:
+                    spans.append((begin, starts[i], spanindoc))
+                    begin = starts[i]
+                    spanindoc = indocument
+                mathmode = False
+            elif name == 'end' and indocument or name == 'begin' and \
+                     i + 3 < ntokens and kinds[i+1] == BGROUP and \
+                     kinds[i+3] == EGROUP and \
+                     data[starts[i+2]:starts[i+3]] == 'document':
+                indocument = name == 'begin'
+                mathmode = False
+                i += 4
+                continue
+            if name == 'begin' and not mathmode:
+                envlevel = 1
+        elif kind == MATHMODE:
+            mathmode = not mathmode
+        elif mathmode:
+            pass
+        elif kind == BGROUP:
+            bracelevel += 1
+        elif kind == EGROUP:
+            bracelevel -= 1
+        i += 1
+    if begin < len(data) or not spans:
+        spans.append((begin, len(data), spanindoc))
+    return spans
+
+
+class SectionCache(DiskCache):
+    """ A `DiskCache` of the ReST written for sections of documents. """
+    suffix = '.sec'
+
+    def key(self, source, indocument, config, state):
+        """
+        Return the key of the ReST for the section with the `source` text,
+        written with the writer `config` from the writer `state`.
+        """
+        digest = hashlib.sha1(fingerprint(writer_modules))
+        digest.update(pickle.dumps((indocument, config, state), 2))
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        digest.update(source)
+        return digest.hexdigest()
+
+
+def write_sections(content, filename, cache, toctree=None, deflang=None,
+                   labelprefix='', extlinks={}):
+    """
+    Convert the LaTeX `content` section by section, taking the sections
+    that did not change from `cache`, a `SectionCache`.  Returns the ReST,
+    the writer warnings, a `DocParser` with the unrecognized commands and
+    warnings of all sections, and the number of sections that were written
+    and that were taken from the cache.  Line numbers are those of the
+    file: a section with parser warnings is only taken from the cache if it
+    still starts on the same line.
+    """
+    tokenizer = Tokenizer(content)
+    spans = section_spans(tokenizer.tokenize()._tokens)
+    writer = RestWriter(None, False, toctree, deflang, labelprefix)
+    config = (toctree, deflang, labelprefix, sorted(extlinks.items()))
+    chunks = []
+    params = {}
+    footnotes = []
+    warnings = []
+    parser = DocParser(None, filename)
+    written = reused = 0
+    for start, stop, indocument in spans:
+        source = content[start:stop]
+        state = writer.get_state()
+        key = cache.key(source, indocument, config, state)
+        lineno = tokenizer.position(start)[0]
+        entry = cache.get(key)
+        if entry is not None and entry[-1] != lineno and entry[5]:
+            # the parser warnings name lines of the section where it was
+            entry = None
+        if entry is not None:
+            text, state, notes, warns, unrec, pwarns, prms = entry[:-1]
+            writer.set_state(state)
+            reused += 1
+        else:
+            writer.fp = StringIO()
+            writer.footnotes = notes = []
+            writer.warnings = warns = []
+            # the section is lexed in place, so that the lines in warnings
+            # and errors are lines of the file
+            p = DocParser(tokenizer.tokenize_range(start, stop), filename,
+                          extlinks=extlinks)
+            for part in p.iterparse(indocument):
+                writer.visit_node(part)
+            writer.flush_par()
+            text = writer.fp.getvalue()
+            unrec, pwarns, prms = p.unrecognized, p.warnings, p.rootnode.params
+            cache.put(key, (text, writer.get_state(), notes, warns, unrec,
+                            pwarns, prms, lineno))
+            written += 1
+        chunks.append(text)
+        footnotes.extend(notes)
+        warnings.extend(warns)
+        parser.unrecognized.update(unrec)
+        parser.warnings.extend(pwarns)
+        params.update(prms)
+
+    # the header goes before the first section, the footnotes after the last
+    header = RestWriter(StringIO(), False, toctree, deflang, labelprefix)
+    if deflang:
+        header.write_directive('highlightlang', deflang)
+    header.write_header(params)
+    writer.fp = StringIO()
+    writer.footnotes = header.footnotes + footnotes
+    writer.write_footnotes()
+    text = header.fp.getvalue() + ''.join(chunks) + writer.fp.getvalue()
+    return text, header.warnings + warnings, parser, written, reused
+
+
+def convert_text(content, filename, toctree=None, deflang=None,
+                 labelprefix='', extlinks={}):
+    """ Return the ReST of a full conversion of the LaTeX `content`. """
+    fp = StringIO()
+    p = DocParser(Tokenizer(content).tokenize(), filename, extlinks=extlinks)
+    RestWriter(fp, False, toctree, deflang, labelprefix).write_document(
+        p.parse())
+    return fp.getvalue()
+
+
+def convert_file(infile, outfile, cache, doraise=True, toctree=None,
+                 deflang=None, labelprefix='', extlinks={}, verify=False):
+    """
+    Convert a LaTeX file to ReST like `converter.convert_file()`, writing
+    only the sections that changed since the last conversion that used
+    `cache`, a `SectionCache`.  With `verify`, the result is compared with
+    a full conversion and a `VerificationError` raised if they differ.
+    """
+    try:
+        content = codecs.open(infile, 'r', 'latin1').read()
+        text, warnings, p, written, reused = write_sections(
+            content, infile, cache, toctree, deflang, labelprefix, extlinks)
+        if verify and text != convert_text(content, infile, toctree, deflang,
+                                           labelprefix, extlinks):
+            raise VerificationError('%s: incremental conversion differs '
+                                    'from a full conversion' % infile)
+        outf = codecs.open(outfile, 'w', 'utf-8')
+        outf.write(text)
+        outf.close()
+        p.finish()  # print warnings about unrecognized commands
+        return 1, warnings
+    except Exception, err:
+        if doraise:
+            raise
+        return 0, str(err)
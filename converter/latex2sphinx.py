@@ -1,7 +1,7 @@
-import os, sys, re, logging
+import os, sys, re, mmap, logging
 log = logging.getLogger(__name__)
 
-from converter import DocParser, Tokenizer, RestWriter 
+from converter import DocParser, Tokenizer, RestWriter, map_file
 from converter import restwriter
 from .tabular import TabularData
 
@@ -13,11 +13,24 @@ class envvars(list):
                 self.append(dict(key=k,val=v)) 
    
 def _convert_file(inf, outf, doraise=True, splitchap=False,
-                 toctree=None, deflang=None, labelprefix='', fakechapter=None, fakesection=None, extlinks={}, verbose=False, dry_run=False , incname=None ):
+                 toctree=None, deflang=None, labelprefix='', fakechapter=None, fakesection=None, extlinks={}, verbose=False, dry_run=False , incname=None, usemmap=False, cache=None, stream=False, diagnostics=None ):
     """
          *fakechapter* and *fakesection* preprend the chapter or section definition to 
          the content read from the source latex file, allowing the converted reST to 
          incorporate the chapter/section title without needing to change the latex source 
+
+         *usemmap* tokenizes straight from a memory map of the file instead of reading 
+         it into memory, this needs a real file and no fake chapter/section prefix
+
+         *cache* a `ParseCache`, loads the parsed document instead of parsing when 
+         the content was parsed before
+
+         *stream* parses and writes the document section by section, without a cache, 
+         to a seekable *outf*: when document metadata follows the first section the 
+         output is truncated and the document converted again without streaming 
+
+         *diagnostics* a list, turns on recovery mode: errors are appended to it 
+         as `Diagnostic` instances, with a comment left in the output for each 
  
     """
 
@@ -28,18 +41,49 @@ def _convert_file(inf, outf, doraise=True, splitchap=False,
     else:
         pfx = ""
 
-    content = inf.read()
+    if usemmap and not (fakechapter or fakesection) and hasattr(inf, 'fileno'):
+        content = map_file(inf.name)
+    else:
+        content = inf.read()
     if fakechapter:
         content = "%s\chapter{%s}\n" % ( pfx, fakechapter ) + content 
     if fakesection:
         content = "%s\section{%s}\n" % ( pfx, fakesection ) + content 
 
-    p = DocParser(Tokenizer(content).tokenize(), inf, extlinks=extlinks)
-    r = RestWriter(outf, splitchap, toctree, deflang, labelprefix)
-    r.write_document(p.parse())
-    if p.unrecognized:
-        outf.write(".. warning:: latexparser did not recognize : " + " ".join(p.unrecognized))
-    return p.unrecognized
+    try:
+        r = RestWriter(outf, splitchap, toctree, deflang, labelprefix, diagnostics)
+        if cache is not None:
+            p = cache.parser(content, inf, extlinks=extlinks, diagnostics=diagnostics)
+            r.write_document(p.rootnode)
+        elif stream:
+            p = DocParser(Tokenizer(content).tokenize(), inf, extlinks=extlinks,
+                          diagnostics=diagnostics)
+            start = outf.tell()
+            ndiagnostics = len(diagnostics or ())
+            parts = p.iterparse()
+            if not r.write_stream(p.rootnode, parts):
+                # the title block lacks metadata that follows the first
+                # section: convert the document again as a whole
+                log.warning("%s: document metadata after the first section, "
+                            "converted without stream" % getattr(inf, 'name', inf))
+                if diagnostics is not None:
+                    del diagnostics[ndiagnostics:]
+                outf.seek(start)
+                outf.truncate()
+                r = RestWriter(outf, splitchap, toctree, deflang, labelprefix, diagnostics)
+                p = DocParser(Tokenizer(content).tokenize(), inf, extlinks=extlinks,
+                              diagnostics=diagnostics)
+                r.write_document(p.parse())
+        else:
+            p = DocParser(Tokenizer(content).tokenize(), inf, extlinks=extlinks,
+                          diagnostics=diagnostics)
+            r.write_document(p.parse())
+        if p.unrecognized:
+            outf.write(".. warning:: latexparser did not recognize : " + " ".join(p.unrecognized))
+        return p.unrecognized
+    finally:
+        if isinstance(content, mmap.mmap):
+            content.close()
 
 
 
@@ -222,10 +266,13 @@ def convert_doc( tex , rst=None, **kwa ):
     rst.close()
     return unrec
 
-def convert_doctree( base , dry_run=False, extlinks={} , verbose=False, envvars=[], force=False ):
+def convert_doctree( base , dry_run=False, extlinks={} , verbose=False, envvars=[], force=False, cache=None, diagnostics=None ):
     """
     Although could recurse from the root, it is simpler to understand errors by 
     manual looping over primaries and recursing from there. 
+
+    A list *diagnostics* converts all files in recovery mode, collecting 
+    the problems of the whole tree in one run
     """
     root = INode(base)
     print "convert_doctree from %r " % root
@@ -233,9 +280,13 @@ def convert_doctree( base , dry_run=False, extlinks={} , verbose=False, envvars=
     predicate = lambda _:1
     #predicate = lambda _:_.is_index
     for pri in filter(predicate,root):
-        pri.tex2rst(recurse=True,dry_run=dry_run,extlinks=extlinks,verbose=verbose, force=force) 
+        pri.tex2rst(recurse=True,dry_run=dry_run,extlinks=extlinks,verbose=verbose, force=force, cache=cache, diagnostics=diagnostics) 
     print "root... "  ## last to facilitate error reporting
     root.tex2rst(recurse=False,verbose=verbose,envvars=envvars, force=force)
+    if diagnostics:
+        print "%d problems:" % len(diagnostics)
+        for diagnostic in diagnostics:
+            print "   ", diagnostic
 
  
 from nose.tools import make_decorator
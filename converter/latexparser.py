@@ -14,62 +14,92 @@ from .docnodes import CommentNode, RootNode, NodeList, ParaSepNode, \
      DescLineCommandNode, InlineNode, IndexNode, SectioningNode, \
      EnvironmentNode, DescEnvironmentNode, TableNode, TabularNode, VerbatimNode, RstVerbatimNode, \
      ListNode, ItemizeNode, EnumerateNode, DescriptionNode, \
-     DefinitionsNode, ProductionListNode, AmpersandNode, ExtLinkNode, ListingNode, FigureNode, MathNode, TOCNode
+     DefinitionsNode, ProductionListNode, AmpersandNode, ExtLinkNode, ListingNode, FigureNode, MathNode, TOCNode, \
+     NodeIndex
 
-from .util import umlaut, empty
+from .util import umlaut, empty, Diagnostic
 import sys, re
+from types import MethodType
 
 def walk(node):
-    for x in node.walk():
-        #print repr(x)
-        yield x
-        for y in walk(x):
-            yield y
+    """ Yield the nodes below `node` in pre-order. """
+    stack = [iter(node.walk())]
+    while stack:
+        for x in stack[-1]:
+            yield x
+            stack.append(iter(x.walk()))
+            break
+        else:
+            stack.pop()
 
 def fwalk(node, filter_=lambda:True):
     return filter(filter_, [_ for _ in walk(node)] )
 
-def find_label(node):
+def find_label(node, index=None):
     """ walk ahead to find the label """
-    nlabel = fwalk(node, lambda _:isinstance(_,CommandNode) and _.cmdname == 'label')
-    if len(nlabel) == 0:
+    if index is None:
+        index = NodeIndex(node)
+    nlabel = index.find(node, cmdname='label')
+    if nlabel is None:
         return None
-    nlabel = nlabel[0]
     return ( nlabel.args[0].text.lower() if  isinstance(nlabel.args[0], TextNode) else None)
 
-def find_caption_node(node):
-    """ walk ahead to find the label """
-    ncaption = fwalk(node, lambda _:isinstance(_,CommandNode) and _.cmdname == 'caption')
-    if len(ncaption) == 0:
-        return None
-    return ncaption[0]
+def find_caption_node(node, index=None):
+    """ walk ahead to find the caption """
+    if index is None:
+        index = NodeIndex(node)
+    return index.find(node, cmdname='caption')
 
-def find_subnode(node, type=ListingNode):
+def find_subnode(node, type=ListingNode, index=None):
     """ walk ahead to look for listing """
-    nfound = fwalk(node, lambda _:isinstance(_,type))
-    if len(nfound) == 0:
-        return None
-    return nfound[0]
+    if index is None:
+        index = NodeIndex(node)
+    return index.find(node, type=type)
 
 
 
 class ParserError(Exception):
-    def __init__(self, msg, lineno):
+    def __init__(self, msg, lineno, col=None):
         Exception.__init__(self, msg, lineno)
+        self.col = col
 
     def __str__(self):
-        return '%s, line %s' % self.args
+        if self.col is None:
+            return '%s, line %s' % self.args
+        return '%s, line %s, column %s' % (self.args + (self.col,))
+
+
+def blank_cell(cell):
+    """
+    Is the table cell, text or a node, only whitespace, comments and
+    commands without arguments like ``\\hline``?
+    """
+    if isinstance(cell, basestring):
+        return not cell.strip()
+    if isinstance(cell, NodeList):
+        return all(blank_cell(node) for node in cell)
+    if isinstance(cell, TextNode):
+        return not cell.text.strip()
+    if isinstance(cell, CommandNode):
+        return not cell.args
+    return isinstance(cell, (EmptyNode, CommentNode, ParaSepNode))
 
 
 def generic_command(name, argspec, nodetype=CommandNode):
+    # every node of the command shares the name
+    name = intern(str(name))
+    parse = argspec_parser(argspec)
+    cmdname = '\\' + name
     def handle(self):
-        args = self.parse_args('\\'+name, argspec)
-        return nodetype(name, args)
+        return nodetype(name, parse(self, cmdname))
+    # lets parse_until open the command itself
+    handle.generic = (cmdname, argspec_steps(argspec), nodetype, name, False)
     return handle
 
 def sectioning_command(name):
     """ Special handling for sectioning commands: move labels directly following
         a sectioning command before it, as required by reST. """
+    name = intern(str(name))
     def handle(self):
         args = self.parse_args('\\'+name, 'M')
         snode = SectioningNode(name, args)
@@ -89,13 +119,160 @@ def sectioning_command(name):
     return handle
 
 def generic_environment(name, argspec, nodetype=EnvironmentNode):
+    name = intern(str(name))
+    parse = argspec_parser(argspec)
     def handle(self):
-        args = self.parse_args(name, argspec)
-        return nodetype(name, args, self.parse_until(self.environment_end))
+        args = parse(self, name)
+        return self.environment_closed(
+            nodetype(name, args, self.parse_until(self.environment_end)))
+    # lets parse_until open the environment itself
+    handle.generic = (name, argspec_steps(argspec), nodetype, name, True)
     return handle
 
 
+def optional_end(type, value, bracelevel):
+    return type == 'eoptional' and bracelevel == 0
+
+def next_argument_token(tokens):
+    """ Pop the next token that is no comment or whitespace. """
+    l, t, v, r = tokens.pop()
+    while t == 'comment' or (t == 'text' and v.isspace()):
+        l, t, v, r = tokens.pop()
+    return l, t, v, r
+
+def parse_optional_arg(self, cmdname, i, textonly):
+    token = next_argument_token(self.tokens)
+    if token[1] != 'boptional':
+        # not given
+        self.tokens.push(token)
+        return EmptyNode()
+    arg = self.parse_until(optional_end)
+    if textonly and not isinstance(arg, TextNode):
+        raise ParserError('%s: argument %d must be text only' %
+                          (cmdname, i), *self.tokens.location(-1))
+    return arg
+
+def parse_mandatory_arg(self, cmdname, i, textonly):
+    nextl, nextt, nextv, nextr = next_argument_token(self.tokens)
+    if nextt == 'bgroup':
+        arg = self.parse_until(None, endatbrace=True)
+        if textonly and not isinstance(arg, TextNode):
+            raise ParserError('%s: argument %d must be text only' %
+                              (cmdname, i), *self.tokens.location(-1))
+        return arg
+    if nextt != 'text':
+        raise ParserError('%s: non-grouped non-text arguments not '
+                          'supported' % cmdname, *self.tokens.location(-1))
+    self.tokens.push((nextl, nextt, nextv[1:], nextr[1:]))
+    return TextNode(nextv[0])
+
+argspec_steps_cache = {}
+
+def argspec_steps(argspec):
+    """
+    Return the steps of parsing the arguments given by `argspec` (see
+    `DocParser.parse_args`): a tuple of ``(optional, textonly)`` flags.
+    """
+    try:
+        return argspec_steps_cache[argspec]
+    except KeyError:
+        pass
+    for c in argspec:
+        if c not in 'OMTQ':
+            raise ValueError('bad argspec %r' % argspec)
+    steps = tuple((c in 'OQ', c in 'TQ') for c in argspec)
+    argspec_steps_cache[argspec] = steps
+    return steps
+
+argspec_parsers = {}
+
+def argspec_parser(argspec):
+    """
+    Return a function ``parse(parser, cmdname)`` that parses the arguments
+    given by `argspec` (see `DocParser.parse_args`) and returns them as a
+    list.  There is one such function per distinct argspec.
+    """
+    try:
+        return argspec_parsers[argspec]
+    except KeyError:
+        pass
+    steps = [(optional and parse_optional_arg or parse_mandatory_arg,
+              i, textonly)
+             for i, (optional, textonly) in enumerate(argspec_steps(argspec))]
+    if not steps:
+        def parse(self, cmdname):
+            return []
+    elif len(steps) == 1:
+        (step, i, textonly), = steps
+        def parse(self, cmdname):
+            return [step(self, cmdname, i, textonly)]
+    else:
+        def parse(self, cmdname):
+            return [step(self, cmdname, i, textonly)
+                    for step, i, textonly in steps]
+    argspec_parsers[argspec] = parse
+    return parse
+
+
+def command_pattern(names):
+    """ Return a regex matching the raw text of the commands `names`. """
+    names = sorted(names, key=len, reverse=True)
+    return re.compile(r'\\(?:%s)(?![a-zA-Z*])' %
+                      '|'.join(map(re.escape, names)))
+
+
+def node_text(node):
+    """ Return the text in `node` and in the arguments of its commands. """
+    parts = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, TextNode):
+            parts.append(node.text)
+        elif isinstance(node, CommandNode):
+            stack.extend(reversed(node.args))
+        else:
+            stack.extend(reversed(node.walk()))
+    return ''.join(parts)
+
+
+class Outline(object):
+    """
+    The structure of a document as `DocParser.outline()` finds it; all
+    entries start with the line number and all names are plain text.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # metadata name -> text
+        self.params = {}
+        # (lineno, command, title, label or None)
+        self.sections = []
+        # (lineno, label)
+        self.labels = []
+        # (lineno, command, target)
+        self.refs = []
+        # (lineno, command, filename)
+        self.includes = []
+
+    def __repr__(self):
+        return 'Outline(%r, %d sections, %d labels, %d refs, %d includes)' % (
+            self.filename, len(self.sections), len(self.labels),
+            len(self.refs), len(self.includes))
+
+
 class DocParserMeta(type):
+    """
+    Creates the handlers of the generic commands and environments, and the
+    `handlers` table mapping command names (and environment names followed
+    by ``_env``) to the ``handle_`` functions the class would find by
+    attribute lookup, and the `generic_handlers` table with the ``generic``
+    attribute of those handlers that have one.  Setting or deleting a
+    ``handle_`` attribute later updates the tables of the class and its
+    subclasses; the handlers of one instance are set with
+    `DocParser.set_handler()`.
+    """
+
     def __init__(cls, name, bases, dict):
         for nodetype, commands in cls.generic_commands.iteritems():
             for cmdname, argspec in commands.iteritems():
@@ -110,18 +287,95 @@ class DocParserMeta(type):
                 setattr(cls, 'handle_%s_env' % envname,
                         generic_environment(envname, argspec, nodetype))
 
+        cls.handlers = {}
+        cls.generic_handlers = {}
+        for attr in dir(cls):
+            if attr.startswith('handle_'):
+                cls.refresh_handler(attr[7:])
+
+    def __setattr__(cls, attr, value):
+        type.__setattr__(cls, attr, value)
+        if attr.startswith('handle_') and 'handlers' in cls.__dict__:
+            cls.refresh_handler(attr[7:])
+
+    def __delattr__(cls, attr):
+        type.__delattr__(cls, attr)
+        if attr.startswith('handle_') and 'handlers' in cls.__dict__:
+            cls.refresh_handler(attr[7:])
+
+    def refresh_handler(cls, name):
+        """ Look up the handler for `name` again, here and in subclasses. """
+        handler = getattr(cls, 'handle_' + name, None)
+        if handler is None:
+            cls.handlers.pop(name, None)
+        else:
+            cls.handlers[name] = getattr(handler, 'im_func', handler)
+        generic = getattr(handler, 'generic', None)
+        if generic is None:
+            cls.generic_handlers.pop(name, None)
+        else:
+            cls.generic_handlers[name] = generic
+        for subclass in cls.__subclasses__():
+            subclass.refresh_handler(name)
+
 
 class DocParser(object):
     """ Parse a Python documentation LaTeX file. """
     __metaclass__ = DocParserMeta
 
-    def __init__(self, tokenstream, filename, extlinks={}):
+    def __init__(self, tokenstream, filename, extlinks={}, singlepass=True,
+                 diagnostics=None):
+        """
+        With `singlepass`, the \\xxxline commands are attached to their
+        xxxdesc environment while parsing, not by `RootNode.transform()`.
+        A list `diagnostics` turns on recovery mode, see `recover()`.
+        """
         self.tokens = tokenstream
         self.filename = filename
+        self.singlepass = singlepass
+        self.diagnostics = diagnostics
         self.unrecognized = set()
-
+        self.unrecognized_handlers = {}
+        # problems in the input that do not stop the parser
+        self.warnings = []
+        self.index = None
+        # (content, opts) of the floats, see resolve_floats()
+        self.floats = []
+
+        # on the instance: the handlers must not outlive this parser
         for name, (patn, prefix) in extlinks.items():
-            setattr( self.__class__ , 'handle_' + name , generic_command( name, 'M' , ExtLinkNode ))
+            self.set_handler(name, MethodType(
+                generic_command(name, 'M', ExtLinkNode), self))
+
+    def set_handler(self, name, handler):
+        """
+        Make `handler` the handler of the command `name` (an environment's
+        name followed by ``_env``) for this parser only, or with None, the
+        class's handler again.  It is called without arguments, like a
+        bound method.  The parser then has copies of the class's `handlers`
+        and `generic_handlers`, which later changes of the class do not
+        reach.
+        """
+        if 'handlers' not in self.__dict__:
+            self.handlers = dict(self.handlers)
+            self.generic_handlers = dict(self.generic_handlers)
+        if handler is None:
+            # the class's handler again, if there is one
+            handler = type(self).handlers.get(name)
+        else:
+            def call(parser, handler=handler):
+                return handler()
+            call.__dict__.update(getattr(handler, '__dict__', {}))
+            handler = call
+        if handler is None:
+            self.handlers.pop(name, None)
+        else:
+            self.handlers[name] = handler
+        generic = getattr(handler, 'generic', None)
+        if generic is None:
+            self.generic_handlers.pop(name, None)
+        else:
+            self.generic_handlers[name] = generic
 
     def finish(self):
         if len(self.unrecognized) != 0:
@@ -131,63 +385,392 @@ class DocParser(object):
                 'handle_unrecognized.\n'
             for cmd in self.unrecognized:
                 print "   ",cmd
+        for warning in self.warnings:
+            print 'WARNING: %s' % warning
 
     def parse(self):
         self.rootnode = RootNode(self.filename, None)
-        self.rootnode.children = self.parse_until(None)
-        self.rootnode.transform()
+        self.index = None
+        children = self.parse_until(None)
+        if type(children) is not NodeList:
+            # a document of one node (or none) is still a list of them
+            nodelist = NodeList()
+            nodelist.append(children)
+            children = nodelist
+        self.rootnode.children = children
+        if self.floats:
+            self.resolve_floats()
+        if not self.singlepass:
+            self.rootnode.transform()
         return self.rootnode
 
+    def iterparse(self, indocument=False):
+        """
+        Parse the document part by part.  Returns an iterator over the
+        top-level parts of the document, NodeLists that together are the
+        children `parse()` would give the root node: what precedes the first
+        sectioning command, then each sectioning command outside of all
+        groups and environments (except the document environment) with what
+        follows it.  A part is yielded as soon as it is complete and is not
+        kept; the root node, `self.rootnode`, gets the metadata but no
+        children.  With `indocument`, the tokens are taken to be inside the
+        document environment already.
+        """
+        self.rootnode = RootNode(self.filename, NodeList())
+        self.index = None
+        return self.iterparts(indocument)
+
+    def iterparts(self, indocument):
+        tokens = self.tokens
+        sectioning = set(self.sectioning_commands)
+        # (skip the next token, the boundary command found, in document)
+        state = [False, None, indocument]
+
+        def boundary(t, v, bracelevel):
+            if t != 'command' or bracelevel:
+                return False
+            if state[0]:
+                state[0] = False
+                return False
+            if v in sectioning:
+                state[1] = v
+                return True
+            # the document environment ends at any \end, as in parse()
+            if v == 'begin' and self.document_follows() or \
+                   v == 'end' and state[2]:
+                state[1] = v
+                return True
+            return False
+
+        part = NodeList()
+        found = None
+        while True:
+            state[1] = None
+            nodes = self.parse_until(boundary)
+            if type(nodes) is NodeList and found != 'begin':
+                # parse() appends these nodes one by one, and the content
+                # of the document environment as a whole
+                for node in nodes:
+                    part.append(node)
+            else:
+                part.append(nodes)
+            found = state[1]
+            if found is None:
+                break
+            if found in sectioning:
+                if part:
+                    yield self.part_closed(part)
+                    part = NodeList()
+                # parse the command as part of the next part
+                tokens.push(tokens.last)
+                state[0] = True
+            else:
+                self.parse_args('\\' + found, 'T')
+                state[2] = found == 'begin'
+        if part:
+            yield self.part_closed(part)
+
+    def document_follows(self):
+        """ Is the next argument ``{document}``? """
+        try:
+            tokens = self.tokens.peekmany(3)
+        except StopIteration:
+            return False
+        return [token[2] for token in tokens] == ['{', 'document', '}']
+
+    def part_closed(self, part):
+        """ Finish a part of the document that `iterparse()` yields. """
+        if self.floats:
+            self.index = NodeIndex(part)
+            self.resolve_floats()
+            self.index = None
+        if not self.singlepass:
+            RootNode(self.filename, part).transform()
+        return part
+
+    # the commands outline() looks at besides the sectioning commands
+    outline_metadata = ('title', 'author', 'authoraddress', 'date', 'release',
+                        'setshortversion', 'setreleaseinfo')
+    outline_refs = {'ref': 'T', 'refmodule': 'QT'}
+    outline_includes = {'input': 'T', 'include': 'T', 'verbatiminput': 'T'}
+    # environments whose bodies outline() skips
+    outline_skipped_envs = ('tabular', 'longtable', 'tableii', 'longtableii',
+                            'tableiii', 'longtableiii', 'tableiv',
+                            'longtableiv', 'tablev', 'longtablev',
+                            'description')
+    # raw environments whose first label outline() takes, as
+    # handle_displaymath_env does
+    outline_math_envs = ('displaymath', 'equation', 'eqnarray', 'math')
+    outline_math_label_re = re.compile(r"\\label\{(\S*)\}")
+
+    def outline(self):
+        """
+        Return the `Outline` of the document.  Only the arguments of the
+        sectioning, label, reference, include and metadata commands are
+        parsed; the parser skips from one of these commands (or a
+        ``\\begin``) to the next without building nodes for what is between.
+        """
+        outline = Outline(self.filename)
+        self.rootnode = RootNode(self.filename, None)
+        sectioning = set(self.sectioning_commands)
+        metadata = set(self.outline_metadata)
+        skipped = set(self.outline_skipped_envs)
+        refs = self.outline_refs
+        includes = self.outline_includes
+        names = sectioning | metadata | set(refs) | set(includes) | \
+                set(['label', 'begin'])
+        commands_re = command_pattern(names)
+        envs_re = command_pattern(['begin', 'end'])
+        tokens = self.tokens
+        while tokens.skip_to_command(commands_re):
+            l, t, v, r = tokens.pop()
+            if v in sectioning:
+                title, = self.parse_args('\\' + v, 'M')
+                label = None
+                # a label directly following belongs to the section
+                for l2, t2, v2, r2 in tokens:
+                    if t2 == 'command' and v2 == 'label':
+                        label = node_text(self.parse_args('\\label', 'T')[0])
+                        outline.labels.append((l2, label))
+                    elif t2 == 'text' and not v2.strip():
+                        continue
+                    else:
+                        tokens.push((l2, t2, v2, r2))
+                    break
+                outline.sections.append((l, v, node_text(title), label))
+            elif v == 'label':
+                outline.labels.append(
+                    (l, node_text(self.parse_args('\\label', 'T')[0])))
+            elif v in refs:
+                args = self.parse_args('\\' + v, refs[v])
+                outline.refs.append((l, v, node_text(args[-1])))
+            elif v in includes:
+                args = self.parse_args('\\' + v, includes[v])
+                outline.includes.append((l, v, node_text(args[-1])))
+            elif v in metadata:
+                self.handlers[v](self)
+            else:
+                envname = node_text(self.parse_args('\\begin', 'T')[0])
+                if envname in self.outline_math_envs and tokens:
+                    l2, t2, v2, r2 = tokens.peek()
+                    m = t2 == 'raw' and self.outline_math_label_re.search(v2)
+                    if m:
+                        outline.labels.append((l2, m.group(1)))
+                elif envname in skipped:
+                    depth = 1
+                    while depth and tokens.skip_to_command(envs_re):
+                        if tokens.pop()[2] == 'begin':
+                            depth += 1
+                        else:
+                            depth -= 1
+        for name, value in self.rootnode.params.iteritems():
+            outline.params[name] = node_text(value)
+        return outline
+
+    def environment_closed(self, node):
+        """ Finish the node of a generic environment whose content is parsed. """
+        if self.singlepass and isinstance(node, DescEnvironmentNode):
+            node.collect_lines()
+        return node
+
+    def node_index(self):
+        """ Return the `NodeIndex` of the parsed document. """
+        if self.index is None:
+            self.index = NodeIndex(self.rootnode)
+        return self.index
+
+    def resolve_floats(self):
+        """
+        Fill in the options of the tables and figures that are found in
+        their content, from the index of the document.
+        """
+        for content, opts in self.floats:
+            index = self.node_index()
+            if content not in index:
+                # hidden from walk(), e.g. inside a tabular
+                index = NodeIndex(content)
+            if 'label' in opts:
+                opts['label'] = find_label(content, index)
+            if 'caption_node' in opts:
+                opts['caption_node'] = find_caption_node(content, index)
+            if 'listing' in opts:
+                opts['listing'] = find_subnode(content, ListingNode, index)
+        self.floats = []
+
     def parse_until(self, condition=None, endatbrace=False):
+        """
+        Parse tokens until `condition` is true for one, or until the closing
+        brace of the current group if `endatbrace` is true.
+
+        The arguments and content of generic commands and environments (the
+        handlers with a ``generic`` attribute) are parsed here too, not by
+        calling the handler: their groups are kept on a stack, so that
+        deeply nested groups and environments need no recursion.  All other
+        handlers are called.  In recovery mode, an error in a command is
+        left behind with `recover()` and parsing goes on.
+        """
+        tokens = self.tokens
+        handlers = self.handlers
+        generics = self.generic_handlers
+        # the enclosing groups, with the command each one is an argument of
+        stack = []
         nodelist = NodeList()
         bracelevel = 0
         mathmode = False
-        math = ''
-        for l, t, v, r in self.tokens:
-            #sys.stderr.write("[%s][%s][%s][%s]\n" % ( l,t,v,r ))  ## line, type[command/text/egroup/...] ,  
-
-            if condition and condition(t, v, bracelevel):
-                return nodelist.flatten()
-            if mathmode:
-                if t == 'mathmode':
-                    nodelist.append(InlineNode('math', [TextNode(math)]))
-                    math = ''
-                    mathmode = False
+        math = []
+        t = v = None
+        while True:
+            try:
+                generic = None
+                for l, t, v, r in tokens:
+                    #sys.stderr.write("[%s][%s][%s][%s]\n" % ( l,t,v,r ))  ## line, type[command/text/egroup/...] ,  
+
+                    if condition and condition(t, v, bracelevel):
+                        break
+                    if mathmode:
+                        if t == 'mathmode':
+                            nodelist.append(InlineNode('math',
+                                                       [TextNode(''.join(math))]))
+                            math = []
+                            mathmode = False
+                        else:
+                            math.append(r)
+                    elif t == 'command':
+                        if len(v) == 1 and not v.isalpha():
+                            nodelist.append(self.handle_special_command(v))
+                            continue
+                        generic = generics.get(v)
+                        if generic is not None:
+                            break
+                        handler = handlers.get(v)
+                        if handler is None:
+                            nodelist.append(self.handle_unrecognized(v, l)())
+                            continue
+                        if getattr(handler, 'begins_environment', False):
+                            handler = self.begin_environment()
+                            generic = getattr(handler, 'generic', None)
+                            if generic is not None:
+                                break
+                        nodelist.append(handler(self))
+                    elif t == 'bgroup':
+                        bracelevel += 1
+                    elif t == 'egroup':
+                        if bracelevel == 0 and endatbrace:
+                            break
+                        bracelevel -= 1
+                    elif t == 'comment':
+                        nodelist.append(CommentNode(v))
+                    elif t == 'tilde':
+                        nodelist.append(NbspNode())
+                    elif t == 'ampersand':
+                        nodelist.append(AmpersandNode())
+                    elif t == 'mathmode':
+                        mathmode = True
+                    elif t == 'parasep':
+                        nodelist.append(ParaSepNode())
+                    else:
+                        # includes 'boptional' and 'eoptional' which don't have a
+                        # special meaning in text
+                        nodelist.append(TextNode(v))
+
+                if generic is not None:
+                    # a generic command or environment is opened
+                    cmdname, steps, nodetype, name, environment = generic
+                    args = []
                 else:
-                    math += r
-            elif t == 'command':
-                if len(v) == 1 and not v.isalpha():
-                    nodelist.append(self.handle_special_command(v))
-                    continue
-                handler = getattr(self, 'handle_' + v, None)
-                if not handler:
-                    handler = self.handle_unrecognized(v, l)
-                nodelist.append(handler())
-            elif t == 'bgroup':
-                bracelevel += 1
-            elif t == 'egroup':
-                if bracelevel == 0 and endatbrace:
-                    return nodelist.flatten()
-                bracelevel -= 1
-            elif t == 'comment':
-                nodelist.append(CommentNode(v))
-            elif t == 'tilde':
-                nodelist.append(NbspNode())
-            elif t == 'ampersand':
-                nodelist.append(AmpersandNode())
-            elif t == 'mathmode':
-                mathmode = True
-            elif t == 'parasep':
-                nodelist.append(ParaSepNode())
-            else:
-                # includes 'boptional' and 'eoptional' which don't have a
-                # special meaning in text
-                nodelist.append(TextNode(v))
-        return nodelist.flatten()
-
-
-
-
+                    # the group has ended
+                    group = nodelist.flatten()
+                    if not stack:
+                        return group
+                    if mathmode:
+                        mathmode = False
+                        math = []
+                    nodelist, bracelevel, condition, endatbrace, generic, args = \
+                              stack.pop()
+                    cmdname, steps, nodetype, name, environment = generic
+                    if len(args) == len(steps):
+                        # it was the content of an environment
+                        nodelist.append(self.environment_closed(
+                            nodetype(name, args, group)))
+                        continue
+                    if steps[len(args)][1] and not isinstance(group, TextNode):
+                        raise ParserError('%s: argument %d must be text only' %
+                                          (cmdname, len(args)),
+                                          *tokens.location(-1))
+                    args.append(group)
+
+                # parse the arguments up to the next one that is a group
+                while len(args) < len(steps):
+                    optional, textonly = steps[len(args)]
+                    nextl, nextt, nextv, nextr = next_argument_token(tokens)
+                    if optional:
+                        if nextt == 'boptional':
+                            group = optional_end, False
+                            break
+                        # not given
+                        tokens.push((nextl, nextt, nextv, nextr))
+                        args.append(EmptyNode())
+                    elif nextt == 'bgroup':
+                        group = None, True
+                        break
+                    elif nextt != 'text':
+                        raise ParserError('%s: non-grouped non-text arguments '
+                                          'not supported' % cmdname,
+                                          *tokens.location(-1))
+                    else:
+                        args.append(TextNode(nextv[0]))
+                        tokens.push((nextl, nextt, nextv[1:], nextr[1:]))
+                else:
+                    if not environment:
+                        nodelist.append(nodetype(name, args))
+                        continue
+                    group = self.environment_end, False
+                stack.append((nodelist, bracelevel, condition, endatbrace,
+                              generic, args))
+                nodelist = NodeList()
+                bracelevel = 0
+                condition, endatbrace = group
+            except Exception, err:
+                if self.diagnostics is None:
+                    raise
+                nodelist.append(self.recover(err, t == 'command' and v))
+
+    def diagnose(self, err, command=None):
+        """
+        Record a `Diagnostic` for the error `err` raised while parsing
+        `command`; returns the placeholder node for what was left out.
+        """
+        try:
+            lineno = self.tokens.location(-1)[0]
+        except Exception:
+            lineno = None
+        if command:
+            command = '\\' + command
+        diagnostic = Diagnostic.from_error(err, self.filename, lineno, command)
+        self.diagnostics.append(diagnostic)
+        return CommentNode('ERROR: %s' % diagnostic.message)
+
+    def recover(self, err, command=None):
+        """
+        Get over the error `err` raised while parsing `command`: record it
+        with `diagnose()` and skip the tokens up to the next paragraph
+        separator or the ``\\end`` of the current environment.
+        """
+        node = self.diagnose(err, command)
+        tokens = self.tokens
+        depth = 0
+        while tokens:
+            l, t, v, r = tokens.peek()
+            if t == 'parasep' and not depth:
+                break
+            if t == 'command' and v == 'begin':
+                depth += 1
+            elif t == 'command' and v == 'end':
+                if not depth:
+                    break
+                depth -= 1
+            tokens.next()
+        return node
 
     def parse_args_raw(self, cmdname ):
         """
@@ -196,13 +779,14 @@ class DocParser(object):
 
         """
         d = 0 
-        raw = ""
+        raw = []
         for l, t, v, r in self.tokens:
-             raw += r 
+             raw.append(r)
              if t == "bgroup":d += 1
              if t == "egroup":d -= 1
              #print d,l,t,v,r
              if d == 0:break     
+        raw = ''.join(raw)
         assert raw[0] == "{" and raw[-1] == "}" 
         return [raw[1:-1]]
 
@@ -210,42 +794,7 @@ class DocParser(object):
         """ Helper to parse arguments of a command. """
         # argspec: M = mandatory, T = mandatory, check text-only,
         #          O = optional, Q = optional, check text-only
-        args = []
-        def optional_end(type, value, bracelevel):
-            return type == 'eoptional' and bracelevel == 0
-
-        for i, c in enumerate(argspec):
-            assert c in 'OMTQ'
-            nextl, nextt, nextv, nextr = self.tokens.pop()
-            while nextt == 'comment' or (nextt == 'text' and nextv.isspace()):
-                nextl, nextt, nextv, nextr = self.tokens.pop()
-
-            if c in 'OQ':
-                if nextt == 'boptional':
-                    arg = self.parse_until(optional_end)
-                    if c == 'Q' and not isinstance(arg, TextNode):
-                        raise ParserError('%s: argument %d must be text only' %
-                                          (cmdname, i), nextl)
-                    args.append(arg)
-                else:
-                    # not given
-                    args.append(EmptyNode())
-                    self.tokens.push((nextl, nextt, nextv, nextr))
-                continue
-
-            if nextt == 'bgroup':
-                arg = self.parse_until(None, endatbrace=True)
-                if c == 'T' and not isinstance(arg, TextNode):
-                    raise ParserError('%s: argument %d must be text only' %
-                                      (cmdname, i), nextl)
-                args.append(arg)
-            else:
-                if nextt != 'text':
-                    raise ParserError('%s: non-grouped non-text arguments not '
-                                      'supported' % cmdname, nextl)
-                args.append(TextNode(nextv[0]))
-                self.tokens.push((nextl, nextt, nextv[1:], nextr[1:]))
-        return args
+        return argspec_parser(argspec)(self, cmdname)
 
     sectioning_commands = [
         'chapter',
@@ -521,9 +1070,12 @@ class DocParser(object):
         killers = ("em",)
         if name in killers:
             assert False , "killer command %s found at line %s " % ( name, line ) 
-        def handler():
-            self.unrecognized.add(name)
-            return EmptyNode()
+        handler = self.unrecognized_handlers.get(name)
+        if handler is None:
+            def handler():
+                self.unrecognized.add(name)
+                return EmptyNode()
+            self.unrecognized_handlers[name] = handler
         return handler
 
     def handle_special_command(self, cmdname):
@@ -536,7 +1088,8 @@ class DocParser(object):
             if nextt == 'bgroup':
                 _, nextt, _, _ = self.tokens.next()
                 if nextt != 'egroup':
-                    raise ParserError('wrong argtype for \\%s' % cmdname, nextl)
+                    raise ParserError('wrong argtype for \\%s' % cmdname,
+                                      *self.tokens.location(-1))
                 return TextNode(cmdname)
             if nextt != 'text':
                 # not nice, but {\~} = ~
@@ -548,7 +1101,7 @@ class DocParser(object):
         elif cmdname == '\\':
             return BreakNode()
         raise ParserError('no handler for \\%s command' % cmdname,
-                          self.tokens.peek()[0])
+                          *self.tokens.location())
 
 
 
@@ -557,14 +1110,26 @@ class DocParser(object):
         #print "handle_lstset %r " % args 
         return EmptyNode()
 
-    def handle_begin(self):
+    def begin_environment(self):
+        """ Parse the name after ``\\begin``; return the environment's handler. """
         envname, = self.parse_args('begin', 'T')
         self.envname = envname.text
-        handler = getattr(self, 'handle_%s_env' % envname.text, None)
-        if not handler:
-            raise ParserError('no handler for %s environment' % envname.text,
-                              self.tokens.peek()[0])
-        return handler()
+        handler = self.handlers.get(envname.text + '_env')
+        if handler is None:
+            err = ParserError('no handler for %s environment' % envname.text,
+                              *self.tokens.location())
+            if self.diagnostics is None:
+                raise err
+            def handler(self):
+                # parse the content to get past it, and to its problems
+                self.parse_until(self.environment_end)
+                return self.diagnose(err, 'begin')
+        return handler
+
+    def handle_begin(self):
+        return self.begin_environment()(self)
+    # lets parse_until open generic environments itself
+    handle_begin.begins_environment = True
 
     # ------------------------- command handlers -----------------------------
 
@@ -668,80 +1233,49 @@ class DocParser(object):
     handle_sideways_env = handle_document_env
 
 
-    def handle_verbatim_env(self):
+    def parse_raw_env(self, envname):
+        """
+        Return the source text of the body of an environment that is taken
+        literally, and the source text of its ``\\end``.  The tokenizer
+        gives the body as a single ``raw`` token; token streams without
+        one are read up to the ``\\end`` token by token.
+        """
+        tokens = self.tokens
+        if tokens and tokens.peek()[1] == 'raw':
+            body = tokens.next()[3]
+            # a raw region stops right at its \end{envname}
+            end = tokens and ''.join(tok[3] for tok in tokens.popmany(4))
+            return body, end or ''
         text = []
-        for l, t, v, r in self.tokens:
-            if t == 'command' and v == 'end' :
-                tok = self.tokens.peekmany(3)
-                if tok[0][1] == 'bgroup' and \
-                   tok[1][1] == 'text' and \
-                   tok[1][2] == 'verbatim' and \
-                   tok[2][1] == 'egroup':
-                    self.tokens.popmany(3)
-                    break
+        for l, t, v, r in tokens:
+            if t == 'command' and v == 'end' and \
+                   self.at_environment_end(envname):
+                return ''.join(text), r + ''.join(tok[3] for tok in
+                                                  tokens.popmany(3))
             text.append(r)
-        #print "handle_verbatim_env %s " % repr(text)
-        return VerbatimNode(TextNode(''.join(text)))
+        return ''.join(text), ''
+
+    def handle_verbatim_env(self):
+        text, end = self.parse_raw_env('verbatim')
+        return VerbatimNode(TextNode(text))
 
     def handle_rstverbatim_env(self):
-        text = []
-        for l, t, v, r in self.tokens:
-            if t == 'command' and v == 'end' :
-                tok = self.tokens.peekmany(3)
-                if tok[0][1] == 'bgroup' and \
-                   tok[1][1] == 'text' and \
-                   tok[1][2] == 'rstverbatim' and \
-                   tok[2][1] == 'egroup':
-                    self.tokens.popmany(3)
-                    break
-            text.append(r)
-        #print "handle_verbatim_env %s " % repr(text)
-        return RstVerbatimNode(TextNode(''.join(text)))
+        text, end = self.parse_raw_env('rstverbatim')
+        return RstVerbatimNode(TextNode(text))
    
     def handle_lstlisting_env(self):
-        text = []
         args = self.parse_args('\\lstlisting', 'O')
         #print "args", args   
-
-        for l, t, v, r in self.tokens:
-            #print l,t,v,r
-            if t == 'command' and v == 'end' :
-                tok = self.tokens.peekmany(3)
-                if tok[0][1] == 'bgroup' and \
-                   tok[1][1] == 'text' and \
-                   tok[1][2] == 'lstlisting' and \
-                   tok[2][1] == 'egroup':
-                    self.tokens.popmany(3)
-                    break
-            text.append(r)
-
-        lstn = ListingNode(TextNode(''.join(text)), args )
+        text, end = self.parse_raw_env('lstlisting')
+        lstn = ListingNode(TextNode(text), args )
         #print "lstn %s " % repr(lstn)
         return lstn
 
     # involved math markup must be corrected manually
     def handle_displaymath_env(self):
         envname = self.envname
-        raw = "\\begin{%s}" % envname
-        for l, t, v, r in self.tokens:
-            #print l,t,v,r
-            raw += r
-            if t == 'command' and v == 'end' :
-                 tok = self.tokens.popmany(3)
-                 if tok[0][1] == 'bgroup' and \
-                    tok[1][1] == 'text' and \
-                    tok[2][1] == 'egroup':
-                    endenv = tok[1][2]
-                 else:
-                    endenv = None
-                 for _ in tok[2],tok[1],tok[0]:  ## huh need reverse order ... to avoid \end}array{ 
-                    self.tokens.push(_)                   
-            
-                 if endenv == envname:
-                     tok = self.tokens.popmany(3)
-                     for _ in tok:
-                         raw += _[3]
-                     break 
+        body, end = self.parse_raw_env(envname)
+        raw = "\\begin{%s}" % envname + body + end
 
         label_ptn = re.compile(r"\\label\{(\S*)\}") 
         label_m = label_ptn.search(raw)
@@ -767,10 +1301,11 @@ class DocParser(object):
                 if len(v) == 1 and not v.isalpha():
                     nodelist.append(self.handle_special_command(v))
                     continue
-                handler = getattr(self, 'handle_' + v, None)
-                if not handler:
-                    raise ParserError('no handler for \\%s command' % v, l)
-                nodelist.append(handler())
+                handler = self.handlers.get(v)
+                if handler is None:
+                    raise ParserError('no handler for \\%s command' % v,
+                                      *self.tokens.location(-1))
+                nodelist.append(handler(self))
             elif t == 'comment':
                 nodelist.append(CommentNode(v))
             else:
@@ -867,46 +1402,52 @@ class DocParser(object):
         colspec = colspec.replace('|','')
         numcols = len(colspec)
         #print "handle_tabular_env numcols %s orig_colspec %s colspec %s " % ( numcols , orig_colspec, colspec  )
- 
-        all = []
-        running = [False]
 
-        def endrow_condition(t, v, bracelevel):
-            #print "endrow t[%s] v[%s] b[%s] " % ( t, v, bracelevel )
+        # (what ended the cell: '&', '\\' or None for the environment end,
+        #  in math mode)
+        state = [None, False]
+
+        def endcell_condition(t, v, bracelevel):
             if self.environment_end(t, v):
-                del running[:]
+                state[0] = None
                 return True
             if t == 'command' and v == "\\":
+                state[0] = v
+                return True
+            if t == 'mathmode':
+                state[1] = not state[1]
+            elif t == 'ampersand' and not state[1]:
+                state[0] = '&'
                 return True
             return False
 
-        while running:
-            row = NodeList() 
-            row.append( self.parse_until(endrow_condition) )
-            row.append( AmpersandNode())
-
-            #print "row %r " % row 
-
-            cols = []
-            elem = NodeList()            
-            for c in row:
-                if isinstance(c, AmpersandNode):
-                    cols.append(elem)
-                    elem = NodeList()
-                else:
-                    elem.append(c)
-
-            #print "cols %r " % cols 
-            if len(cols) == numcols: 
-                all.append( cols )
-            else:
-                pass
-                #print "tail skip ", ( repr(cols) , numcols, len(cols) )
+        # the cells are parsed one by one and a row is kept as a tuple of
+        # them, a text-only cell as its text
+        rows = []
+        while True:
+            cells = []
+            while True:
+                state[1] = False
+                cell = self.parse_until(endcell_condition)
+                if type(cell) is TextNode:
+                    cell = cell.text
+                elif type(cell) is EmptyNode:
+                    cell = ''
+                cells.append(cell)
+                if state[0] != '&':
+                    break
+            if len(cells) == numcols:
+                rows.append(tuple(cells))
+            elif len(cells) > 1 or not blank_cell(cells[0]):
+                self.warnings.append(
+                    '%s: dropped a row of %d columns instead of %d, line %s' %
+                    (envname, len(cells), numcols, self.tokens.location(-1)[0]))
+            if state[0] is None:
+                break
 
-        if len(all) > 0:
-            headings = all[0]
-            lines = all[1:]
-            return TabularNode(numcols, headings, lines , colspec=orig_colspec)
+        if len(rows) > 0:
+            return TabularNode(numcols, rows[0], rows[1:],
+                               colspec=orig_colspec)
         else:
             assert False, "handle_tabular_env failed to parse any table rows matching the column spec %s %s CHECK TABULAR COLS MATCH THE SPEC " % ( colspec, numcols )
             print "WARNING returning EMPTY"
@@ -918,8 +1459,10 @@ class DocParser(object):
         args = self.parse_args('table', 'Q' )
         content = self.parse_until(self.environment_end)
         opts = {}
-        opts['label'] = find_label( content )
-        opts['caption_node'] = find_caption_node( content )
+        # filled in by resolve_floats()
+        opts['label'] = None
+        opts['caption_node'] = None
+        self.floats.append((content, opts))
         tn = TableNode("table", [], content, opts=opts )
         #print "handle_table_env %r " % ( tn ) 
         return tn
@@ -929,8 +1472,11 @@ class DocParser(object):
         args = self.parse_args('figure', 'Q')
         content = self.parse_until(self.environment_end)
         opts = {}
-        opts['label'] = find_label( content )
-        opts['listing'] = find_subnode( content, type=ListingNode )  ## a dummy figure as vehicle for a code listing
+        # filled in by resolve_floats(); the listing is for a dummy figure
+        # as vehicle for a code listing
+        opts['label'] = None
+        opts['listing'] = None
+        self.floats.append((content, opts))
         for n in content:
             if isinstance(n, CommandNode) and n.cmdname == 'centering':
                 opts['align'] = "center"
@@ -959,6 +1505,12 @@ class DocParser(object):
         node.arg = env_args[0]
         return node
 
+    def at_environment_end(self, envname):
+        """ Check if the tokens following an ``\\end`` are ``{envname}``. """
+        peek = self.tokens.peek
+        return peek(0)[1] == 'bgroup' and peek(1)[1] == 'text' and \
+               peek(1)[2] == envname and peek(2)[1] == 'egroup'
+
     def environment_end(self, t, v, bracelevel=0):
         if t == 'command' and v == 'end':
             self.parse_args('\\end', 'T')
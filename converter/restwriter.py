@@ -13,11 +13,11 @@
     There are some intricacies while writing ReST:
 
     - Paragraph text must be rewrapped in order to avoid ragged lines. The
-      `textwrap` module does that nicely, but it must obviously operate on a
-      whole paragraph at a time. Therefore the contents of the current paragraph
-      are cached in `self.curpar`. Every time a block level element is
-      encountered, its node handler calls `self.flush_par()` which writes out a
-      paragraph. Because this can be detrimental for the markup at several
+      `wrap_text()` function does that, never breaking inside markup, but it
+      must obviously operate on a whole paragraph at a time. Therefore the
+      contents of the current paragraph are cached in `self.curpar`. Every
+      time a block level element is encountered, its node handler calls
+      `self.flush_par()` which writes out a paragraph. Because this can be detrimental for the markup at several
       stages, the `self.noflush` context manager can be used to forbid paragraph
       flushing temporarily, which means that no block level nodes can be
       processed.
@@ -63,26 +63,15 @@ from __future__ import with_statement
 import os
 import re
 import StringIO
-import textwrap
+from itertools import chain
 
 WIDTH = 80
 INDENT = 3
 
-new_wordsep_re = re.compile(
-        r'(\s+|'                                  # any whitespace
-        r'(?<=\s)(?::[a-z-]+:)?`\S+|'             # interpreted text start
-        r'[^\s\w]*\w+[a-zA-Z]-(?=\w+[a-zA-Z])|'   # hyphenated words
-        r'(?<=[\w\!\"\'\&\.\,\?])-{2,}(?=\w))')   # em-dash
-
-import textwrap
-# monkey-patch...
-textwrap.TextWrapper.wordsep_re = new_wordsep_re
-wrapper = textwrap.TextWrapper(width=WIDTH, break_long_words=False)
-
 from .docnodes import RootNode, TextNode, NodeList, InlineNode, \
-     CommentNode, EmptyNode, GraphicsNode, ListingNode
+     CommentNode, EmptyNode, GraphicsNode, ListingNode, NbspNode, SimpleCmdNode
 from .util import fixup_text, empty, text, my_make_id, \
-     repair_bad_inline_markup
+     repair_bad_inline_markup, dedent_lines, wrap_text, Diagnostic
 from .filenamemap import includes_mapping
 
 class WriterError(Exception):
@@ -126,6 +115,84 @@ class NoFlush(object):
         self.writer.no_flushing -= 1
 
 
+class OutputBuffer(object):
+    """
+    A file for the writer to write to that collects the strings written and
+    encodes and writes them to the byte stream `fp` at once: when more than
+    `threshold` characters are waiting (never if it is None), on `flush()`
+    and on `close()`.  Closing it again does nothing, as for a file.
+    """
+    def __init__(self, fp, encoding='utf-8', threshold=1<<20):
+        self.fp = fp
+        self.encoding = encoding
+        self.threshold = threshold
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.threshold is not None and self.size > self.threshold:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            data = u''.join(self.parts).encode(self.encoding)
+            self.parts = []
+            self.size = 0
+            self.fp.write(data)
+        self.fp.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.fp.close()
+
+
+# the nodes whose rendering depends on nothing but what they contain
+text_node_types = (TextNode, SimpleCmdNode, NbspNode, EmptyNode)
+
+def subtree_key(node, limit=64):
+    """
+    Return a tuple that is equal for subtrees that render the same, or
+    None if the subtree is larger than `limit` nodes or has nodes that
+    may do more than add to the paragraph.
+    """
+    budget = [limit]
+    def key(node):
+        cls = type(node)
+        if cls is NodeList:
+            children = node
+            parts = [cls]
+        elif cls is InlineNode:
+            children = node.args
+            parts = [cls, node.cmdname]
+        else:
+            return None
+        budget[0] -= len(children) + 1
+        if budget[0] < 0:
+            return None
+        for child in children:
+            childcls = type(child)
+            if childcls in text_node_types:
+                parts.append((childcls, child.text))
+                continue
+            childkey = key(child)
+            if childkey is None:
+                return None
+            parts.append(childkey)
+        return tuple(parts)
+    cls = type(node)
+    if cls in text_node_types:
+        return (cls, node.text)
+    return key(node)
+
+
 class SectionMeta(object):
     def __init__(self):
         self.modname = ''
@@ -138,7 +205,8 @@ class SectionMeta(object):
 class RestWriter(object):
     """ Write ReST from a node tree. """
 
-    def __init__(self, fp, splitchap=False, toctree=None, deflang=None, labelprefix=''):
+    def __init__(self, fp, splitchap=False, toctree=None, deflang=None, labelprefix='',
+                 diagnostics=None):
         self.splitchap = splitchap      # split output at chapters?
         if splitchap:
             self.fp = StringIO.StringIO() # dummy one
@@ -167,6 +235,8 @@ class RestWriter(object):
         self.indexentries = []          # indexentries to be output before flushing
         self.footnotes = []             # footnotes to be output at document end
         self.warnings = []              # warnings while writing
+        self.diagnostics = diagnostics  # errors got over, None: don't recover
+        self.filename = None            # of the document, for diagnostics
 
         # specials
         self.sectionlabel = ''          # most recent \label command
@@ -176,11 +246,16 @@ class RestWriter(object):
         self.indexsubitem = ''          # current \withsubitem text
 
         self.floatnode = None           # allow different behavior inside floats : figure/table envs
+        # the rendering of inline subtrees seen before, None: don't keep it
+        self.rendered = {}
+        self.render_hits = self.render_misses = 0
+        self.rendering = False
         self.floatlabel = None          # allow control of float label positioning no matter where in tex 
  
     def write_document(self, rootnode):
         """ Write a document, represented by a RootNode. """
         assert type(rootnode) is RootNode
+        self.filename = rootnode.filename
 
         if self.deflang:
             self.write_directive('highlightlang', self.deflang)
@@ -188,6 +263,58 @@ class RestWriter(object):
         self.visit_node(rootnode)
         self.write_footnotes()
 
+    # what the writer carries from one section to the next, besides the
+    # footnotes; see get_state()
+    state_attributes = ('sectionlabel', 'thisclass', 'sectionmeta',
+                        'indexsubitem', 'floatnode', 'floatlabel', 'listing',
+                        'indentation', 'indentfirstline', 'noescape',
+                        'curpar', 'comments', 'indexentries')
+
+    def get_state(self):
+        """
+        Return the state of the writer as a tuple of the values of the
+        `state_attributes`, or None while a flush callback is pending.
+        """
+        if self.flush_cb is not None:
+            return None
+        return tuple([getattr(self, name, None)
+                      for name in self.state_attributes])
+
+    def set_state(self, state):
+        """ Restore a state that `get_state()` returned. """
+        for name, value in zip(self.state_attributes, state):
+            setattr(self, name, value)
+
+    def write_stream(self, rootnode, parts):
+        """
+        Write a document like `write_document`, from its RootNode without
+        children and an iterable of its top-level parts, such as
+        `DocParser.iterparse()` returns.  Each part is written and dropped
+        before the next one is asked for; only the state the writer carries
+        between sections (footnotes, current class, section metadata) is
+        kept.  The title block is written from the metadata known when the
+        first part is there; returns False if metadata for it came later
+        and is missing from the output, True otherwise.
+        """
+        assert type(rootnode) is RootNode
+        self.filename = rootnode.filename
+
+        if self.deflang:
+            self.write_directive('highlightlang', self.deflang)
+
+        params = rootnode.params
+        header = None
+        for part in parts:
+            if header is None:
+                header = [params.get(name) for name in self.header_params]
+                self.write_header(params)
+            self.visit_node(part)
+        if header is None:
+            header = [params.get(name) for name in self.header_params]
+            self.write_header(params)
+        self.write_footnotes()
+        return header == [params.get(name) for name in self.header_params]
+
     def new_chapter(self):
         """ Called if self.splitchap is True. Create a new file pointer
             and set self.fp to it. """
@@ -196,14 +323,18 @@ class RestWriter(object):
         self.fp = new_fp
 
     def write(self, text='', nl=True, first=False):
-        """ Write a string to the output file. """
+        """ Write a string to the output file, with one write() call. """
         if first:
-            self.fp.write((self.indentation if self.indentfirstline else '') + text)
+            line = (self.indentation if self.indentfirstline else '') + text
             self.indentfirstline = True
         elif text: # don't write indentation only
-            self.fp.write(self.indentation + text)
+            line = self.indentation + text
+        else:
+            line = ''
         if nl:
-            self.fp.write('\n')
+            line += '\n'
+        if line:
+            self.fp.write(line)
 
     def write_footnotes(self):
         """ Write the current footnotes, if any. """
@@ -250,6 +381,35 @@ class RestWriter(object):
         self.write()
         self.write()
 
+    # the metadata the title block is written from
+    header_params = ('title', 'author', 'authoremail', 'date', 'release')
+
+    def write_header(self, params):
+        """ Write the title block for the document metadata `params`. """
+        if params.get('title'):
+            title = self.get_node_text(params['title'])
+            hl = len(title)
+            self.write('*' * (hl+4))
+            self.write('  %s  ' % title)
+            self.write('*' * (hl+4))
+            self.write()
+
+            if params.get('author'):
+                self.write(':Author: %s%s' %
+                           (self.get_node_text(params['author']),
+                            (' <%s>' % self.get_node_text(params['authoremail'])
+                             if 'authoremail' in params else '')))
+                self.write()
+
+            if params.get('date'):
+                self.write(':Date: %s' % self.get_node_text(params['date']))
+                self.write()
+
+            if params.get('release'):
+                self.write('.. |release| replace:: %s' %
+                           self.get_node_text(params['release']))
+                self.write()
+
     indexentry_mapping = {
         'index': 'single',
         'indexii': 'pair',
@@ -308,8 +468,7 @@ class RestWriter(object):
         self.curpar = []
         if wrap:
             # returns a list!
-            wrapper.width = width or WIDTH
-            return wrapper.wrap(text)
+            return wrap_text(text, width or WIDTH)
         else:
             return text
 
@@ -355,9 +514,52 @@ class RestWriter(object):
             raise WriterError('get_textonly_node() failed for %r' % subnode)
         return do(node)
 
+    def render_cached(self, node, render, *extra):
+        """
+        Call `render`, which adds the rendering of `node` to the paragraph
+        and returns a value, or add and return what it did for an equal
+        subtree before; `extra` are the arguments the rendering depends on.
+        Warnings are repeated; a rendering that left footnotes, comments or
+        index entries behind is not kept.
+        """
+        # the subtrees of one being rendered are part of its entry already
+        if self.rendered is None or self.rendering:
+            return render()
+        key = subtree_key(node)
+        if key is None:
+            return render()
+        key = (key, self.noescape, self.labelprefix) + extra
+        entry = self.rendered.get(key)
+        if entry is not None:
+            self.render_hits += 1
+            pieces, warnings, ret = entry
+            self.curpar.extend(pieces)
+            self.warnings.extend(warnings)
+            if type(ret) is list:
+                ret = list(ret)
+            return ret
+        self.render_misses += 1
+        curpar = self.curpar
+        before = (len(curpar), len(self.warnings), len(self.footnotes),
+                  len(self.comments), len(self.indexentries))
+        self.rendering = True
+        try:
+            ret = render()
+        finally:
+            self.rendering = False
+        if self.curpar is curpar and before[2:] == (
+                len(self.footnotes), len(self.comments), len(self.indexentries)):
+            self.rendered[key] = (curpar[before[0]:], self.warnings[before[1]:],
+                                  list(ret) if type(ret) is list else ret)
+        return ret
+
     def get_node_text(self, node, wrap=False, width=None):
         """ Write the node to a temporary paragraph and return the result
             as a string. """
+        return self.render_cached(
+            node, lambda: self.render_node_text(node, wrap, width), wrap, width)
+
+    def render_node_text(self, node, wrap, width):
         with self.noflush:
             self._old_curpar = self.curpar
             self.curpar = []
@@ -403,38 +605,47 @@ class RestWriter(object):
 
     def visit_node(self, node):
         """ "Write" a node (appends to curpar or writes something). """
+        if self.diagnostics is not None:
+            return self.visit_recovering(node)
         visitfunc = getattr(self, 'visit_' + node.__class__.__name__, None)
         if not visitfunc:
             raise WriterError('no visit function for %s node' % node.__class__)
         visitfunc(node)
 
+    def visit_recovering(self, node):
+        """
+        Visit a node in recovery mode: if that fails, the paragraph and
+        indentation are put back as they were, a `Diagnostic` is recorded
+        and a comment stands in for the node.
+        """
+        curpar = self.curpar
+        saved = (len(curpar), self.indentation, self.indentfirstline,
+                 self.no_flushing, self.noescape)
+        try:
+            visitfunc = getattr(self, 'visit_' + node.__class__.__name__, None)
+            if not visitfunc:
+                raise WriterError('no visit function for %s node' %
+                                  node.__class__)
+            visitfunc(node)
+        except Exception, err:
+            self.curpar = curpar
+            del curpar[saved[0]:]
+            (self.indentation, self.indentfirstline, self.no_flushing,
+             self.noescape) = saved[1:]
+            if getattr(node, 'cmdname', None):
+                command = '\\' + node.cmdname
+            else:
+                command = getattr(node, 'envname', None) or \
+                          node.__class__.__name__
+            diagnostic = Diagnostic.from_error(err, self.filename, None,
+                                               command)
+            self.diagnostics.append(diagnostic)
+            self.comments.append('ERROR: %s' % diagnostic.message)
+
     # ------------------------- node handlers -----------------------------
 
     def visit_RootNode(self, node):
-        if node.params.get('title'):
-            title = self.get_node_text(node.params['title'])
-            hl = len(title)
-            self.write('*' * (hl+4))
-            self.write('  %s  ' % title)
-            self.write('*' * (hl+4))
-            self.write()
-
-            if node.params.get('author'):
-                self.write(':Author: %s%s' %
-                           (self.get_node_text(node.params['author']),
-                            (' <%s>' % self.get_node_text(node.params['authoremail'])
-                             if 'authoremail' in node.params else '')))
-                self.write()
-
-            if node.params.get('date'):
-                self.write(':Date: %s' % self.get_node_text(node.params['date']))
-                self.write()
-
-            if node.params.get('release'):
-                self.write('.. |release| replace:: %s' %
-                           self.get_node_text(node.params['release']))
-                self.write()
-
+        self.write_header(node.params)
         self.visit_NodeList(node.children)
 
     def visit_NodeList(self, nodelist):
@@ -877,34 +1088,32 @@ class RestWriter(object):
         with self.indented():
             if isinstance(node.content, TextNode):
                 # verbatim
-                lines = textwrap.dedent(text(node.content).lstrip('\n')).split('\n')
-                if not lines:
-                    return
+                lines = dedent_lines(text(node.content).lstrip('\n'))
             else:
                 # alltt, possibly with inline formats
                 lines = self.get_node_text(self.get_textonly_node(
                     node.content, warn=0)).split('\n') + ['']
             # discard leading blank links
-            while not lines[0].strip():
-                del lines[0]
-            for line in lines:
-                self.write(line)
+            first = 0
+            while first < len(lines) and not lines[first].strip():
+                first += 1
+            for i in xrange(first, len(lines)):
+                self.write(lines[i])
 
     def visit_RstVerbatimNode(self, node):
         if isinstance(node.content, TextNode):
             # verbatim
-            lines = textwrap.dedent(text(node.content).lstrip('\n')).split('\n')
-            if not lines:
-                return
+            lines = dedent_lines(text(node.content).lstrip('\n'))
         else:
             # alltt, possibly with inline formats
             lines = self.get_node_text(self.get_textonly_node(
                     node.content, warn=0)).split('\n') + ['']
         # discard leading blank links
-        while not lines[0].strip():
-            del lines[0]
-        for line in lines:
-            self.write(line)
+        first = 0
+        while first < len(lines) and not lines[first].strip():
+            first += 1
+        for i in xrange(first, len(lines)):
+            self.write(lines[i])
 
 
     note_re = re.compile('^\(\d\)$')
@@ -912,18 +1121,19 @@ class RestWriter(object):
 
     def visit_TabularNode(self, node):
         self.flush_par()
-        lines = node.lines[:]
-        lines.insert(0, node.headings)
         fmted_rows = []
         width = WIDTH - len(self.indentation)
         realwidths = [0] * node.numcols
         colwidth = (width / node.numcols) + 5
         # don't allow paragraphs in table cells for now
         with self.noflush:
-            for line in lines:
+            for line in chain([node.headings], node.lines):
                 cells = []
                 for i, cell in enumerate(line):
                     #print "cell %r " % cell
+                    if isinstance(cell, basestring):
+                        # a text-only cell
+                        cell = TextNode(cell)
                     par = self.get_node_text(cell, wrap=True, width=colwidth)
                     if len(par) == 1 and self.note_re.match(par[0].strip()):
                         # special case: escape "(1)" to avoid enumeration
@@ -1084,6 +1294,9 @@ class RestWriter(object):
     ))
 
     def visit_InlineNode(self, node):
+        self.render_cached(node, lambda: self.render_InlineNode(node))
+
+    def render_InlineNode(self, node):
         # XXX: no nested markup -- docutils doesn't support it
         cmdname = node.cmdname
         if not node.args:
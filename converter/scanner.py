@@ -9,6 +9,27 @@
     :license: BSD license.
 """
 import re
+from bisect import bisect_right
+
+
+def line_index(text):
+    """
+    Return a list of the offsets at which the lines of `text` start,
+    built in one pass over the text.  (A list, not an array: `bisect` is
+    much faster on it.)
+    """
+    starts = [0]
+    starts.extend(m.end() for m in re.finditer('\n', text))
+    return starts
+
+
+def offset_position(starts, offset):
+    """
+    Return the 1-based ``(line, column)`` of `offset`, given the line
+    start offsets returned by `line_index()`.
+    """
+    line = bisect_right(starts, offset)
+    return line, offset - starts[line-1] + 1
 
 
 class EndOfText(RuntimeError):
@@ -39,6 +60,23 @@ class Scanner(object):
         self.last = None
         self.match = None
         self._re_cache = {}
+        self._line_starts = None
+
+    def line_starts(self):
+        """The offsets of all line starts, built on first use."""
+        if self._line_starts is None:
+            self._line_starts = line_index(self.data)
+        return self._line_starts
+    line_starts = property(line_starts, line_starts.__doc__)
+
+    def position(self, offset=None):
+        """
+        Return the ``(line, column)`` of `offset`, by default of the
+        current position.
+        """
+        if offset is None:
+            offset = self.pos
+        return offset_position(self.line_starts, offset)
 
     def eos(self):
         """`True` if the scanner reached the end of text."""
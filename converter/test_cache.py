@@ -0,0 +1,61 @@
+from converter.testutil import parse, write
+
+
+def test_parse_cache():
+    import os, shutil, tempfile
+    from converter.cache import ParseCache
+    text = ("\\section{Intro}\\label{intro}\n\nSome \\emph{text} and "
+            "\\issue{12} \\unknowncmd{x}.\n\n\\begin{figure}x"
+            "\\caption{A}\\label{f}\\end{figure}\n")
+    extlinks = {'issue': ('http://x/%s', '')}
+    dirname = tempfile.mkdtemp()
+    try:
+        cache = ParseCache(dirname)
+        parsed = cache.parser(text, 'x.tex', extlinks)
+        expected = parse(text, extlinks=extlinks).rootnode
+        assert repr(parsed.rootnode) == repr(expected)
+        loaded = cache.parser(text, 'y.tex', extlinks)
+        assert loaded.tokens is None
+        assert loaded.rootnode.filename == 'y.tex'
+        assert write(loaded.rootnode) == write(expected)
+        assert loaded.unrecognized == set(['unknowncmd'])
+        assert len(cache.entries()) == 1
+        # other extlinks or content give other entries
+        cache.parser(text, 'x.tex')
+        cache.parser(text + 'More.\n', 'x.tex', extlinks)
+        assert len(cache.entries()) == 3
+        # the least recently used entries go first
+        first = cache.filename(cache.key(text, extlinks))
+        os.utime(first, (0, 0))
+        assert cache.prune(sum(e[1] for e in cache.entries()) - 1) == 1
+        assert not os.path.exists(first)
+        open(cache.filename(cache.key(text)), 'wb').write('damaged')
+        assert cache.parser(text, 'x.tex').tokens is not None
+        assert cache.clear() == 2
+    finally:
+        shutil.rmtree(dirname)
+
+def test_cache_command():
+    import os, shutil, tempfile
+    from converter.cache import DiskCache, ParseCache, main
+    from converter.incremental import SectionCache
+    dirname = tempfile.mkdtemp()
+    try:
+        ParseCache(dirname).put('a', 1)
+        SectionCache(dirname).put('b', 2)
+        DiskCache(dirname).put('c', 3)
+        for fn in ('notes.tex', 'notes.rst', 'notes'):
+            open(os.path.join(dirname, fn), 'w').write('keep')
+        assert main(['cache', dirname, 'prune', '0']) == 0
+        assert sorted(os.listdir(dirname)) == \
+               ['c.cache', 'notes', 'notes.rst', 'notes.tex']
+        assert main(['cache', dirname, 'clear']) == 0
+        assert len(os.listdir(dirname)) == 4
+        try:
+            DiskCache(dirname, suffixes=('.ast', ''))
+        except ValueError:
+            pass
+        else:
+            assert False, 'empty suffix accepted'
+    finally:
+        shutil.rmtree(dirname)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+
+import converter
+from converter import convert_file
+
+
+def test_convert_file_closes_map():
+    maps = []
+    def map_file(infile):
+        maps.append(real_map_file(infile))
+        return maps[-1]
+    real_map_file, converter.map_file = converter.map_file, map_file
+    dirname = tempfile.mkdtemp()
+    try:
+        good = os.path.join(dirname, 'good.tex')
+        open(good, 'w').write('\\section{A}\nText.\n\n\\section{B}\nMore.\n')
+        bad = os.path.join(dirname, 'bad.tex')
+        open(bad, 'w').write('Text \\begin{nosuchenv}x\\end{nosuchenv}\n')
+        out = os.path.join(dirname, 'out.rst')
+        assert convert_file(good, out, usemmap=True) == (1, [])
+        assert convert_file(good, out, usemmap=True, stream=True) == (1, [])
+        assert convert_file(bad, out, False, usemmap=True)[0] == 0
+        assert len(maps) == 3
+        for map in maps:
+            try:
+                map[0]
+            except ValueError:
+                pass
+            else:
+                assert False, 'map left open'
+    finally:
+        converter.map_file = real_map_file
+        shutil.rmtree(dirname)
+
+def test_convert_file_stream_metadata():
+    dirname = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(dirname, 'doc.tex')
+        out = os.path.join(dirname, 'out.rst')
+        open(infile, 'w').write('\\section{A}\nText.\n\\section{B}\n'
+                                '\\title{Late}\nMore.\n')
+        assert convert_file(infile, out) == (1, [])
+        expected = open(out).read()
+        assert 'Late' in expected
+        success, warnings = convert_file(infile, out, stream=True)
+        assert success and open(out).read() == expected
+        assert warnings == ['document metadata after the first section, '
+                            'converted without streaming']
+        # the diagnostics of the first attempt are not kept
+        open(infile, 'a').write('\\begin{nosuchenv}x\\end{nosuchenv}\n')
+        diagnostics = []
+        assert convert_file(infile, out, stream=True,
+                            diagnostics=diagnostics)[0] == 1
+        assert len(diagnostics) == 1
+        # metadata in the first part is known when the title block is written
+        open(infile, 'w').write('\\section{A}\n\\title{Early}\n'
+                                '\\section{B}\nText.\n')
+        assert convert_file(infile, out, stream=True) == (1, [])
+    finally:
+        shutil.rmtree(dirname)
+
+def test_convert_file_error_keeps_output():
+    dirname = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(dirname, 'doc.tex')
+        out = os.path.join(dirname, 'out.rst')
+        open(infile, 'w').write('\\section{A}\nText.\n\n\\section{B}\n'
+                                '\\begin{nosuchenv}x\\end{nosuchenv}\n')
+        success, error = convert_file(infile, out, False, stream=True)
+        assert not success and 'nosuchenv' in error
+        assert 'Text.' in open(out).read()
+    finally:
+        shutil.rmtree(dirname)
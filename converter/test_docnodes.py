@@ -0,0 +1,26 @@
+from converter.testutil import parse
+
+
+def test_compact_nodes():
+    import pickle
+    from converter.docnodes import TextNode, EmptyNode, ParaSepNode, \
+         NodeList
+    tree = parse("Some \\emph{text}~here.\n\nA\\\\B & "
+                 "\\code{x} {and} {more}.\n").rootnode
+    classes = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        stack.extend(node.walk())
+        classes.add(type(node))
+        assert not hasattr(node, '__dict__'), node
+    assert ParaSepNode in classes
+    assert EmptyNode() is EmptyNode() and ParaSepNode() is ParaSepNode()
+    assert isinstance(EmptyNode(), TextNode) and EmptyNode().text == ''
+    nodes = NodeList([TextNode('a')])
+    for s in ('b', u'c', EmptyNode().text, 'd'):
+        nodes.append(TextNode(s))
+    assert len(nodes) == 1 and nodes[0].text == u'abcd'
+    copy = pickle.loads(pickle.dumps(tree, 2))
+    assert repr(copy) == repr(tree)
+    assert pickle.loads(pickle.dumps(ParaSepNode(), 2)) is ParaSepNode()
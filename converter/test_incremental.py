@@ -0,0 +1,70 @@
+from converter.tokenizer import Tokenizer
+
+
+def test_incremental():
+    import shutil, tempfile
+    from converter.incremental import SectionCache, section_spans, \
+         write_sections, convert_text
+    sections = ["\\section{One}\\label{one}\nText\\footnote{A note.} "
+                "{\\section{Grouped}}.\n",
+                "\\section{Two}\n\\begin{classdesc}{C}{}Doc.\\end{classdesc}"
+                "\n\\begin{methoddesc}{m}{}M.\\end{methoddesc}\n",
+                "\\subsection{Three}\n\\begin{quote}\\section{Quoted}"
+                "\\end{quote}\nMath $\\mathrm{x}$\\footnote{Another.}.\n"]
+    def document(sections):
+        return ("\\title{Doc}\\release{1.0}\n\\begin{document}\nIntro.\n" +
+                ''.join(sections) + "\\end{document}\n")
+    text = document(sections)
+    spans = section_spans(Tokenizer(text).tokenize()._tokens)
+    assert [text[start:stop] for start, stop, indocument in spans][1:] == \
+           sections[:2] + [sections[2] + "\\end{document}\n"]
+    assert [indocument for start, stop, indocument in spans] == \
+           [False, True, True, True]
+    dirname = tempfile.mkdtemp()
+    try:
+        cache = SectionCache(dirname)
+        result = write_sections(text, 'x.tex', cache)
+        assert result[0] == convert_text(text, 'x.tex')
+        assert result[3:] == (4, 0)
+        assert write_sections(text, 'x.tex', cache)[3:] == (0, 4)
+        # only the edited section is written again
+        sections[1] = sections[1].replace('Doc.', 'Changed \\emph{doc}.')
+        text = document(sections)
+        result = write_sections(text, 'x.tex', cache)
+        assert result[0] == convert_text(text, 'x.tex')
+        assert result[3:] == (1, 3)
+    finally:
+        shutil.rmtree(dirname)
+
+def test_incremental_lines():
+    import shutil, tempfile
+    from converter.latexparser import ParserError
+    from converter.incremental import SectionCache, write_sections, \
+         convert_text
+    table = ("\\begin{tabular}{ll}\na & b \\\\\nlost \\\\\n"
+             "\\end{tabular}\n")
+    text = "\\section{One}\nText.\n\n\\section{Two}\n" + table
+    dirname = tempfile.mkdtemp()
+    try:
+        cache = SectionCache(dirname)
+        parser = write_sections(text, 'x.tex', cache)[2]
+        assert parser.warnings == [
+            'tabular: dropped a row of 1 columns instead of 2, line 7']
+        # the warning moves with its section
+        text = "\\section{One}\nMore\ntext.\n\n\\section{Two}\n" + table
+        result = write_sections(text, 'x.tex', cache)
+        assert result[2].warnings == [
+            'tabular: dropped a row of 1 columns instead of 2, line 8']
+        assert result[3:] == (2, 0)
+        text += "\\section{Three}\n\n\\begin{nosuchenv}\\end{nosuchenv}\n"
+        errors = []
+        for convert in (lambda: write_sections(text, 'x.tex', cache),
+                        lambda: convert_text(text, 'x.tex')):
+            try:
+                convert()
+            except ParserError, err:
+                errors.append(str(err))
+        assert errors == ['no handler for nosuchenv environment, '
+                          'line 12, column 18'] * 2
+    finally:
+        shutil.rmtree(dirname)
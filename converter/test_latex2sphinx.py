@@ -0,0 +1,21 @@
+import tempfile
+from StringIO import StringIO
+
+from converter.latex2sphinx import _convert_file
+
+
+def test_convert_file_stream_metadata():
+    text = ('\\section{A}\nText.\n\\section{B}\n\\author{Someone}\n'
+            '\\title{Late}\\release{2.0}\nMore.\n')
+    expected = StringIO()
+    _convert_file(StringIO(text), expected)
+    expected = expected.getvalue()
+    assert 'Late' in expected and 'Someone' in expected and '2.0' in expected
+    outf = tempfile.TemporaryFile()
+    outf.write('.. preamble\n')
+    diagnostics = []
+    assert _convert_file(StringIO(text), outf, stream=True,
+                         diagnostics=diagnostics) == set()
+    outf.seek(0)
+    assert outf.read() == '.. preamble\n' + expected
+    assert diagnostics == []
@@ -0,0 +1,187 @@
+from converter.tokenizer import Tokenizer, TokenStream
+from converter.latexparser import DocParser
+from converter.testutil import make_parser, parse, write
+
+
+def test_parser_dispatch():
+    from converter.latexparser import argspec_parser
+    from converter.docnodes import TextNode
+    class Parser(DocParser):
+        def handle_note(self):
+            arg, = self.parse_args('\\note', 'M')
+            return TextNode('*')
+    text = "\\note{a} \\issue{1} \\bogus \\versionadded[2.0]{y}"
+    tree = parse(text, parserclass=Parser,
+                 extlinks={'issue': ('http://x/%s', '')}).rootnode
+    assert repr(tree) == "RootNode('x.tex', NL[T'* ', " \
+        "ExtLinkNode('issue', [T'1']), T' ', " \
+        "CommandNode('versionadded', [T'2.0', T'y'])])"
+    assert 'issue' not in DocParser.handlers
+    assert Parser.handlers['note'] is Parser.__dict__['handle_note']
+    DocParser.handle_bogus = DocParser.handle_c.im_func
+    try:
+        assert Parser.handlers['bogus'] is DocParser.handlers['bogus']
+    finally:
+        del DocParser.handle_bogus
+    assert 'bogus' not in Parser.handlers
+    assert argspec_parser('OM') is argspec_parser('OM')
+
+def test_instance_handlers():
+    from converter.docnodes import TextNode
+    parser = make_parser("\\shout \\code{x} \\issue{1}")
+    parser.set_handler('shout', lambda: TextNode('*'))
+    parser.set_handler('code', lambda: TextNode(
+        parser.parse_args('\\code', 'M')[0].text.upper()))
+    assert repr(parser.parse()) == "RootNode('x.tex', NL[T'*X 1'])"
+    assert 'shout' not in DocParser.handlers
+    parser.set_handler('code', None)
+    assert parser.handlers['code'] is DocParser.handlers['code']
+    parser.set_handler('shout', None)
+    assert 'shout' not in parser.handlers
+    # extlinks are handlers of their parser only
+    tree = parse("\\issue{1}", extlinks={'issue': ('http://x/%s', '')})
+    assert repr(tree.rootnode.children) == "NL[ExtLinkNode('issue', [T'1'])]"
+    assert 'issue' not in DocParser.handlers
+    assert repr(parse("\\issue{1}").rootnode.children) == "NL[T'1']"
+
+def test_parse_deep_nesting():
+    import sys
+    from converter.docnodes import TextNode
+    from converter.benchmark import nested_document, nesting_kinds
+    depth = sys.getrecursionlimit() * 2
+    for kind in nesting_kinds:
+        tree = parse(nested_document(kind, depth)).rootnode
+        node, found = tree.children[2], 0
+        while not isinstance(node, TextNode):
+            node = getattr(node, 'content', None) or node.args[-1]
+            found += 1
+        assert node.text.strip() == 'x', kind
+        assert found >= depth or kind == 'groups', kind
+
+def test_node_index():
+    from converter.docnodes import NodeIndex, ListingNode
+    text = ("A\n\n\\begin{figure}x \\begin{quote}\\label{Fig}"
+            "\\begin{lstlisting}\nint x;\n\\end{lstlisting}\\end{quote} y"
+            "\\end{figure}\n\n\\begin{table}\\caption{C}\\label{tab}"
+            " z\\end{table}\n")
+    parser = parse(text)
+    tree = parser.rootnode
+    figure, table = tree.children[2], tree.children[4]
+    assert figure.opts['label'] == 'fig'
+    assert isinstance(figure.opts['listing'], ListingNode)
+    assert table.opts['label'] == 'tab'
+    assert table.opts['caption_node'].cmdname == 'caption'
+    index = parser.node_index()
+    assert index.nodes[0] is tree and index.parent(figure) is tree
+    assert index.find(tree, cmdname='label').args[0].text == 'Fig'
+    assert index.find(table, type=ListingNode) is None
+    quote = figure.content[1]
+    assert index.subtree(quote) == NodeIndex(quote).nodes[1:]
+
+def test_singlepass_desc_lines():
+    from converter.docnodes import DescEnvironmentNode
+    text = ("\\begin{classdesc}{C}{a}\nA class.\n"
+            "\\begin{methoddesc}{m}{x}\\methodline{m}{x, y}\n"
+            "  Method. \\emph{x}\\end{methoddesc}\n"
+            "\\begin{memberdesc}{attr}\\memberline{other}A member."
+            "\\end{memberdesc}\n\\end{classdesc}\n\n"
+            "\\begin{funcdesc}{f}{a}\n\\funcline{f}{a, b}\n"
+            "\\funcline{g}{}\nDoes things.\\end{funcdesc}\n")
+    outputs = []
+    for singlepass in (True, False):
+        parser = parse(text, singlepass=singlepass)
+        index = parser.node_index()
+        lines = [(index.nodes[i].envname, index.nodes[i].additional)
+                 for i in index.types[DescEnvironmentNode]]
+        outputs.append((repr(parser.rootnode), repr(lines),
+                        write(parser.rootnode)))
+    assert outputs[0] == outputs[1]
+    assert '.. function:: f(a)\n              f(a, b)\n              g()' in \
+           outputs[0][2]
+
+def test_outline():
+    text = ("\\title{The \\emph{Manual}}\\release{2.1}\n"
+            "\\section{Intro \\code{x}}\n  \\label{intro}\n"
+            "See \\ref{other} and \\refmodule[m]{os}. % \\ref{comment}\n"
+            "\\input{chap1}\n"
+            "\\begin{tabular}{ll} \\label{hidden} & \\ref{hidden} \\\\\n"
+            "\\begin{tabular}{l}x\\end{tabular}\\end{tabular}\n"
+            "\\begin{equation}x=1\\label{eq1}\\end{equation}\n"
+            "\\begin{verbatim}\n\\section{no}\n\\end{verbatim}\n"
+            "\\verb|\\label{no}| \\\\label{no}\n"
+            "\\subsection{Two}\\label{sec2}\\label{other}\n"
+            "\\chapter*{Three}\n")
+    expected = ({'title': 'The Manual', 'release': '2.1'},
+                [(2, 'section', 'Intro x', 'intro'),
+                 (13, 'subsection', 'Two', 'sec2'),
+                 (14, 'chapter*', 'Three', None)],
+                [(3, 'intro'), (8, 'eq1'), (13, 'sec2'), (13, 'other')],
+                [(4, 'ref', 'other'), (4, 'refmodule', 'os')],
+                [(5, 'input', 'chap1')])
+    # searching the token buffer and walking a token list agree
+    for tokens in (Tokenizer(text).tokenize(),
+                   TokenStream(list(Tokenizer(text).tokenize()))):
+        outline = DocParser(tokens, 'x.tex').outline()
+        assert (outline.params, outline.sections, outline.labels,
+                outline.refs, outline.includes) == expected
+
+def test_iterparse():
+    from StringIO import StringIO
+    from converter.docnodes import SectioningNode
+    from converter.restwriter import RestWriter
+    text = ("\\title{Doc}\\release{1.0}\nPreamble.\n\\begin{document}\n"
+            "Intro\\footnote{A note.}.\n\\section{One}\\label{one}\nText "
+            "{\\section{Grouped}} more.\n\\begin{figure}x\\caption{A}"
+            "\\label{fig}\\end{figure}\n\\subsection{Two}\n"
+            "\\begin{funcdesc}{f}{a}\\funcline{g}{b}Doc.\\end{funcdesc}\n"
+            "\\end{document}\n")
+    expected = write(parse(text).rootnode)
+    parser = make_parser(text)
+    parts = list(parser.iterparse())
+    assert [type(part[0]) for part in parts[1:]] == [SectioningNode] * 2
+    assert parser.rootnode.children == []
+    streamed = StringIO()
+    parser = make_parser(text)
+    parts = parser.iterparse()
+    RestWriter(streamed).write_stream(parser.rootnode, parts)
+    assert streamed.getvalue() == expected
+    assert '  Doc  \n' in expected and '.. [#] A note.' in expected
+
+def test_tabular_rows():
+    from converter.docnodes import TabularNode, NodeList
+    text = ("\\begin{tabular}{l|l}\n\\hline\nName & Value \\\\\n\\hline\n"
+            "a & \\code{1} \\\\\n$x & y$ & z \\\\\nlost row \\\\\n"
+            "{b} & \\\\\n\\hline\n\\end{tabular}\n")
+    parser = parse(text)
+    node = parser.rootnode.children[0]
+    assert isinstance(node, TabularNode)
+    assert node.headings == ('  Name ', ' Value ')
+    assert isinstance(node.lines[0][0], str)
+    assert isinstance(node.lines[0][1], NodeList)
+    assert node.lines[1][1] == ' z ' and node.lines[2] == (' b ', ' ')
+    assert parser.warnings == [
+        'tabular: dropped a row of 1 columns instead of 2, line 7']
+    assert '| :math:`x & y` | z     |' in write(parser.rootnode)
+
+def test_recovery():
+    def convert(text, diagnostics):
+        tree = parse(text, diagnostics=diagnostics).rootnode
+        return write(tree, diagnostics=diagnostics)
+    text = ("Intro \\\"q bad umlaut.\n\nNext \\code{ok}.\n"
+            "\\begin{itemize}\\item a \\begin{nosuchenv}x\\end{nosuchenv} b\n"
+            "\\item c\\end{itemize}\n\n"
+            "\\begin{methoddesc}{m}{}No class.\\end{methoddesc}\n\nDone.\n")
+    diagnostics = []
+    result = convert(text, diagnostics)
+    assert map(str, diagnostics) == [
+        'x.tex:1: \\": unsupported umlaut \\"q',
+        'x.tex:4: \\begin: no handler for nosuchenv environment',
+        'x.tex:?: methoddesc: No current class for m member']
+    assert '.. % ERROR: unsupported umlaut' in result
+    assert 'Next ``ok``.' in result and '* c' in result and 'Done.' in result
+    # a valid document converts as without recovery
+    text = ("\\section{A}\nText \\emph{here}.\n\n"
+            "\\begin{itemize}\\item x\\end{itemize}\n")
+    diagnostics = []
+    assert convert(text, diagnostics) == convert(text, None)
+    assert diagnostics == []
@@ -0,0 +1,46 @@
+from converter.testutil import parse
+
+
+def test_output_buffer():
+    from StringIO import StringIO
+    from converter.restwriter import OutputBuffer
+    class Stream(StringIO):
+        writes = 0
+        def write(self, data):
+            self.writes += 1
+            StringIO.write(self, data)
+    fp = Stream()
+    outf = OutputBuffer(fp, 'utf-8', 10)
+    outf.write('abc\n')
+    outf.write(u'\xfc\n')
+    assert fp.writes == 0
+    outf.write('defghijk\n')
+    assert fp.writes == 1 and outf.parts == []
+    outf.write('end\n')
+    outf.flush()
+    assert fp.writes == 2
+    assert fp.getvalue() == 'abc\n\xc3\xbc\ndefghijk\nend\n'
+    outf.close()
+    outf.close()
+    assert fp.closed
+
+def test_render_memo():
+    from StringIO import StringIO
+    from converter.restwriter import RestWriter
+    text = ("Use \\function{open} and \\emph{\\function{x}}.\\footnote{See "
+            "\\function{open}.}\n\n" * 3 +
+            "\\begin{itemize}\n\\item \\function{open} "
+            "\\emph{twice \\code{x}}\n\\end{itemize}\n")
+    results = []
+    for memo in (True, False):
+        out = StringIO()
+        writer = RestWriter(out)
+        if not memo:
+            writer.rendered = None
+        writer.write_document(parse(text).rootnode)
+        results.append((out.getvalue(), writer.warnings,
+                        writer.render_hits, writer.render_misses))
+    assert results[0][:2] == results[1][:2]
+    assert results[0][1]
+    assert results[0][2] > 0 and results[1][2:] == (0, 0)
+    assert results[0][0].count('.. [#]') == 3
@@ -1,8 +1,201 @@
-from converter.tokenizer import Tokenizer
+from converter.tokenizer import Tokenizer, diff_engines
 
-t = Tokenizer("hello ~ world & yeah & ooodles & doodles ")
-ts = t.tokenize()
+engine_samples = [
+    "hello ~ world & yeah & ooodles & doodles ",
+    "\\section{Intro}\\label{intro}\n\nSome \\emph{text} % comment\n  more\n",
+    "\\verb|x = 1| and \\verb+a|b+ and \\verbatim\n",
+    "a \\\\\nb\\\n\n\n  \n\tc $x^2$ \\{ \\} [opt] \\foo*  {x}\n",
+]
 
-for x in ts:
-    print x
+def test_engines_agree():
+    for sample in engine_samples:
+        assert diff_engines(sample) is None, sample
 
+def test_token_buffer():
+    from converter.tokenizer import Tokenizer, TokenBuffer
+    stream = Tokenizer("\\emph{x} % c\n").tokenize()
+    buf = stream._tokens
+    assert isinstance(buf, TokenBuffer)
+    assert len(buf) == 6
+    assert [buf.type(i) for i in range(len(buf))] == \
+        ['command', 'bgroup', 'text', 'egroup', 'text', 'comment']
+    assert buf.raw(4) == ' '
+    assert buf[-1] == (1, 'comment', ' c', '% c\n')
+    assert list(stream) == list(buf)
+
+def test_token_stream_cursor():
+    from converter.tokenizer import Tokenizer
+    ts = Tokenizer("\\end{verbatim} x").tokenize()
+    assert ts.peek(2) == (1, 'text', 'verbatim', 'verbatim')
+    assert [tok[1] for tok in ts.peekmany(4)] == \
+        ['command', 'bgroup', 'text', 'egroup']
+    start = ts.mark()
+    first = ts.pop()
+    ts.push(first)
+    assert ts.mark() == start
+    ts.popmany(2)
+    ts.push((1, 'text', 'erbatim', 'erbatim'))
+    mark = ts.mark()
+    assert ts.pop()[2] == 'erbatim'
+    ts.reset(mark)
+    assert ts.pop()[2] == 'erbatim'
+    assert ts.slice(start, 4).raw() == '\\end{verbatim}'
+    assert [tok[2] for tok in ts[4:]] == [' x']
+    ts.reset(start)
+    assert ts.pop() == first
+
+def test_token_positions():
+    from converter.tokenizer import Tokenizer
+    from converter.latexparser import DocParser, ParserError
+    tokenizer = Tokenizer("a\n\n  \\emph{x}\n  \\begin{foo} x")
+    assert tokenizer.position(2) == (2, 1)
+    ts = tokenizer.tokenize()
+    assert [tok[0] for tok in ts._tokens] == [1, 1, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4]
+    assert ts._tokens.position(2) == (3, 3)
+    assert ts._tokens.span(2) == (5, 10)
+    try:
+        DocParser(ts, 'x.tex').parse()
+    except ParserError, e:
+        assert (e.args[1], e.col) == (4, 14)
+        assert str(e) == 'no handler for foo environment, line 4, column 14'
+    else:
+        assert False
+
+def test_verb_newline_lines():
+    # the token buffer has the lines tokens start on; the scan engine does
+    # not count the newlines that delimit a \verb
+    text = "a\\verb\nx\n y\nz \\emph{q}\n"
+    tokens = list(Tokenizer(text).tokenize())
+    scanned = list(Tokenizer(text, engine='scan').tokenize())
+    assert [tok[1:] for tok in tokens] == [tok[1:] for tok in scanned]
+    assert [tok[0] for tok in tokens] == [1, 1, 1, 2, 2, 3, 3, 4, 4, 4, 4, 4, 4]
+    assert [tok[0] for tok in scanned] == [1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2]
+    assert diff_engines(text, ('scan', 'master'))[:2] == \
+           (3, (1, 'text', 'x', 'x'))
+
+def test_stream_tokenizer():
+    from StringIO import StringIO
+    from converter.tokenizer import Tokenizer, StreamTokenizer
+    samples = engine_samples + ["\\verb\nx\n y %\n\n\n\n z\\\\"]
+    for sample in samples:
+        expected = list(Tokenizer(sample).tokenize())
+        for chunksize in (1, 2, 3, 7, 64):
+            stream = StreamTokenizer(StringIO(sample), chunksize).tokenize()
+            assert list(stream) == expected, (sample, chunksize)
+
+def test_stream_tokenizer_raw_regions():
+    from StringIO import StringIO
+    from converter import tokenizer
+    calls = []
+    def raw_construct(data, pos, lineno):
+        calls.append(pos)
+        return real_raw_construct(data, pos, lineno)
+    real_raw_construct = tokenizer.raw_construct
+    tokenizer.raw_construct = raw_construct
+    try:
+        for opening, body, closing in [
+                ('\\begin{verbatim}', 'a \\fi b\n', '\\end{verbatim}'),
+                ('\\ifx', 'a % \\fi\n', '\\fi')]:
+            text = 'x\n' + opening + body * 500 + closing + '\ny\n\nz\n'
+            expected = list(tokenizer.Tokenizer(text).tokenize())
+            del calls[:]
+            stream = tokenizer.StreamTokenizer(StringIO(text), 64).tokenize()
+            assert list(stream) == expected
+            # the open region is not lexed again for every chunk
+            assert len(calls) <= 3, len(calls)
+    finally:
+        tokenizer.raw_construct = real_raw_construct
+
+def test_token_window():
+    from converter.tokenizer import TokenStream
+    ts = TokenStream((i, 'text', str(i), str(i)) for i in xrange(100))
+    ts._tokens.history = 4
+    for i in range(50):
+        tok = ts.pop()
+    ts.push(tok)
+    assert ts.peek(1)[0] == 50
+    assert len(ts._tokens._tokens) <= 10
+    assert [tok[0] for tok in ts][-1] == 99
+    assert not ts
+    # slices of a window do not need its length
+    ts = TokenStream((i, 'text', str(i), str(i)) for i in xrange(100))
+    assert [tok[0] for tok in ts.slice(2, 5)] == [2, 3, 4]
+    assert len(ts._tokens._tokens) == 5
+    assert ts[98:].raw() == '9899'
+    try:
+        len(ts._tokens)
+    except TypeError:
+        pass
+    else:
+        assert False, 'a window has a length'
+
+def test_retokenize():
+    from converter.tokenizer import Tokenizer
+    old = "\\section{A}\n\nSome \\verb|x| text % note\nmore\n\nend\n"
+    new = "\\section{A}\n\nSome \\verb|yy| text % note\nmore \\emph{b}\n\nend\n"
+    edits = [(24, 25, 24, 26), (43, 43, 44, 53)]
+    tokens = Tokenizer(old).tokenize()
+    stream = Tokenizer(new).retokenize(tokens, edits)
+    assert list(stream) == list(Tokenizer(new).tokenize())
+    assert stream._tokens.line_starts == Tokenizer(new).line_starts
+
+def test_tokenize_parallel():
+    from converter.tokenizer import Tokenizer, split_points
+    text = ''.join("\\section{S%d}\n\nSome \\verb|x| text %% c\n\n"
+                   "\\begin{verbatim}\n\n\\section{no}\n\\end{verbatim}\n\n"
+                   % i for i in range(20))
+    points = split_points(text, 4)
+    assert points[0] == 0 and points[-1] == len(text) and len(points) == 5
+    for point in points[1:-1]:
+        assert text[point:].startswith('\\section{S')
+    serial = Tokenizer(text).tokenize()._tokens
+    parallel = Tokenizer(text).tokenize_parallel(2, min_segment=100)._tokens
+    assert parallel.kinds == serial.kinds
+    assert parallel.starts == serial.starts
+    assert parallel.line_starts == serial.line_starts
+
+def test_raw_regions():
+    from StringIO import StringIO
+    from converter.tokenizer import Tokenizer, StreamTokenizer
+    from converter.testutil import parse
+    text = ("\\begin{verbatim}\n  a % b {c}\n\\end{verbatim}\n"
+            "\\ifx\\a\\b % \\fi\n \\\\fi \\emph{x}\\fi y")
+    tokens = list(Tokenizer(text).tokenize())
+    assert [tok[1] for tok in tokens[:5]] == \
+        ['command', 'bgroup', 'text', 'egroup', 'raw']
+    assert tokens[4][3] == '\n  a % b {c}\n'
+    assert tokens[10][2] == 'ifx'
+    assert tokens[11][1] == 'raw' and tokens[12][2] == 'fi'
+    assert tokens == list(Tokenizer(text, engine='scan').tokenize())
+    tree = parse(text).rootnode
+    assert repr(tree.children) == \
+        "NL[VerbatimNode(T'\\n  a % b {c}\\n'), T' y']"
+    # an \fi in a \verb does not end the region
+    text = "\\ifx\\a\\b \\verb|\\fi| \\\\verb|\\fi| y"
+    tokens = list(Tokenizer(text).tokenize())
+    assert tokens[1][1] == 'raw' and \
+           tokens[1][3] == '\\a\\b \\verb|\\fi| \\\\verb|'
+    assert tokens == list(Tokenizer(text, engine='scan').tokenize())
+    assert tokens == list(StreamTokenizer(StringIO(text), 4).tokenize())
+
+def test_generate_corpus():
+    from converter.benchmark import generate_corpus, corpus_shapes
+    mix = dict.fromkeys(corpus_shapes, 1)
+    text = generate_corpus(20000, mix, seed=7)
+    assert len(text) >= 20000
+    assert text == generate_corpus(20000, mix, seed=7)
+    assert text != generate_corpus(20000, mix, seed=8)
+    assert diff_engines(text) is None
+
+def test_allocations():
+    from converter.benchmark import allocations
+    # the list, the tuples and the new strings
+    assert allocations(lambda: [(str(i), 'x') for i in range(1000, 1010)]) == 21
+
+
+if __name__ == '__main__':
+    t = Tokenizer("hello ~ world & yeah & ooodles & doodles ")
+    ts = t.tokenize()
+
+    for x in ts:
+        print x
@@ -0,0 +1,36 @@
+def test_wrap_text():
+    import textwrap
+    from converter.util import wrap_text, wordsep_re
+    wrapper = textwrap.TextWrapper(break_long_words=False)
+    wrapper.wordsep_re = wordsep_re
+    text = (u"A well-known module--the\tstring one--has  many functions, "
+            u"and so\non.  Extraordinarily-long-hyphenated-words are "
+            u"split; an  unbreakablewordthatislongerthananyline is not. ")
+    for width in (1, 7, 10, 13, 20, 33, 80):
+        wrapper.width = width
+        assert wrap_text(text, width) == wrapper.wrap(text)
+        assert wrap_text(str(text), width) == wrapper.wrap(str(text))
+    # no breaks at the hyphens in roles, interpreted text and literals
+    text = u'Use the (:ref:`option-parser`) or ``long--option`` flag.'
+    assert wrap_text(text, 12) == [u'Use the', u'(:ref:`option-parser`)',
+                                   u'or', u'``long--option``', u'flag.']
+
+def test_inline_markup_repair():
+    from converter.util import repair_bad_inline_markup, fixup_text
+    assert repair_bad_inline_markup(
+        u"see:func:`spam()`, the \\```eggs``' and `` ham ``s.") == \
+        u'see\\ :func:`spam`, the ``eggs`` and ``ham``\\ s.'
+    assert repair_bad_inline_markup(u'a ``\\`` b `````` c') == \
+        u'a ``\\`` b `````` c'
+    assert repair_bad_inline_markup('plain text') == 'plain text'
+    assert fixup_text(u"It's ``quoted'' |x| *y* `z`") == \
+        u'It\'s "quoted" \\|x\\| \\*y\\* \'z\''
+    assert fixup_text(u'nothing to fix') == u'nothing to fix'
+    # the same as the full passes the two functions narrow down
+    from converter.benchmark import full_repair_bad_inline_markup, \
+         full_fixup_text
+    for text in (u"x:meth:`a()`y \\```b``'c ``\\`` ``````d `` e ``f",
+                 u"`'``'''``` |*| \x02\x03 `a` ``b``", 'no markup', u''):
+        assert repair_bad_inline_markup(text) == \
+               full_repair_bad_inline_markup(text)
+        assert fixup_text(text) == full_fixup_text(text)
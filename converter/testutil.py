@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+    Test helpers
+    ~~~~~~~~~~~~
+
+    Building parsers and writers for LaTeX strings, for the test modules.
+"""
+
+from StringIO import StringIO
+
+from .tokenizer import Tokenizer
+from .latexparser import DocParser
+from .restwriter import RestWriter
+
+
+def make_parser(text, filename='x.tex', parserclass=DocParser, **kwds):
+    """ Return a `parserclass` instance for the LaTeX `text`. """
+    return parserclass(Tokenizer(text).tokenize(), filename, **kwds)
+
+
+def parse(text, filename='x.tex', parserclass=DocParser, **kwds):
+    """
+    Return a `parserclass` instance that has parsed the LaTeX `text`; the
+    tree is its `rootnode`.
+    """
+    parser = make_parser(text, filename, parserclass, **kwds)
+    parser.parse()
+    return parser
+
+
+def write(tree, *args, **kwds):
+    """ Return the ReST a `RestWriter(fp, *args, **kwds)` writes for `tree`. """
+    out = StringIO()
+    RestWriter(out, *args, **kwds).write_document(tree)
+    return out.getvalue()
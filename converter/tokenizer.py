@@ -10,8 +10,26 @@
 """
 
 import re
+import codecs
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .scanner import Scanner, line_index, offset_position
+
+# Environments whose body the tokenizer passes on as a single ``raw``
+# token, up to the first ``\\end{env}``.
+raw_environments = ('verbatim', 'rstverbatim', 'lstlisting', 'displaymath',
+                    'equation', 'eqnarray', 'math')
+
+raw_end_res = dict((env, re.compile(r'\\end[ \t]*\{%s\}' % env))
+                   for env in raw_environments)
+
+# an ``\\fi`` command, and the lexemes of a line before it: a ``\\verb``
+# (up to its closing delimiter), another backslash sequence or plain text
+fi_re = re.compile(r'\\fi(?![a-zA-Z*])')
+line_lexeme_re = re.compile(r'\\verb([^a-zA-Z]).*?\1|\\.|[^%\\\n]+')
 
-from .scanner import Scanner
 
 class Tokenizer(Scanner):
     """ Lex a Python doc LaTeX document. """
@@ -26,14 +44,58 @@ class Tokenizer(Scanner):
         '&': 'ampersand',
     }
 
+    # The token rules, in order of precedence.  The ``scan`` engine tries
+    # the same patterns one after another via `Scanner.scan()`, the
+    # ``master`` engine compiles them into a single alternation and
+    # dispatches on the name of the group that matched.
+    rules = [
+        ('verb', r'\\verb(?P<verbdelim>[^a-zA-Z])(?P<verbtext>.*?)'
+                 r'(?P=verbdelim)'),
+        ('rawenv', r'\\begin[ \t]*\{(?P<rawname>%s)\}' %
+                   '|'.join(raw_environments)),
+        ('ifx', r'\\ifx(?![a-zA-Z*])[ \t]*'),
+        ('command', r'\\(?P<cmdname>[a-zA-Z]+\*?)[ \t]*'),
+        ('charcommand', r'\\.'),
+        ('linebreak', r'\\\n'),
+        ('comment', r'%(?P<commenttext>.*)\n[ \t]*'),
+        ('special', r'[{}\[\]~&$]'),
+        ('parasep', r'(?:\n[ \t]*){2,}'),
+        ('newline', r'\n[ \t]*'),
+        ('text', r'[^\\%}{\[\]~\n\$&]+'),
+    ]
+
+    master_re = re.compile('|'.join('(?P<%s>%s)' % rule for rule in rules))
+
+    # the constructs followed by a raw region
+    raw_start_re = re.compile('|'.join('(?P<%s>%s)' % rule for rule in rules
+                                       if rule[0] in ('rawenv', 'ifx')))
+
+    engines = ('scan', 'master')
+
+    def __init__(self, text, flags=0, engine='master', encoding=None):
+        """
+        `text` may also be a byte string or an `mmap`, in which case the
+        token text is decoded with `encoding` only when a token is built.
+        """
+        Scanner.__init__(self, text, flags)
+        if engine not in self.engines:
+            raise ValueError('unknown tokenizer engine %r' % engine)
+        self.engine = engine
+        self.encoding = encoding
+
     @property
     def mtext(self):
         return self.match.group()
 
     def tokenize(self):
-        return TokenStream(self._tokenize())
+        tokens = getattr(self, '_tokenize_' + self.engine)()
+        if self.encoding and not isinstance(tokens, TokenBuffer):
+            encoding = self.encoding
+            tokens = [(l, t, v.decode(encoding), r.decode(encoding))
+                      for l, t, v, r in tokens]
+        return TokenStream(tokens)
 
-    def _tokenize(self):
+    def _tokenize_scan(self):
         lineno = 1
         while not self.eos:
             #print self
@@ -43,6 +105,11 @@ class Tokenizer(Scanner):
                 yield lineno, 'text', self.match.group(1), self.match.group(1)
                 yield lineno, 'text', self.match.group(2), self.match.group(2)
                 yield lineno, 'text', self.match.group(3), self.match.group(3)
+            elif self.test(self.raw_start_re.pattern):
+                tokens, self.pos = raw_construct(self.data, self.pos, lineno)
+                for token in tokens:
+                    yield token
+                lineno = token[0] + token[3].count('\n')
             elif self.scan(r'\\([a-zA-Z]+\*?)[ \t]*'):
                 yield lineno, 'command', self.match.group(1), self.mtext
             elif self.scan(r'\\.'):
@@ -68,15 +135,766 @@ class Tokenizer(Scanner):
                 raise RuntimeError('unexpected text on line %d: %r' %
                                    (lineno, self.data[self.pos:self.pos+100]))
 
+    def _tokenize_master(self):
+        tokens = TokenBuffer(self.data, self.encoding, self.line_starts)
+        self.pos = self._lex(tokens, self.pos, self.data_length)
+        tokens.starts.append(self.pos)
+        return tokens
+
+    def _lex(self, tokens, pos, stop):
+        """
+        Lex the tokens starting at `pos` and before `stop` into the token
+        buffer and return the offset where the last one ends.
+        """
+        kinds = tokens.kinds
+        starts = tokens.starts
+        data = self.data
+        match = self.master_re.match
+        special_kinds = TokenBuffer.special_kinds
+        while pos < stop:
+            m = match(data, pos)
+            if m is None:
+                raise RuntimeError('unexpected text on line %d, column %d: '
+                                   '%r' % (self.position(pos) +
+                                           (data[pos:pos+100],)))
+            kind = m.lastgroup
+            if kind == 'text':
+                kinds.append(TEXT)
+            elif kind == 'command':
+                kinds.append(COMMAND)
+            elif kind == 'special':
+                kinds.append(special_kinds[data[pos]])
+            elif kind == 'newline':
+                kinds.append(NEWLINE)
+            elif kind == 'charcommand':
+                kinds.append(CHARCOMMAND)
+            elif kind == 'comment':
+                kinds.append(COMMENT)
+            elif kind == 'parasep':
+                kinds.append(PARASEP)
+            elif kind == 'linebreak':
+                kinds.append(TEXT)
+            elif kind == 'verb':
+                # specialcase \verb here: command, delimiter, text, delimiter
+                kinds.extend(verb_kinds)
+                starts.extend((pos, m.start('verbdelim'), m.start('verbtext'),
+                               m.end('verbtext')))
+                pos = m.end()
+                continue
+            else:
+                pos = self._lex_raw(tokens, m)
+                continue
+            starts.append(pos)
+            pos = m.end()
+        return pos
+
+    def _lex_raw(self, tokens, m):
+        """
+        Lex a raw environment's ``\\begin{env}`` or an ``\\ifx``, and the
+        raw region following it up to the ``\\end{env}`` or ``\\fi``, which
+        is found with a single search and becomes one ``raw`` token.  The
+        optional argument of an ``lstlisting`` is lexed normally.  Returns
+        the offset of the terminator (or of the end of the text).
+        """
+        kinds = tokens.kinds
+        starts = tokens.starts
+        kinds.append(COMMAND)
+        starts.append(m.start())
+        first = len(kinds)
+        env = m.group('rawname')
+        if env:
+            kinds.extend((BGROUP, TEXT, EGROUP))
+            starts.extend((m.start('rawname') - 1, m.start('rawname'),
+                           m.end('rawname')))
+            pos = m.end()
+            if env == 'lstlisting':
+                # raw regions inside the argument are part of this one
+                ngroups = len(tokens.raw_groups)
+                pos = self._lex_optional(tokens, pos)
+                del tokens.raw_groups[ngroups:]
+            end = raw_end_res[env].search(self.data, pos)
+        else:
+            pos = m.end()
+            end = find_fi(self.data, pos, m.start())
+        kinds.append(RAW)
+        starts.append(pos)
+        tokens.raw_groups.append((first, len(kinds) - 1))
+        if end is None:
+            return self.data_length
+        return end.start()
+
+    def _lex_optional(self, tokens, pos):
+        """
+        Lex what the parser reads as the optional argument of a command:
+        whitespace and comments, then, if given, the brackets.  Returns
+        the offset of the first token after it.
+        """
+        kinds = tokens.kinds
+        starts = tokens.starts
+        data = self.data
+        while pos < self.data_length:
+            n = len(kinds)
+            ngroups = len(tokens.raw_groups)
+            end = self._lex(tokens, pos, pos + 1)
+            kind = kinds[n]
+            if kind == NEWLINE or kind == COMMENT or \
+                   kind == TEXT and data[pos:end].isspace():
+                pos = end
+                continue
+            if kind != BOPTIONAL:
+                # this one belongs to the body
+                del kinds[n:], starts[n:], tokens.raw_groups[ngroups:]
+                return pos
+            pos = end
+            bracelevel = 0
+            while pos < self.data_length:
+                n = len(kinds)
+                pos = self._lex(tokens, pos, pos + 1)
+                kind = kinds[n]
+                if kind == EOPTIONAL and bracelevel == 0:
+                    break
+                elif kind == BGROUP:
+                    bracelevel += 1
+                elif kind == EGROUP:
+                    bracelevel -= 1
+            return pos
+        return pos
+
+    def retokenize(self, old, edits):
+        """
+        Tokenize the text by updating the tokens of a previous version.
+
+        `old` is the `TokenBuffer` (or a stream over it) of the previous
+        text, `edits` a list of ``(old_start, old_end, new_start, new_end)``
+        ranges that were replaced, as in the opcodes of a
+        `difflib.SequenceMatcher`.  The edits are merged into one span.
+        Lexing restarts at the last token boundary before the line that
+        precedes the span (no token before it can have looked at the
+        edited text), and stops as soon as a new token past the span starts
+        where an old one did: the lexer keeps no state between tokens, so
+        from there on the old tokens only need to be shifted.
+        """
+        if isinstance(old, TokenStream):
+            old = old._tokens
+        if not isinstance(old, TokenBuffer):
+            raise TypeError('can only retokenize a TokenBuffer')
+        ostart = min(edit[0] for edit in edits)
+        oend = max(edit[1] for edit in edits)
+        nend = max(edit[3] for edit in edits)
+        delta = nend - oend
+        oldkinds = old.kinds
+        oldstarts = old.starts
+        nold = len(old)
+        if oldstarts[nold] + delta != self.data_length:
+            raise ValueError('edits do not match the length of the text')
+
+        # the line index only changes within the edited span
+        oldlines = old.line_starts
+        k = bisect_right(oldlines, ostart)
+        line_starts = oldlines[:k]
+        line_starts.extend(m.end() + ostart for m in
+                           re.finditer('\n', self.data[ostart:nend]))
+        line_starts.extend(e + delta for e in
+                           oldlines[bisect_right(oldlines, oend):])
+        self._line_starts = line_starts
+
+        # resynchronize at the start of the line before the edited one
+        anchor = oldlines[max(k - 2, 0)]
+        i = max(bisect_right(oldstarts, anchor, 0, nold) - 1, 0)
+        while not old.is_boundary(i):
+            i -= 1
+        tokens = TokenBuffer(self.data, self.encoding, line_starts)
+        tokens.kinds.extend(oldkinds[:i])
+        tokens.starts.extend(oldstarts[:i])
+        tokens.raw_groups.extend(group for group in old.raw_groups
+                                 if group[1] < i)
+
+        pos = self._lex(tokens, oldstarts[i], nend)
+        while True:
+            if pos >= self.data_length:
+                j = nold
+                break
+            j = bisect_left(oldstarts, pos - delta, 0, nold)
+            if j < nold and oldstarts[j] == pos - delta and \
+                   old.is_boundary(j):
+                break
+            pos = self._lex(tokens, pos, pos + 1)
+        shift = len(tokens) - j
+        tokens.raw_groups.extend((first + shift, last + shift)
+                                 for first, last in old.raw_groups
+                                 if first > j)
+        tokens.kinds.extend(oldkinds[j:])
+        tokens.starts.extend(array('l', [start + delta for start in
+                                         oldstarts[j:]]))
+        self.pos = self.data_length
+        return TokenStream(tokens)
+
+    def tokenize_range(self, start, stop):
+        """
+        Tokenize like the ``master`` engine, but only the text from offset
+        `start` to `stop`, both token boundaries.  The tokens keep the line
+        numbers and columns they have in the whole text.
+        """
+        tokens = TokenBuffer(self.data, self.encoding, self.line_starts)
+        tokens.starts.append(self._lex(tokens, start, stop))
+        return TokenStream(tokens)
+
+    def tokenize_parallel(self, processes=None, min_segment=1<<20):
+        """
+        Tokenize like the ``master`` engine, but split the text at safe
+        points (see `split_points()`) and lex the segments in a pool of
+        `processes` worker processes.  Texts shorter than two segments of
+        `min_segment` characters are tokenized serially.  The resulting
+        token buffer is identical to the serial one.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        nsegments = min(processes, self.data_length // min_segment)
+        if nsegments < 2:
+            return self.tokenize()
+        data = self.data
+        points = split_points(data, nsegments)
+        jobs = [(data[start:stop], start)
+                for start, stop in zip(points, points[1:])]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_lex_segment, jobs)
+        except RuntimeError:
+            # lex serially to report the error with the right position
+            return self.tokenize()
+        finally:
+            pool.terminate()
+        for kinds, starts, lines, raw_groups in results[:-1]:
+            if kinds and kinds[-1] == RAW:
+                # a raw region ran into the next segment: the split point
+                # was not safe after all
+                return self.tokenize()
+        line_starts = [0]
+        for kinds, starts, lines, raw_groups in results:
+            line_starts.extend(lines)
+        tokens = TokenBuffer(data, self.encoding, line_starts)
+        for kinds, starts, lines, raw_groups in results:
+            shift = len(tokens)
+            tokens.raw_groups.extend((first + shift, last + shift)
+                                     for first, last in raw_groups)
+            tokens.kinds.extend(kinds)
+            tokens.starts.extend(starts)
+        tokens.starts.append(self.data_length)
+        self._line_starts = line_starts
+        self.pos = self.data_length
+        return TokenStream(tokens)
+
+
+class StreamTokenizer(object):
+    """
+    Lex a LaTeX document read from a file object in chunks.
+
+    Only the current chunk and the tail of the previous one are kept in
+    memory.  A lexeme that may continue past the end of the buffer (an
+    open ``\\verb``, a comment still missing its newline, a run of blank
+    lines, a raw region whose terminator has not been read yet) is left in
+    the buffer until the next chunk has been read; while a raw region is
+    open, only the newly read text is searched for its terminator.  The
+    tokens are the same as those of the ``master`` engine of `Tokenizer`.
+    """
+
+    def __init__(self, fileobj, chunksize=65536, encoding=None):
+        if encoding:
+            fileobj = codecs.getreader(encoding)(fileobj)
+        self.fileobj = fileobj
+        self.chunksize = chunksize
+
+    def tokenize(self):
+        return TokenStream(self._tokenize())
+
+    def _tokenize(self):
+        read = self.fileobj.read
+        match = Tokenizer.master_re.match
+        specials = Tokenizer.specials
+        buf = read(self.chunksize)
+        eof = not buf
+        pos = 0
+        lineno = 1
+        opening = None
+        while True:
+            end = len(buf)
+            # a lexeme starting before the last two newlines of the buffer
+            # (a \verb may use a newline as its delimiter) and ending before
+            # the end of the buffer is complete
+            safe = -1
+            last = buf.rfind('\n')
+            if last > 0:
+                safe = buf.rfind('\n', 0, last)
+            while pos < end:
+                if not eof and pos > safe:
+                    break
+                m = match(buf, pos)
+                if m is None:
+                    if eof:
+                        raise RuntimeError('unexpected text on line %d: %r' %
+                                           (lineno, buf[pos:pos+100]))
+                    break
+                if not eof and m.end() >= end:
+                    break
+                kind = m.lastgroup
+                if kind == 'rawenv' or kind == 'ifx':
+                    # the whole construct must be followed by two more
+                    # newlines, like any other lexeme
+                    try:
+                        tokens, rawend = raw_construct(buf, pos, lineno)
+                    except RuntimeError:
+                        if eof:
+                            raise
+                        break
+                    if not eof and rawend >= end:
+                        # the terminator is not in the buffer yet
+                        opening = m
+                        break
+                    if not eof and rawend > safe:
+                        break
+                    for token in tokens:
+                        yield token
+                    lineno = token[0] + token[3].count('\n')
+                    pos = rawend
+                    continue
+                pos = m.end()
+                raw = m.group()
+                if kind == 'text':
+                    yield lineno, 'text', raw, raw
+                elif kind == 'command':
+                    yield lineno, 'command', m.group('cmdname'), raw
+                elif kind == 'special':
+                    yield lineno, specials[raw], raw, raw
+                elif kind == 'newline':
+                    yield lineno, 'text', ' ', raw
+                    lineno += 1
+                elif kind == 'charcommand':
+                    yield lineno, 'command', raw[1], raw
+                elif kind == 'comment':
+                    yield lineno, 'comment', m.group('commenttext'), raw
+                    lineno += 1
+                elif kind == 'parasep':
+                    lines = raw.count('\n')
+                    yield lineno, 'parasep', '\n' * lines, raw
+                    lineno += lines
+                elif kind == 'linebreak':
+                    yield lineno, 'text', raw, raw
+                    lineno += 1
+                else:
+                    delim = m.group('verbdelim')
+                    text = m.group('verbtext')
+                    yield lineno, 'command', 'verb', '\\verb'
+                    yield lineno, 'text', delim, delim
+                    if delim == '\n':
+                        lineno += 1
+                    yield lineno, 'text', text, text
+                    yield lineno, 'text', delim, delim
+                    if delim == '\n':
+                        lineno += 1
+            if eof:
+                return
+            if opening is not None:
+                buf, eof = self._read_raw(buf[pos:], opening.group('rawname'),
+                                          opening.end() - pos)
+                opening = None
+            else:
+                chunk = read(self.chunksize)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+            pos = 0
+
+    def _read_raw(self, buf, env, start):
+        """
+        Read chunks until one holds the terminator of the raw region that
+        `buf` starts with (`env` is None for an ``\\ifx``), whose body starts
+        at `start`.  Only the last line and the new chunk are searched each
+        time.  Returns the new buffer and whether the file is read to the
+        end.
+        """
+        read = self.fileobj.read
+        if env:
+            search = raw_end_res[env].search
+        else:
+            search = find_fi
+        chunks = [buf]
+        tail = buf[max(buf.rfind('\n') + 1, start):]
+        while True:
+            chunk = read(self.chunksize)
+            if not chunk:
+                return ''.join(chunks), True
+            chunks.append(chunk)
+            tail += chunk
+            if search(tail, 0) is not None:
+                return ''.join(chunks), False
+            tail = tail[tail.rfind('\n') + 1:]
+
+
+# Split point candidates, best first: line-start sectioning commands,
+# paragraph breaks, any line start.  Each points at the start of a line
+# that does not begin with whitespace, where every lexeme ends.
+split_res = [
+    re.compile(r'\n(?=\\(?:chapter|section)\b)'),
+    re.compile(r'\n[ \t]*\n(?=[^ \t\n])'),
+    re.compile(r'\n(?=[^ \t\n])'),
+]
+
+
+def find_fi(data, pos, linestart=0):
+    """
+    Return the match of the first ``\\fi`` command after `pos` that is
+    not in a comment or a ``\\verb``, or ``None``.  Comments and ``\\verb``\s
+    are only looked for after `linestart` on the line of `pos`, and only
+    on the line of the ``\\fi``: a ``\\verb`` whose delimiter is a newline
+    is not recognized.
+    """
+    match = line_lexeme_re.match
+    while True:
+        m = fi_re.search(data, pos)
+        if m is None:
+            return None
+        start = m.start()
+        i = max(data.rfind('\n', 0, start) + 1, linestart)
+        while i < start:
+            lexeme = match(data, i)
+            if lexeme is None:
+                # a comment
+                break
+            i = lexeme.end()
+        if i == start:
+            return m
+        pos = m.end()
+
+
+def raw_construct(data, pos, lineno):
+    """
+    Lex the raw construct at `pos` into token tuples, for the engines that
+    do not use a `TokenBuffer`.  Returns the tokens and the offset of the
+    terminator of the raw region.
+    """
+    tokens = TokenBuffer(data, line_starts=[])
+    end = Tokenizer(data)._lex(tokens, pos, pos + 1)
+    tokens.starts.append(end)
+    result = []
+    for i in xrange(len(tokens)):
+        token = tokens[i]
+        result.append((lineno,) + token[1:])
+        lineno += token[3].count('\n')
+    return result, end
+
+
+def raw_regions(data):
+    """
+    Return a sorted list of the ``(start, end)`` offsets of what may be
+    the raw environments and ``\\ifx`` blocks in `data`.  Regions may
+    overlap.
+    """
+    regions = []
+    pos = 0
+    while True:
+        m = Tokenizer.raw_start_re.search(data, pos)
+        if m is None:
+            return regions
+        env = m.group('rawname')
+        if env:
+            end = raw_end_res[env].search(data, m.end())
+        else:
+            end = find_fi(data, m.end(), m.start())
+        if end is None:
+            end = len(data)
+        else:
+            end = end.start()
+        regions.append((m.start(), end))
+        # a region found here may be no raw region at all, but hide one
+        pos = m.end()
+
+
+def split_points(data, nsegments):
+    """
+    Return the offsets at which `data` can be cut into about `nsegments`
+    segments that tokenize to the same tokens as the whole text, including
+    ``0`` and ``len(data)``.  No segment starts inside a raw region or
+    right after a ``\\verb`` using a newline as its delimiter.
+    """
+    length = len(data)
+    regions = raw_regions(data)
+    region_starts = [region[0] for region in regions]
+    seglen = length // nsegments
+    points = [0]
+    for k in range(1, nsegments):
+        target = max(k * seglen, points[-1] + 1)
+        limit = min(target + seglen // 2, length)
+        for regex in split_res:
+            pos = target
+            while True:
+                m = regex.search(data, pos, limit)
+                if m is None:
+                    break
+                point = m.end()
+                inside = [end for start, end in
+                          regions[:bisect_right(region_starts, point)]
+                          if point <= end]
+                if inside:
+                    # skip the rest of the raw regions
+                    pos = max(inside) + 1
+                elif data[point-6:point-1] == '\\verb':
+                    pos = point
+                else:
+                    points.append(point)
+                    break
+            if points[-1] >= target:
+                break
+    points.append(length)
+    return points
+
+
+def _lex_segment(job):
+    """
+    Lex one segment of a text in a worker process; returns the token
+    kinds, the start offsets and the line starts, shifted by the offset of
+    the segment, and the raw groups.
+    """
+    data, offset = job
+    tokens = TokenBuffer(data, line_starts=[])
+    Tokenizer(data)._lex(tokens, 0, len(data))
+    starts = tokens.starts
+    if offset:
+        starts = array('l', [start + offset for start in starts])
+    lines = [m.end() + offset for m in re.finditer('\n', data)]
+    return tokens.kinds, starts, lines, tokens.raw_groups
+
+
+def diff_engines(text, engines=Tokenizer.engines):
+    """
+    Tokenize `text` with each of the given engines and compare the token
+    streams.  Returns ``None`` if they agree, else a tuple of the index of
+    the first differing token and the tokens each engine produced there
+    (``None`` for an exhausted stream).  A ``\\verb`` with newline
+    delimiters makes the line numbers of the ``scan`` engine differ (see
+    `TokenBuffer`).
+    """
+    streams = [list(Tokenizer(text, engine=engine).tokenize())
+               for engine in engines]
+    for i in xrange(max(map(len, streams))):
+        toks = [(stream[i] if i < len(stream) else None) for stream in streams]
+        if toks.count(toks[0]) != len(toks):
+            return (i,) + tuple(toks)
+    return None
+
+
+
+# Token kinds stored in a `TokenBuffer`.  The kinds up to AMPERSAND are
+# tokens whose value is their raw text; the others derive their value
+# from the raw text when the token is materialized.
+TEXT, BGROUP, EGROUP, BOPTIONAL, EOPTIONAL, TILDE, MATHMODE, AMPERSAND, \
+    NEWLINE, COMMAND, CHARCOMMAND, VERB, COMMENT, PARASEP, RAW = range(15)
+
+verb_kinds = (VERB, TEXT, TEXT, TEXT)
+
+
+class TokenBuffer(object):
+    """
+    A compact store for the tokens of one document.
+
+    Instead of a 4-tuple with two strings per token, the buffer keeps a
+    type code and the start offset of the token in the source buffer in two
+    arrays.  Tokens are contiguous, so a token ends where the next one
+    starts; a final sentinel offset closes the last one.  The usual
+    ``(lineno, type, value, raw)`` tuple is only built when a token is
+    asked for, the line number is then looked up in the line index of the
+    source.  It is the line the token starts on, also after a ``\\verb``
+    whose delimiter is a newline: the ``scan`` engine counts neither of
+    its two delimiter newlines, so its line numbers fall behind by two
+    from there on.
+
+    The source may also be a byte buffer such as an `mmap`; give an
+    `encoding` to have token text decoded when a token is built.
+
+    `raw_groups` lists the ``(first, last)`` token indices of the tokens
+    after the ``\\begin`` or ``\\ifx`` of each raw region, up to the
+    ``raw`` token itself.
+    """
+
+    kind_types = ('text', 'bgroup', 'egroup', 'boptional', 'eoptional',
+                  'tilde', 'mathmode', 'ampersand', 'text', 'command',
+                  'command', 'command', 'comment', 'parasep', 'raw')
+
+    special_kinds = {
+        '{': BGROUP,
+        '}': EGROUP,
+        '[': BOPTIONAL,
+        ']': EOPTIONAL,
+        '~': TILDE,
+        '$': MATHMODE,
+        '&': AMPERSAND,
+    }
+
+    def __init__(self, data, encoding=None, line_starts=None):
+        self.data = data
+        self.encoding = encoding
+        if line_starts is None:
+            line_starts = line_index(data)
+        self.line_starts = line_starts
+        self.kinds = array('B')
+        self.starts = array('l')
+        self.raw_groups = []
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        for i in xrange(len(self.kinds)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.kinds)
+        kind = self.kinds[i]
+        start = self.starts[i]
+        raw = self.data[start:self.starts[i+1]]
+        if self.encoding:
+            raw = raw.decode(self.encoding)
+        lineno = bisect_right(self.line_starts, start)
+        if kind <= AMPERSAND:
+            return lineno, self.kind_types[kind], raw, raw
+        elif kind == NEWLINE:
+            return lineno, 'text', ' ', raw
+        elif kind == COMMAND:
+            return lineno, 'command', raw[1:].rstrip(' \t'), raw
+        elif kind == CHARCOMMAND:
+            return lineno, 'command', raw[1], raw
+        elif kind == VERB:
+            return lineno, 'command', 'verb', '\\verb'
+        elif kind == COMMENT:
+            return lineno, 'comment', raw[1:raw.index('\n')], raw
+        elif kind == PARASEP:
+            return lineno, 'parasep', '\n' * raw.count('\n'), raw
+        else:
+            return lineno, 'raw', raw, raw
+
+    def is_boundary(self, i):
+        """
+        Return true if the lexer can start at token `i`, that is if it is
+        not one of the parts of a ``\\verb`` or of a raw region.
+        """
+        kinds = self.kinds
+        if i >= 1 and kinds[i-1] == VERB or \
+               i >= 2 and kinds[i-2] == VERB or \
+               i >= 3 and kinds[i-3] == VERB:
+            return False
+        groups = self.raw_groups
+        k = bisect_right(groups, (i, len(kinds))) - 1
+        return k < 0 or groups[k][1] < i
+
+    def type(self, i):
+        """ Return the type of token `i` without building the token. """
+        return self.kind_types[self.kinds[i]]
+
+    def span(self, i):
+        """ Return the start and end offset of token `i` in the source. """
+        return self.starts[i], self.starts[i+1]
+
+    def position(self, i):
+        """ Return the ``(line, column)`` at which token `i` starts. """
+        return offset_position(self.line_starts, self.starts[i])
+
+    def raw(self, i):
+        """ Return the raw source text of token `i`. """
+        return self.source(i, i+1)
+
+    def source(self, start, stop):
+        """ Return the source text of the tokens `start` to `stop`. """
+        if start >= stop:
+            text = self.data[0:0]
+        else:
+            text = self.data[self.starts[start]:self.starts[stop]]
+        if self.encoding:
+            text = text.decode(self.encoding)
+        return text
+
+    def find_command(self, pattern, i=0):
+        """
+        Return the index of the first command token from token `i` on whose
+        raw text the compiled `pattern` matches, ``len(self)`` if there is
+        none.  The source is searched for the pattern instead of building
+        the tokens in between.
+        """
+        kinds = self.kinds
+        starts = self.starts
+        n = len(kinds)
+        if i >= n:
+            return n
+        search = pattern.search
+        data = self.data
+        pos = starts[i]
+        while True:
+            m = search(data, pos)
+            if m is None or m.start() >= starts[n]:
+                return n
+            pos = m.start()
+            # a match inside a comment, raw region or another token is no
+            # command token
+            j = bisect_left(starts, pos, i, n)
+            if j < n and starts[j] == pos and kinds[j] == COMMAND:
+                return j
+            pos += 1
+
+
+class TokenWindow(object):
+    """
+    An indexable view of a token iterator.  Tokens are pulled from the
+    iterator when they are first looked at; tokens more than `history`
+    places behind the furthest one looked at are dropped, so a stream
+    over a window uses bounded memory.
+    """
+
+    def __init__(self, iterable, history=1024):
+        self._iter = iter(iterable)
+        self._tokens = []
+        self.offset = 0
+        self.history = history
+
+    # no __len__: it would have to read the whole iterator
+
+    def __getitem__(self, i):
+        if i < 0:
+            raise IndexError('a token window has no negative indices')
+        j = i - self.offset
+        if j < 0:
+            raise IndexError('token %d has been dropped from the window' % i)
+        tokens = self._tokens
+        if j >= len(tokens):
+            if len(tokens) > 2 * self.history:
+                drop = len(tokens) - self.history
+                del tokens[:drop]
+                self.offset += drop
+                j -= drop
+            for tok in self._iter:
+                tokens.append(tok)
+                if len(tokens) > j:
+                    break
+            else:
+                raise IndexError('token index out of range')
+        return tokens[j]
+
 
 class TokenStream(object):
     """
     A token stream works like a normal generator just that
     it supports peeking and pushing tokens back to the stream.
+
+    The stream is a cursor over an indexable token sequence, usually a
+    `TokenBuffer`: popping a token increments an index, peeking any
+    distance ahead is an index lookup, and pushing back the token that was
+    just popped decrements the index again.  Only tokens that were changed
+    before being pushed back are kept on a separate stack.  A token
+    iterator is read lazily through a `TokenWindow`.
     """
 
-    def __init__(self, generator):
-        self._generator = generator
+    def __init__(self, tokens):
+        if not hasattr(tokens, '__getitem__'):
+            tokens = TokenWindow(tokens)
+        self._tokens = tokens
+        self.pos = 0
         self._pushed = []
         self.last = (1, 'initial', '')
 
@@ -88,17 +906,27 @@ class TokenStream(object):
         if self._pushed:
             return True
         try:
-            self.push(self.next())
-        except StopIteration:
+            self._tokens[self.pos]
+        except IndexError:
             return False
         return True
 
+    def __getitem__(self, index):
+        """ Return a view on the underlying token sequence, see `slice()`. """
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError('token streams only support plain slicing')
+        return self.slice(index.start, index.stop)
+
     def pop(self):
         """ Return the next token from the stream. """
         if self._pushed:
             rv = self._pushed.pop()
         else:
-            rv = self._generator.next()
+            try:
+                rv = self._tokens[self.pos]
+            except IndexError:
+                raise StopIteration
+            self.pos += 1
         self.last = rv
         return rv
 
@@ -108,26 +936,156 @@ class TokenStream(object):
         """ Pop a list of tokens. """
         return [self.next() for i in range(num)]
 
-    def peek(self):
-        """ Pop and push a token, return it. """
-        token = self.next()
-        self.push(token)
-        return token
+    def peek(self, n=0):
+        """ Return the token `n` places ahead without consuming it. """
+        npushed = len(self._pushed)
+        if n < npushed:
+            return self._pushed[-1-n]
+        try:
+            return self._tokens[self.pos + n - npushed]
+        except IndexError:
+            raise StopIteration
 
     def peekmany(self, num=1):
-        """ Pop and push a list of tokens. """
-        tokens = self.popmany(num)
-        for tok in tokens:
-            self.push(tok)
-        return tokens
+        """ Return a list of the next `num` tokens without consuming them. """
+        return [self.peek(i) for i in range(num)]
+
+    def location(self, n=0):
+        """
+        Return the ``(lineno, column)`` of the token `n` places ahead, or
+        of the last popped token for ``n=-1``.  The column is ``None`` if
+        the token sequence does not know it or the token was changed
+        before being pushed back.
+        """
+        tokens = self._tokens
+        npushed = len(self._pushed)
+        if n < 0:
+            tok, i = self.last, self.pos - 1
+        elif n < npushed:
+            return self._pushed[-1-n][0], None
+        else:
+            i = self.pos + n - npushed
+            try:
+                tok = tokens[i]
+            except IndexError:
+                return self.last[0], None
+        if hasattr(tokens, 'position') and i >= 0 and tokens[i] == tok:
+            return tokens.position(i)
+        return tok[0], None
+
+    def skip_to_command(self, pattern):
+        """
+        Skip the tokens before the next command token whose raw text the
+        compiled `pattern` matches; return False if there is none left.
+        This does not build the skipped tokens if the token sequence can
+        search its source.
+        """
+        tokens = self._tokens
+        if not self._pushed and hasattr(tokens, 'find_command'):
+            self.pos = tokens.find_command(pattern, self.pos)
+            return self.pos < len(tokens)
+        match = pattern.match
+        while True:
+            try:
+                l, t, v, r = self.peek()
+            except StopIteration:
+                return False
+            if t == 'command' and match(r):
+                return True
+            self.pop()
 
     def push(self, item):
         """ Push a token back to the stream. """
-        self._pushed.append(item)
+        if not self._pushed and self.pos and \
+               self._tokens[self.pos-1] == item:
+            self.pos -= 1
+        else:
+            self._pushed.append(item)
 
+    def mark(self):
+        """
+        Return the current position for a later `reset()`.  This is the
+        plain token index unless changed tokens have been pushed back.
+        """
+        if self._pushed:
+            return self.pos, tuple(self._pushed)
+        return self.pos
 
+    def reset(self, mark):
+        """ Go back (or forward) to a position returned by `mark()`. """
+        if isinstance(mark, tuple):
+            self.pos, pushed = mark
+            self._pushed = list(pushed)
+        else:
+            self.pos = mark
+            self._pushed = []
 
+    def slice(self, start=None, stop=None):
+        """
+        Return a `TokenSlice` view of the tokens between two positions of
+        the underlying sequence (as returned by `mark()` if nothing was
+        pushed back).  `start` defaults to the current position, `stop` to
+        the end of the stream.  Nothing is copied.
+        """
+        if start is None:
+            start = self.pos
+        return TokenSlice(self._tokens, start, stop)
 
 
+class TokenSlice(object):
+    """
+    A view of a range of a token sequence; a `stop` of None is the end of
+    the sequence, which is only looked for when the length of the slice
+    is asked for (a `TokenWindow` has none).
+    """
 
+    def __init__(self, tokens, start, stop=None):
+        self.tokens = tokens
+        self.start = max(start, 0)
+        self.stop = stop
 
+    def __len__(self):
+        stop = len(self.tokens)
+        if self.stop is not None:
+            stop = min(self.stop, stop)
+        return max(stop - self.start, 0)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or self.stop is not None and self.start + i >= self.stop:
+            raise IndexError('token slice index out of range')
+        return self.tokens[self.start + i]
+
+    def __iter__(self):
+        tokens = self.tokens
+        i = self.start
+        while self.stop is None or i < self.stop:
+            try:
+                token = tokens[i]
+            except IndexError:
+                return
+            yield token
+            i += 1
+
+    def raw(self):
+        """ Return the raw source text covered by the slice. """
+        if isinstance(self.tokens, TokenBuffer):
+            return self.tokens.source(self.start, self.start + len(self))
+        return ''.join(tok[3] for tok in self)
+
+
+if __name__ == '__main__':
+    # diff the tokenizer engines on a corpus of LaTeX files
+    import sys, codecs
+    failed = 0
+    for fn in sys.argv[1:]:
+        diff = diff_engines(codecs.open(fn, 'r', 'latin1').read())
+        if diff is None:
+            print 'OK   ', fn
+        else:
+            failed += 1
+            print 'DIFF ', fn, 'token %d:' % diff[0]
+            for engine, tok in zip(Tokenizer.engines, diff[1:]):
+                print '    %-8s %r' % (engine, tok)
+    sys.exit(failed and 1 or 0)
@@ -8,6 +8,7 @@
 """
 
 import re
+from bisect import bisect_left, bisect_right
 
 from docutils.nodes import make_id
 
@@ -40,10 +41,163 @@ def umlaut(cmd, c):
         from .latexparser import ParserError
         raise ParserError('unsupported umlaut \\%s%s' % (cmd, c), 0)
 
+fixup_re = re.compile(r"[`'|*]")
+
 def fixup_text(text):
+    # most text has nothing to fix: one scan instead of five
+    if fixup_re.search(text) is None:
+        return text
     return text.replace('``', '"').replace("''", '"').replace('`', "'").\
            replace('|', '\\|').replace('*', '\\*')
 
+def dedent_lines(text):
+    """
+    Split `text` into lines and remove their common leading whitespace,
+    with the same result as ``textwrap.dedent(text).split('\\n')``, but
+    without rebuilding the text.
+    """
+    lines = text.split('\n')
+    margin = None
+    for i, line in enumerate(lines):
+        stripped = line.lstrip(' \t')
+        if not stripped:
+            lines[i] = ''
+            continue
+        indent = line[:len(line) - len(stripped)]
+        if margin is None or margin.startswith(indent):
+            margin = indent
+        elif not indent.startswith(margin):
+            for j, (x, y) in enumerate(zip(margin, indent)):
+                if x != y:
+                    margin = margin[:j]
+                    break
+    if margin:
+        cut = len(margin)
+        lines = [line[cut:] for line in lines]
+    return lines
+
+# where paragraph text may be broken besides whitespace: after the hyphen of
+# a hyphenated word and around an em-dash; interpreted text that follows
+# whitespace is kept whole up to the next whitespace
+wordsep_re = re.compile(
+        r'(\s+|'                                  # any whitespace
+        r'(?<=\s)(?::[a-z-]+:)?`\S+|'             # interpreted text start
+        r'[^\s\w]*\w+[a-zA-Z]-(?=\w+[a-zA-Z])|'   # hyphenated words
+        r'(?<=[\w\!\"\'\&\.\,\?])-{2,}(?=\w))')   # em-dash
+interpreted_start_re = re.compile(r'(?::[a-z-]+:)?`.')
+backquotes_re = re.compile(r'(:[a-zA-Z0-9_-]+:)?(`+)')
+
+def _wrap_patterns(flags):
+    return (re.compile(wordsep_re.pattern, flags),
+            re.compile(r'(?<!\S)[^\s-]*-\S*', flags),  # hyphenated word
+            re.compile(r'.*\s', flags | re.S),         # up to the last space
+            re.compile(r'\s+', flags),
+            re.compile(r'\S+', flags))
+
+# \s and \w depend on the type of the text, as in textwrap
+_wrap_str_patterns = _wrap_patterns(0)
+_wrap_unicode_patterns = _wrap_patterns(re.U)
+
+def markup_spans(text):
+    """
+    Return the ``(start, end)`` offsets of the interpreted text and inline
+    literals in `text`, with their role names.  Markup that is not closed
+    runs to the end of the text.
+    """
+    spans = []
+    # the length of the backquotes that opened the markup we are in
+    inmarkup = 0
+    for m in backquotes_re.finditer(text):
+        n = len(m.group(2))
+        if inmarkup:
+            if n == inmarkup:
+                spans.append((start, m.end()))
+                inmarkup = 0
+        elif n <= 2:
+            start = m.start()
+            inmarkup = n
+    if inmarkup:
+        spans.append((start, len(text)))
+    return spans
+
+def word_breaks(text, patterns=_wrap_str_patterns):
+    """
+    Return the sorted offsets in the words of `text` where `wordsep_re`
+    splits them, leaving out those in markup.
+    """
+    wordsep, hyphenated = patterns[:2]
+    spans = '`' in text and markup_spans(text) or []
+    starts = [first for first, last in spans]
+    breaks = []
+    for m in hyphenated.finditer(text):
+        word = m.group()
+        if m.start() and interpreted_start_re.match(word):
+            continue
+        offset = m.start()
+        for chunk in filter(None, wordsep.split(word))[:-1]:
+            offset += len(chunk)
+            i = bisect_left(starts, offset) - 1
+            if i < 0 or offset >= spans[i][1]:
+                breaks.append(offset)
+    return breaks
+
+def wrap_text(text, width):
+    """
+    Wrap the paragraph `text` into lines of at most `width` characters,
+    like a ``textwrap.TextWrapper(width, break_long_words=False)`` that
+    splits words with `wordsep_re` would, but without breaking in markup.
+    Lines are cut out of the text at once instead of built chunk by chunk.
+    """
+    if width <= 0:
+        raise ValueError('invalid width %r (must be > 0)' % width)
+    text = text.expandtabs()
+    # the other whitespace characters count as spaces
+    for char in '\n\r\x0b\x0c':
+        if char in text:
+            text = text.replace(char, ' ')
+    if isinstance(text, unicode):
+        patterns = _wrap_unicode_patterns
+    else:
+        patterns = _wrap_str_patterns
+    lastspace, spaces, word = patterns[2:]
+    breaks = '-' in text and word_breaks(text, patterns) or []
+    lines = []
+    pos = 0
+    length = len(text)
+    while pos < length:
+        if length - pos <= width:
+            end = length
+        else:
+            # the last chunk boundary that leaves the line short enough
+            limit = pos + width
+            if text[limit].isspace():
+                end = pos + len(text[pos:limit].rstrip())
+            else:
+                m = lastspace.match(text, pos, limit)
+                end = m and m.end() or pos
+            if breaks:
+                i = bisect_right(breaks, limit) - 1
+                if i >= 0 and breaks[i] > end:
+                    end = breaks[i]
+            if end <= pos:
+                # a chunk longer than the line gets a line of its own
+                if text[pos].isspace():
+                    end = spaces.match(text, pos).end()
+                else:
+                    end = word.match(text, pos).end()
+                    i = bisect_right(breaks, pos)
+                    if i < len(breaks) and breaks[i] < end:
+                        end = breaks[i]
+        # whitespace at the end of a line is dropped
+        line = text[pos:end].rstrip()
+        if line:
+            lines.append(line)
+        pos = end
+        # and at the start of a line, except the first
+        if lines and pos < length and text[pos].isspace():
+            pos = spaces.match(text, pos).end()
+    return lines
+
 def empty(node):
     return (type(node) is EmptyNode)
 
@@ -62,6 +216,40 @@ def text(node, skipcmd=[]):
     raise WriterError('text() failed for %r' % node)
 
 
+class Diagnostic(object):
+    """
+    A problem that the parser or writer got over in recovery mode: the file
+    and line (None if not known) where it is, the command or environment
+    it is in, and the error message.
+    """
+    def __init__(self, filename, lineno, command, message):
+        self.filename = filename
+        self.lineno = lineno
+        self.command = command
+        self.message = message
+
+    def __repr__(self):
+        return 'Diagnostic(%r, %r, %r, %r)' % (self.filename, self.lineno,
+                                               self.command, self.message)
+
+    def __str__(self):
+        return '%s:%s: %s: %s' % (self.filename, self.lineno or '?',
+                                  self.command, self.message)
+
+    @classmethod
+    def from_error(cls, err, filename, lineno, command):
+        """ Return the diagnostic for the exception `err`. """
+        from .latexparser import ParserError
+        from .restwriter import WriterError
+        if isinstance(err, ParserError):
+            message = err.args[0]
+            lineno = err.args[1] or lineno
+        elif isinstance(err, WriterError):
+            message = err.args[0]
+        else:
+            message = '%s: %s' % (err.__class__.__name__, err)
+        return cls(filename, lineno, command, message)
+
 
 markup_re = re.compile(r'(:[a-zA-Z0-9_-]+:)?`(.*?)`')
 
@@ -76,29 +264,38 @@ bad_markup_re = re.compile(r'(:[a-zA-Z0-9_-]+:)?(`{1,2})[ ]*(.+?)[ ]*(\2)')
 quoted_code_re = re.compile(r'\\`(``.+?``)\'')
 paren_re = re.compile(r':(func|meth|cfunc):`(.*?)\(\)`')
 
+def _repair_markup(m):
+    s, e = m.span()
+    if m.end(2) == m.start(3) and m.end(3) == m.start(4):
+        markup = m.group()
+    else:
+        # strip the spaces inside the markup
+        markup = (m.group(1) or '') + m.group(2) + m.group(3) + m.group(4)
+    # and separate it from the words around it
+    xtext = m.string
+    if s != 0 and xtext[s-1] in wordchars_s:
+        markup = '\\ ' + markup
+    if e != len(xtext) and xtext[e] in wordchars_e:
+        markup += '\\ '
+    return markup
+
 def repair_bad_inline_markup(text):
+    # all the repairs are of markup, or of the placeholders for it
+    if '`' not in text and '\x02' not in text and '\x03' not in text:
+        return text
+
     # remove quoting from `\code{x}'
-    xtext = quoted_code_re.sub(r'\1', text)
+    if '\\```' in text:
+        text = quoted_code_re.sub(r'\1', text)
 
     # special: the literal backslash
-    xtext = xtext.replace('``\\``', '\x03')
+    xtext = text.replace('``\\``', '\x03')
     # special: literal backquotes
     xtext = xtext.replace('``````', '\x02')
 
     # remove () from function markup
-    xtext = paren_re.sub(r':\1:`\2`', xtext)
-
-    ntext = []
-    lasti = 0
-    l = len(xtext)
-    for m in bad_markup_re.finditer(xtext):
-        ntext.append(xtext[lasti:m.start()])
-        s, e = m.start(), m.end()
-        if s != 0 and xtext[s-1:s] in wordchars_s:
-            ntext.append('\\ ')
-        ntext.append((m.group(1) or '') + m.group(2) + m.group(3) + m.group(4))
-        if e != l and xtext[e:e+1] in wordchars_e:
-            ntext.append('\\ ')
-        lasti = m.end()
-    ntext.append(xtext[lasti:])
-    return ''.join(ntext).replace('\x02', '``````').replace('\x03', '``\\``')
+    if '()`' in xtext:
+        xtext = paren_re.sub(r':\1:`\2`', xtext)
+
+    xtext = bad_markup_re.sub(_repair_markup, xtext)
+    return xtext.replace('\x02', '``````').replace('\x03', '``\\``')